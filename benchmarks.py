@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+from unittest import mock
+
+from lydia import Lydia
+from models import LydiaConfig
+from rules import RuleEngine
+from eyed3_utils import Eyed3Utils
+
+
+class SyntheticLibrary:
+    """
+    Generates a synthetic (but realistically messy) music library to benchmark lydia against: an artists directory full
+    of artist/album trees, an albums (downloads) directory, and empty staging/inventory directories.
+
+    Every track is a real (tiny) .mp3 file - a single silent MPEG frame carrying an ID3v2.4 tag.
+    """
+
+    ARTIST_NAMES = [
+        "joy division", "Judy Collins", "NEW ORDER", "the durutti column", "Cocteau Twins", "坂本龍一",
+        "yellow magic orchestra"
+    ]
+
+    ALBUM_NAME_FORMATS = [
+        "{year} - {title}",
+        "{year} - {Title}",
+        "({year}) - {Title}",
+        "[{year}] - {title}",
+        "{year} - {year} - {title}",
+        "{Title}",
+        "{year} - 未知の快楽 {index}",
+    ]
+
+    MPEG_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+    def __init__(self, root, albums=1000, tracks_per_album=3, albums_per_artist=5, downloaded_albums=None, seed=0):
+        """
+        :param root: The directory to generate the library in.
+        :param albums: The number of albums in the artists directory.
+        :param tracks_per_album: The number of .mp3 files in each album.
+        :param albums_per_artist: The number of albums in each artist directory.
+        :param downloaded_albums: The number of albums in the albums directory (defaults to a tenth of `albums`).
+        :param seed: The random seed; the same seed always generates the same library.
+        """
+
+        self.root = root
+        self.albums = albums
+        self.tracks_per_album = tracks_per_album
+        self.albums_per_artist = albums_per_artist
+        self.downloaded_albums = downloaded_albums if downloaded_albums is not None else max(1, albums // 10)
+        self.seed = seed
+
+        self.artists_directory = os.path.join(root, "artists")
+        self.albums_directory = os.path.join(root, "albums")
+        self.staging_directory = os.path.join(root, "staging")
+        self.inventory_path = os.path.join(root, "inventory")
+
+    def generate(self):
+        """
+        (Re-)generates the library from scratch.
+        """
+
+        random.seed(self.seed)
+
+        for directory in (self.artists_directory, self.albums_directory, self.staging_directory, self.inventory_path):
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+            os.makedirs(directory)
+
+        for index in range(0, self.albums, self.albums_per_artist):
+            artist = self.artist_name(index // self.albums_per_artist)
+            artist_path = os.path.join(self.artists_directory, artist)
+            os.mkdir(artist_path)
+
+            for album_index in range(index, min(index + self.albums_per_artist, self.albums)):
+                self.create_album(os.path.join(artist_path, self.album_name(album_index)), artist, album_index)
+
+            if random.random() < 0.05:
+                self.create_file(os.path.join(artist_path, "folder.jpg"))
+
+        for index in range(self.downloaded_albums):
+            artist = self.artist_name(random.randrange(self.albums // self.albums_per_artist + 1))
+            album_index = self.albums + index
+            self.create_album(os.path.join(self.albums_directory, self.album_name(album_index)), artist, album_index)
+
+        # leftovers: empty artist/album folders and loose files
+        os.mkdir(os.path.join(self.artists_directory, "empty artist"))
+        os.mkdir(os.path.join(self.albums_directory, "Empty Album"))
+        self.create_file(os.path.join(self.albums_directory, "loose file.txt"))
+
+    def artist_name(self, index):
+        return f"{SyntheticLibrary.ARTIST_NAMES[index % len(SyntheticLibrary.ARTIST_NAMES)]} {index}"
+
+    def album_name(self, index):
+        name_format = SyntheticLibrary.ALBUM_NAME_FORMATS[index % len(SyntheticLibrary.ALBUM_NAME_FORMATS)]
+        title = f"unknown pleasures {index}"
+
+        return name_format.format(year=1950 + index % 70, title=title, Title=title.title(), index=index)
+
+    def create_album(self, path, artist, index):
+        os.mkdir(path)
+
+        if random.random() < 0.02:
+            return  # an empty album
+
+        for track in range(1, self.tracks_per_album + 1):
+            SyntheticLibrary.create_mp3(
+                os.path.join(path, f"{track:02} - track {track}.mp3"),
+                artist=artist.title(),
+                album=f"Unknown Pleasures {index}",
+                year=str(1950 + index % 70)
+            )
+
+    @staticmethod
+    def create_file(path):
+        with open(path, "wb") as f:
+            f.write(b"\x00" * 64)
+
+    @staticmethod
+    def create_mp3(path, artist, album, year, padding=256):
+        """
+        Writes a single-frame .mp3 file with an ID3v2.4 tag (TPE1, TALB and TDRC frames).
+        """
+
+        frames = b"".join(
+            SyntheticLibrary.create_id3_frame(frame_id, text)
+            for frame_id, text in (("TPE1", artist), ("TALB", album), ("TDRC", year))
+        ) + b"\x00" * padding
+
+        with open(path, "wb") as f:
+            f.write(b"ID3\x04\x00\x00" + SyntheticLibrary.syncsafe(len(frames)) + frames)
+            f.write(SyntheticLibrary.MPEG_FRAME)
+
+    @staticmethod
+    def create_flac(path, artist, album, year, seconds=1, sample_rate=44100):
+        """
+        Writes a (truncated) .flac file: a STREAMINFO block, a cover-art PICTURE block and a VORBIS_COMMENT block,
+        followed by some dummy audio frames.
+        """
+
+        # 16-bit minimum/maximum block sizes, 24-bit minimum/maximum frame sizes, then sample rate (20 bits), channels
+        # (3), bits per sample (5) and total samples (36), then a 128-bit MD5
+        packed = (sample_rate << 44) | (1 << 41) | (15 << 36) | (seconds * sample_rate)
+        streaminfo = b"\x10\x00\x10\x00" + b"\x00" * 6 + packed.to_bytes(8, "big") + b"\x00" * 16
+
+        comments = [f"ARTIST={artist}", f"ALBUM={album}", f"DATE={year}"]
+        vorbis_comment = b"".join(
+            [len(b"lydia").to_bytes(4, "little"), b"lydia", len(comments).to_bytes(4, "little")]
+            + [len(c.encode("utf-8")).to_bytes(4, "little") + c.encode("utf-8") for c in comments]
+        )
+
+        with open(path, "wb") as f:
+            f.write(b"fLaC")
+
+            for block_type, data in ((0, streaminfo), (6, b"\x00" * 4096), (4 | 0x80, vorbis_comment)):
+                f.write(bytes([block_type]) + len(data).to_bytes(3, "big") + data)
+
+            f.write(b"\xff\xf8" + b"\x00" * 1024)
+
+    @staticmethod
+    def create_id3_frame(frame_id, text):
+        data = b"\x03" + text.encode("utf-8")  # 0x03 = UTF-8
+        return frame_id.encode("ascii") + SyntheticLibrary.syncsafe(len(data)) + b"\x00\x00" + data
+
+    @staticmethod
+    def syncsafe(number):
+        return bytes([(number >> 21) & 0x7F, (number >> 14) & 0x7F, (number >> 7) & 0x7F, number & 0x7F])
+
+
+class Benchmark:
+    """
+    Times lydia's commands against freshly generated synthetic libraries.
+    """
+
+    BENCHMARKS = [
+        "clean_artists_directory",
+        "clean_albums_directory",
+        "migrate_albums_to_staging_directory",
+        "create_inventory",
+        "validate_album_names",
+        "fix_idv3_metadata"
+    ]
+
+    def __init__(self, library, jobs=1, pool="thread", catalog=False):
+        """
+        :param library: The `SyntheticLibrary` to benchmark against.
+        :param jobs: The number of workers lydia may use to read tags.
+        :param pool: Either "thread" or "process".
+        :param catalog: Whether lydia should use a (cold) catalog.
+        """
+
+        self.library = library
+        self.jobs = jobs
+        self.pool = pool
+        self.catalog = catalog
+
+    def create_config(self):
+        config_file_path = os.path.join(self.library.root, "config.json")
+
+        with open(config_file_path, "w") as f:
+            json.dump({
+                "albums_directory": self.library.albums_directory,
+                "artists_directory": self.library.artists_directory,
+                "staging_directory": self.library.staging_directory,
+                "inventory_path": self.library.inventory_path,
+                "catalog_path": os.path.join(self.library.root, "catalog.db") if self.catalog else None,
+                "journal_path": os.path.join(self.library.root, "journal.jsonl"),
+                "album_validation_behavior": {
+                    "rename_as_lowercase": "force",
+                    "rename_as_year_plus_title": "force",
+                    "remove_empty_folders": "force",
+                    "remove_folders_with_no_mp3s_or_flacs": "force"
+                }
+            }, f)
+
+        return LydiaConfig(config_file_path)
+
+    def run(self, benchmarks=None):
+        """
+        Runs each benchmark against a freshly generated library, and returns their wall times (in seconds).
+        """
+
+        results = {}
+
+        for name in benchmarks or Benchmark.BENCHMARKS:
+            self.library.generate()
+
+            if self.catalog and os.path.isfile(os.path.join(self.library.root, "catalog.db")):
+                os.remove(os.path.join(self.library.root, "catalog.db"))
+
+            lydia = Lydia(jobs=self.jobs, pool=self.pool, config=self.create_config())
+            command = self.get_command(lydia, name)
+
+            # lydia is chatty, and must never block on a prompt mid-benchmark
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                    mock.patch("builtins.input", return_value="n"):
+                start = time.perf_counter()
+                command()
+                results[name] = time.perf_counter() - start
+
+            if lydia.catalog:
+                lydia.catalog.close()
+
+        return results
+
+    def get_command(self, lydia, name):
+        if name == "clean_artists_directory":
+            return lambda: lydia.clean_artists_directory(force=False)
+
+        if name == "validate_album_names":
+            # a hundred names per album, a third of them messy - checked without touching the disk
+            names = [
+                f"{1900 + i % 100} - Album {i}" if i % 3 else f"album {i}" for i in range(self.library.albums * 100)
+            ]
+            engine = RuleEngine(lydia.config.album_validation_behavior)
+
+            return lambda: engine.validate_names(names)
+
+        if name == "fix_idv3_metadata":
+            artists_directory = self.library.artists_directory
+
+            return lambda: [
+                Eyed3Utils.fix_idv3_metadata(artist_directory=os.path.join(artists_directory, a), artist=a)
+                for a in sorted(os.listdir(artists_directory))
+            ]
+
+        return getattr(lydia, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks lydia against synthetic music libraries.")
+
+    parser.add_argument("--albums", type=int, nargs="+", default=[1000], help="The library sizes (in albums) to test.")
+    parser.add_argument("--tracks", type=int, default=3, help="The number of tracks per album.")
+    parser.add_argument("--benchmarks", nargs="+", choices=Benchmark.BENCHMARKS, default=Benchmark.BENCHMARKS)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--pool", choices=["thread", "process"], default="thread")
+    parser.add_argument("--catalog", action="store_true", help="Benchmark with a (cold) catalog.")
+    parser.add_argument("--directory", help="Where to generate libraries (defaults to a temporary directory).")
+    parser.add_argument("--output", help="Where to write the JSON report (defaults to stdout).")
+
+    args = parser.parse_args()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "jobs": args.jobs,
+        "pool": args.pool,
+        "catalog": args.catalog,
+        "runs": []
+    }
+
+    root = args.directory or tempfile.mkdtemp(prefix="lydia-benchmarks-")
+
+    try:
+        for albums in args.albums:
+            print(f"INFO: Benchmarking a {albums}-album library...", file=sys.stderr)
+
+            library = SyntheticLibrary(os.path.join(root, str(albums)), albums=albums, tracks_per_album=args.tracks)
+            os.makedirs(library.root, exist_ok=True)
+
+            results = Benchmark(library, jobs=args.jobs, pool=args.pool, catalog=args.catalog).run(args.benchmarks)
+
+            report["runs"].append({"albums": albums, "tracks_per_album": args.tracks, "seconds": results})
+    finally:
+        if not args.directory:
+            shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
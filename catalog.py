@@ -0,0 +1,141 @@
+import os
+import json
+import sqlite3
+
+from metrics import metrics
+
+
+class Catalog:
+    """
+    A persistent (SQLite) index of parsed ID3 fields and directory listings.
+
+    Every entry is stored alongside the size/mtime of the file or directory it was read from, and is only trusted while
+    those still match what's on disk - so an unchanged library never has to be re-parsed between runs.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path to the SQLite database file (created if it does not exist).
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                fields TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER NOT NULL,
+                directories TEXT NOT NULL,
+                files TEXT NOT NULL
+            );
+            """
+        )
+
+    def get_tag_fields(self, path, size, mtime):
+        """
+        Returns the cached tag fields of a file, or None if the file is unknown or has changed since it was cached.
+        """
+
+        row = self.connection.execute(
+            "SELECT size, mtime, fields FROM tracks WHERE path = ?", (path,)
+        ).fetchone()
+
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+
+        metrics.count("catalog_tag_hits")
+        return json.loads(row[2])
+
+    def put_tag_fields(self, path, size, mtime, fields):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tracks (path, size, mtime, fields) VALUES (?, ?, ?, ?)",
+            (path, size, mtime, json.dumps(fields))
+        )
+
+    def listdir(self, path):
+        """
+        Returns the (subdirectories, files) directly inside a directory. The listing is re-read from disk only if the
+        directory's mtime has changed since it was cached.
+        """
+
+        mtime = os.stat(path).st_mtime_ns
+
+        row = self.connection.execute(
+            "SELECT mtime, directories, files FROM directories WHERE path = ?", (path,)
+        ).fetchone()
+
+        if row is not None and row[0] == mtime:
+            metrics.count("catalog_listing_hits")
+            return json.loads(row[1]), json.loads(row[2])
+
+        metrics.count("directories_visited")
+
+        directories, files = [], []
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.name)
+                else:
+                    files.append(entry.name)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories (path, mtime, directories, files) VALUES (?, ?, ?, ?)",
+            (path, mtime, json.dumps(directories), json.dumps(files))
+        )
+
+        return directories, files
+
+    def walk(self, path):
+        """
+        A drop-in replacement for `os.walk` (top-down) that reads directory listings through the catalog.
+        """
+
+        try:
+            directories, files = self.listdir(path)
+        except OSError:
+            return
+
+        yield path, directories, files
+
+        for directory in directories:
+            yield from self.walk(os.path.join(path, directory))
+
+    def relocate(self, old_path, new_path):
+        """
+        Re-keys every entry at or beneath `old_path` so that it lives beneath `new_path` (e.g. after a rename/move),
+        which keeps moved files from being re-parsed on the next run.
+        """
+
+        for table in ("tracks", "directories"):
+            self.connection.execute(
+                f"UPDATE OR REPLACE {table} SET path = ? || substr(path, ?) "
+                f"WHERE path = ? OR substr(path, 1, ?) = ?",
+                (new_path, len(old_path) + 1, old_path, len(old_path) + 1, old_path + os.sep)
+            )
+
+    def forget(self, path):
+        """
+        Drops every entry at or beneath `path` (e.g. after a delete).
+        """
+
+        for table in ("tracks", "directories"):
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE path = ? OR substr(path, 1, ?) = ?",
+                (path, len(path) + 1, path + os.sep)
+            )
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
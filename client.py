@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import socket
+import argparse
+
+
+def send(request, address):
+    """
+    Sends a single request to a running `lydia.py --serve` and returns its response.
+
+    :param request: {"command": ..., ...its arguments}.
+    :param address: The server's Unix socket path, or a (host, port) tuple.
+    """
+
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+
+    with socket.socket(family, socket.SOCK_STREAM) as connection:
+        connection.connect(address)
+        connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+        with connection.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def read_config():
+    """
+    Returns the `config.json` next to lydia (read directly, so that the client stays light), or {} if it can't be.
+    """
+
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_default_socket_path():
+    """
+    Returns the `socket_path` from the `config.json` next to lydia.
+    """
+
+    return read_config().get("socket_path", os.path.join(os.path.dirname(os.path.abspath(__file__)), "lydia.sock"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sends a command to a running `lydia.py --serve`.")
+
+    parser.add_argument("--socket", dest="socket", help="The server's Unix socket (defaults to `socket_path`).")
+    parser.add_argument("--port", dest="port", type=int, help="Connects to a server on localhost:PORT instead.")
+    parser.add_argument("--token", dest="token", help="The server's token (defaults to `server_token`).")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("ping", "clean-albums", "stage", "unstage", "refresh", "shutdown"):
+        commands.add_parser(command)
+
+    clean_artists = commands.add_parser("clean-artists")
+    clean_artists.add_argument("-f", "--force", dest="force", action="store_true")
+
+    inventory = commands.add_parser("inventory")
+    inventory.add_argument("--incremental", dest="incremental", action="store_true")
+    inventory.add_argument("--gzip", dest="gzip", action="store_true")
+
+    query = commands.add_parser("query")
+    query.add_argument("query", help="e.g. `artist:\"joy division\" year:1979-1982`")
+
+    lookup = commands.add_parser("lookup")
+    lookup.add_argument("--artist", dest="artist")
+    lookup.add_argument("--album", dest="album")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    arguments = {
+        k: v for k, v in vars(args).items() if k not in ("socket", "port", "token", "command") and v is not None
+    }
+    token = args.token or read_config().get("server_token")
+
+    response = send(
+        {"command": args.command.replace("-", "_"), **arguments, **({"token": token} if token else {})},
+        ("127.0.0.1", args.port) if args.port else args.socket or get_default_socket_path()
+    )
+
+    sys.stdout.write(response.get("output", ""))
+
+    if isinstance(response.get("result"), list):
+        for item in response["result"]:
+            print(item if isinstance(item, str) else json.dumps(item))
+
+    if not response["ok"]:
+        print(f"ERROR: {response.get('error', 'the command failed.')}")
+        exit(1)
@@ -0,0 +1,278 @@
+import os
+import re
+import json
+import hashlib
+from collections import defaultdict
+
+from eyed3 import id3
+
+from models import Flac, FlacReader, Id3v2Reader, Track
+from duplicates import DuplicateFinder
+from metrics import metrics
+
+
+class CoverReader:
+    """
+    Reads a track's embedded cover art - and nothing else. For .mp3s, just the ID3v2 frame headers and the APIC
+    frames' payloads are read (every other frame is seeked past); for .flacs, just the metadata block headers and
+    PICTURE blocks. Tags the native reader can't handle (see `Id3v2Reader`) are left to eyed3.
+    """
+
+    FRONT_COVER = 3
+    PICTURE = 6  # FLAC metadata block type
+
+    # what the image data starts with -> its extension (image types are sniffed, since mime types are often wrong)
+    SIGNATURES = {b"\xFF\xD8\xFF": ".jpg", b"\x89PNG": ".png", b"GIF8": ".gif", b"BM": ".bmp"}
+
+    @staticmethod
+    def read_cover(path):
+        """
+        Returns the image data of a track's front cover (or, failing that, its first picture of any kind), or None if
+        it has none.
+        """
+
+        try:
+            with metrics.phase("cover_reading"):
+                if Track.get_track_type(path) is Flac:
+                    pictures = CoverReader.read_flac_pictures(path)
+                else:
+                    pictures = CoverReader.read_id3_pictures(path)
+
+                    if pictures is None:
+                        pictures = CoverReader.read_id3_pictures_with_eyed3(path)
+
+        except OSError as e:
+            print(f"WARNING: could not read '{path}'.")
+            print(e)
+            return None
+
+        pictures = [(picture_type, data) for picture_type, data in pictures if data]
+
+        if not pictures:
+            return None
+
+        metrics.count("covers_read")
+
+        # stable: the first front cover, else the first picture
+        return sorted(pictures, key=lambda picture: picture[0] != CoverReader.FRONT_COVER)[0][1]
+
+    @staticmethod
+    def get_extension(data):
+        for signature, extension in CoverReader.SIGNATURES.items():
+            if data.startswith(signature):
+                return extension
+
+        return ".jpg"
+
+    @staticmethod
+    def read_id3_pictures(path):
+        """
+        Returns the (picture type, image data) of each of the .mp3 file's APIC frames - or None if eyed3 should read
+        them instead.
+        """
+
+        pictures = []
+
+        with open(path, "rb") as f:
+            try:
+                for version, frame_id, frame_size, is_supported in Id3v2Reader.iter_frames(f):
+                    if frame_id != b"APIC":
+                        continue
+
+                    if not is_supported:
+                        return None
+
+                    picture = CoverReader.parse_apic(f.read(frame_size))
+
+                    if picture is None:
+                        return None
+
+                    pictures.append(picture)
+            except ValueError:
+                return None
+
+        return pictures
+
+    @staticmethod
+    def parse_apic(payload):
+        """
+        Parses an APIC frame's payload (encoding, mime type, picture type, description, image data) into (picture
+        type, image data), or None if it's malformed.
+        """
+
+        mime_end = payload.find(b"\x00", 1)
+
+        if not payload or mime_end < 0 or mime_end + 2 > len(payload):
+            return None
+
+        encoding, picture_type, position = payload[0], payload[mime_end + 1], mime_end + 2
+
+        if payload[1:mime_end] == b"-->":
+            return picture_type, None  # a link to an image, not an image
+
+        # the description is terminated by one null byte (latin-1/utf-8), or two aligned ones (utf-16)
+        if encoding in (1, 2):
+            while position + 1 < len(payload) and payload[position:position + 2] != b"\x00\x00":
+                position += 2
+
+            position += 2
+        else:
+            position = payload.find(b"\x00", position) + 1
+
+            if position == 0:
+                return None
+
+        return picture_type, payload[position:]
+
+    @staticmethod
+    def read_id3_pictures_with_eyed3(path):
+        id_tag = id3.Tag()
+
+        if not id_tag.parse(path):
+            return []
+
+        return [(image.picture_type, image.image_data) for image in id_tag.images]
+
+    @staticmethod
+    def read_flac_pictures(path):
+        """
+        Returns the (picture type, image data) of each of the .flac file's PICTURE blocks (big-endian: picture type,
+        mime type, description, width, height, depth, colors, then the image data - each length-prefixed).
+        """
+
+        pictures = []
+
+        with open(path, "rb") as f:
+            if not FlacReader.find_stream(f):
+                return pictures
+
+            for block_type, length in FlacReader.iter_blocks(f):
+                if block_type != CoverReader.PICTURE:
+                    continue
+
+                block = f.read(length)
+                position = 4
+
+                for _ in range(2):  # mime type, description
+                    position += 4 + int.from_bytes(block[position:position + 4], "big")
+
+                position += 16  # width, height, depth, colors
+                data_length = int.from_bytes(block[position:position + 4], "big")
+
+                pictures.append((int.from_bytes(block[0:4], "big"), block[position + 4:position + 4 + data_length]))
+
+        return pictures
+
+
+class CoverCache:
+    """
+    Extracts one cover per album (from the first of its tracks that has any embedded art) into a cache directory, where
+    each image is stored once, named by the SHA-256 of its contents - so the same cover embedded in every track of an
+    album, or shared by several albums, takes up the space of one. `covers.json` maps each album to its cover:
+
+        {"<album path>": {"cover": "<sha-256>.jpg" or null, "tracks": [[name, size, mtime], ...]}}
+
+    Albums whose tracks haven't changed since the last run aren't read again.
+    """
+
+    COVER_REGEX = re.compile(r"^[0-9a-f]{64}\.\w+$")
+
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.index_path = os.path.join(cache_directory, "covers.json")
+        self.index = self.load()
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return {}
+
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def save(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def get(self, album_path):
+        """
+        Returns the path of an album's cached cover, or None if it hasn't got one (or hasn't been extracted yet).
+        """
+
+        entry = self.index.get(album_path)
+        return os.path.join(self.cache_directory, entry["cover"]) if entry and entry["cover"] else None
+
+    def update(self, snapshot, artists_directory=None, albums_directory=None):
+        """
+        Extracts the covers of every album in the artists and albums directories, then forgets albums (and deletes
+        images) that are gone.
+
+        :param snapshot: The `LibrarySnapshot` to read the trees from.
+        :return: The number of distinct covers in the cache.
+        """
+
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+        albums = defaultdict(list)  # album path -> its tracks' paths
+
+        for root, depth in ((artists_directory, 2), (albums_directory, 1)):
+            if root and os.path.isdir(root):
+                for album_path, track_path in DuplicateFinder.iter_album_tracks(snapshot, root, depth):
+                    albums[album_path].append(track_path)
+
+        index = {}
+
+        with metrics.phase("cover_extraction"):
+            for album_path, tracks in sorted(albums.items()):
+                signature = [[os.path.relpath(track, album_path), *snapshot.stat(track)] for track in tracks]
+                entry = self.index.get(album_path)
+
+                if entry is None or entry["tracks"] != signature:
+                    entry = {"cover": self.extract(tracks), "tracks": signature}
+                else:
+                    metrics.count("covers_unchanged")
+
+                index[album_path] = entry
+
+        covers = {entry["cover"] for entry in index.values() if entry["cover"]}
+
+        for name in os.listdir(self.cache_directory):
+            if CoverCache.COVER_REGEX.match(name) and name not in covers:
+                os.remove(os.path.join(self.cache_directory, name))
+
+        self.index = index
+        self.save()
+
+        print(f"INFO: Found {len(covers)} distinct covers across {len(index)} albums in '{self.cache_directory}'.")
+
+        return len(covers)
+
+    def extract(self, tracks):
+        """
+        Writes the cover of the first of `tracks` that has one into the cache (unless it's already there).
+
+        :return: The cover's name in the cache, or None if none of the tracks has any art.
+        """
+
+        for track in tracks:
+            data = CoverReader.read_cover(track)
+
+            if data is not None:
+                break
+        else:
+            return None
+
+        name = hashlib.sha256(data).hexdigest() + CoverReader.get_extension(data)
+        path = os.path.join(self.cache_directory, name)
+
+        if os.path.isfile(path):
+            metrics.count("covers_deduplicated")
+        else:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+
+            os.replace(path + ".tmp", path)
+            metrics.count("covers_written")
+
+        return name
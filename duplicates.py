@@ -0,0 +1,223 @@
+import os
+import hashlib
+from collections import defaultdict
+
+from models import Flac, FlacReader, Id3v2Reader, Track
+from metrics import metrics
+from workers import TagExtractor
+
+
+class DuplicateFinder:
+    """
+    Finds albums that exist more than once across the artists and albums directories - whatever they're named, and
+    however they're tagged.
+
+    Tracks are compared by their audio payload only (i.e. without ID3 tags or FLAC metadata blocks, so that retagged
+    copies still match), in three rounds that each only look at the candidates left by the last:
+
+    1. every track is bucketed by its payload's length (and, for FLACs, duration) - a few bytes read per track;
+    2. tracks that share a bucket have the first `sample_size` bytes of their payloads hashed;
+    3. tracks that still collide have their whole payloads hashed.
+
+    Albums whose tracks' payloads are identical are duplicates.
+    """
+
+    def __init__(self, jobs=1, pool="thread", sample_size=64 * 1024):
+        """
+        :param jobs: The number of workers to read/hash files with.
+        :param pool: Either "thread" or "process".
+        :param sample_size: How much of each candidate's payload is hashed before the whole of it is.
+        """
+
+        if pool not in TagExtractor.POOLS:
+            raise ValueError(f"'{pool}' is not a valid pool; expected one of {list(TagExtractor.POOLS)}.")
+
+        self.jobs = max(1, jobs)
+        self.pool = pool
+        self.sample_size = sample_size
+
+    def find(self, snapshot, artists_directory=None, albums_directory=None):
+        """
+        :param snapshot: The `LibrarySnapshot` to read the trees from.
+        :return: A list of duplicate groups - each a sorted list of two or more album directory paths.
+        """
+
+        albums = defaultdict(list)  # album path -> its tracks' paths
+
+        # artists/<artist>/<album>/... and albums/<album>/...
+        for root, depth in ((artists_directory, 2), (albums_directory, 1)):
+            if root and os.path.isdir(root):
+                for album_path, track_path in DuplicateFinder.iter_album_tracks(snapshot, root, depth):
+                    albums[album_path].append(track_path)
+
+        paths = [path for tracks in albums.values() for path in tracks]
+
+        with metrics.phase("duplicate_detection"):
+            buckets = self.group(paths, DuplicateFinder.get_bucket)
+            samples = self.group(DuplicateFinder.get_collisions(buckets), self.hash_sample)
+            digests = self.group(DuplicateFinder.get_collisions(samples), DuplicateFinder.hash_payload)
+
+        metrics.count("tracks_bucketed", len(paths))
+
+        fingerprints = {path: digest for digest, group in digests.items() if digest is not None for path in group}
+
+        # an album with any track that has no match elsewhere can't be a duplicate
+        groups = defaultdict(list)
+
+        for album_path, tracks in albums.items():
+            if tracks and all(path in fingerprints for path in tracks):
+                groups[tuple(sorted(fingerprints[path] for path in tracks))].append(album_path)
+
+        duplicates = sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+        for group in duplicates:
+            print(f"INFO: found {len(group)} copies of the same album: {', '.join(repr(p) for p in group)}.")
+
+        print(f"INFO: Found {len(duplicates)} duplicated albums ({len(fingerprints)} of {len(paths)} tracks hashed).")
+
+        return duplicates
+
+    @staticmethod
+    def iter_album_tracks(snapshot, root, depth):
+        """
+        Yields (album path, track path) for every track nested at least `depth` directories beneath `root`; tracks in
+        an album's subdirectories (e.g. "CD1") belong to the album.
+        """
+
+        root = os.path.normpath(root)
+
+        for directory, subdirectories, files in snapshot.walk(root):
+            parts = os.path.relpath(directory, root).split(os.sep)
+
+            if directory == root or len(parts) < depth:
+                continue
+
+            album_path = os.path.join(root, *parts[:depth])
+
+            for file in sorted(files):
+                if Track.get_track_type(file):
+                    yield album_path, os.path.join(directory, file)
+
+    def group(self, paths, key):
+        """
+        Groups `paths` by `key(path)` (computed across the worker pool).
+        """
+
+        groups = defaultdict(list)
+
+        if self.jobs == 1 or len(paths) <= 1:
+            keys = map(key, paths)
+        else:
+            executor = TagExtractor.POOLS[self.pool](max_workers=self.jobs)
+            chunksize = 1 if self.pool == "thread" else max(1, len(paths) // (self.jobs * 4))
+            keys = list(executor.map(key, paths, chunksize=chunksize))
+            executor.shutdown()
+
+        for path, k in zip(paths, keys):
+            groups[k].append(path)
+
+        return groups
+
+    @staticmethod
+    def get_collisions(groups):
+        return [path for key, group in groups.items() if key is not None and len(group) > 1 for path in group]
+
+    @staticmethod
+    def get_bucket(path):
+        payload = DuplicateFinder.get_payload(path)
+        return payload[1:] if payload else None
+
+    @staticmethod
+    def get_payload(path):
+        """
+        Returns a track's (payload offset, payload length, duration) - where the duration is only known for FLACs - or
+        None if it can't be read.
+        """
+
+        try:
+            if Track.get_track_type(path) is Flac:
+                return DuplicateFinder.get_flac_payload(path)
+
+            return DuplicateFinder.get_mp3_payload(path)
+
+        except OSError as e:
+            print(f"WARNING: could not read '{path}'.")
+            print(e)
+            return None
+
+    @staticmethod
+    def get_mp3_payload(path):
+        size = os.path.getsize(path)
+        start, end = 0, size
+
+        with open(path, "rb") as f:
+            # skip any ID3v2 tags at the front (taggers occasionally stack them) ...
+            while True:
+                f.seek(start)
+                header = f.read(Id3v2Reader.TAG_HEADER.size)
+
+                if len(header) < Id3v2Reader.TAG_HEADER.size or header[:3] != b"ID3":
+                    break
+
+                footer = 10 if header[5] & 0x10 else 0
+                start += Id3v2Reader.TAG_HEADER.size + Id3v2Reader.syncsafe(header[6:10]) + footer
+
+            # ... and an ID3v1 tag at the back
+            if end - start >= 128:
+                f.seek(end - 128)
+
+                if f.read(3) == b"TAG":
+                    end -= 128
+
+        return min(start, size), max(0, end - start), None
+
+    @staticmethod
+    def get_flac_payload(path):
+        duration = None
+
+        with open(path, "rb") as f:
+            if not FlacReader.find_stream(f):
+                return DuplicateFinder.get_mp3_payload(path)
+
+            for block_type, length in FlacReader.iter_blocks(f):
+                if block_type == FlacReader.STREAMINFO:
+                    duration = FlacReader.get_duration(f.read(length))
+
+            start = f.tell()
+
+        return start, os.path.getsize(path) - start, duration
+
+    def hash_sample(self, path):
+        return DuplicateFinder.hash_payload(path, limit=self.sample_size)
+
+    @staticmethod
+    def hash_payload(path, limit=None):
+        """
+        Returns the SHA-256 digest of a track's audio payload (or of its first `limit` bytes), or None if it can't be
+        read.
+        """
+
+        payload = DuplicateFinder.get_payload(path)
+
+        if payload is None:
+            return None
+
+        offset, length, duration = payload
+        remaining = min(length, limit) if limit else length
+        digest = hashlib.sha256()
+
+        metrics.count("bytes_hashed", remaining)
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+
+            while remaining > 0:
+                block = f.read(min(remaining, 1024 * 1024))
+
+                if not block:
+                    break
+
+                digest.update(block)
+                remaining -= len(block)
+
+        return digest.hexdigest()
@@ -1,5 +1,4 @@
-import os
-import eyed3
+from retag import Retagger
 
 
 class Eyed3Utils:
@@ -13,7 +12,8 @@ class Eyed3Utils:
     @staticmethod
     def fix_idv3_metadata(artist_directory=None, album_directory=None, artist=None, album=None):
         """
-        Manually curates IDv3 metadata - for instance: for albums missing artist information.
+        Manually curates IDv3 metadata - for instance: for albums missing artist information. (A single-directory
+        shortcut to `Retagger`; see `lydia.py --retag` for bulk retagging.)
         """
 
         if not artist_directory and not album_directory:
@@ -23,57 +23,9 @@ class Eyed3Utils:
             print("ERROR: please specify only one artist or album directory.")
             return None
 
-        if album_directory:
-            for file in os.listdir(album_directory):
-                if file.lower().endswith(".mp3"):
-                    mp3_file = file
-                    metadata = eyed3.load(os.path.join(album_directory, mp3_file))
+        fields = {name: value for name, value in (("artist", artist), ("album", album)) if value}
 
-                    if not metadata.tag:
-                        metadata.initTag()
-
-                    if artist:
-                        if metadata.tag.artist != artist or metadata.tag.album_artist != artist:
-                            metadata.tag.artist = artist
-                            metadata.tag.album_artist = artist
-
-                            try:
-                                metadata.tag.save()
-                                print(
-                                    f"INFO: {os.path.join(album_directory, mp3_file)} updated to"
-                                    f" reflect that {artist} is the artist and album_artist."
-                                )
-                            except NotImplementedError:
-                                pass
-
-                            metadata = eyed3.load(os.path.join(album_directory, mp3_file))
-                            print(metadata.tag.artist)
-
-        elif artist_directory:  # todo: lazy alert; please fix
-
-            for ad in os.listdir(artist_directory):
-                for file in os.listdir(os.path.join(artist_directory, ad)):
-                    if file.lower().endswith(".mp3"):
-                        mp3_file = file
-                        metadata = eyed3.load(os.path.join(artist_directory, ad, mp3_file))
-
-                        if not metadata.tag:
-                            metadata.initTag()
-
-                        if artist:
-
-                            if metadata.tag.artist != artist or metadata.tag.album_artist != artist:
-                                metadata.tag.artist = artist
-                                metadata.tag.album_artist = artist
-
-                                try:
-                                    metadata.tag.save()
-                                    print(
-                                        f"INFO: {os.path.join(artist_directory, ad, mp3_file)} updated to"
-                                        f" reflect that {artist} is the artist and album_artist."
-                                    )
-                                except NotImplementedError:
-                                    pass
+        if not fields:
+            return None
 
-                                metadata = eyed3.load(os.path.join(artist_directory, ad, mp3_file))
-                                print(metadata.tag.artist)
\ No newline at end of file
+        return Retagger().retag({artist_directory or album_directory: fields})
@@ -0,0 +1,216 @@
+import os
+import sys
+import pickle
+
+from models import Track
+from metrics import metrics
+
+
+class IndexTrack:
+    """
+    A track in a `LibraryIndex`: just its name, size, mtime and the three tag fields lydia uses.
+    """
+
+    __slots__ = ("name", "size", "mtime", "artist", "album", "recording_date")
+
+    def __init__(self, name, size, mtime, artist=None, album=None, recording_date=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.artist = artist
+        self.album = album
+        self.recording_date = recording_date
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in IndexTrack.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(IndexTrack.__slots__, state):
+            setattr(self, slot, value)
+
+
+class IndexDirectory:
+    """
+    A directory in a `LibraryIndex`. Only its (interned) basename is stored; its path is rebuilt from its parents.
+    """
+
+    __slots__ = ("name", "parent", "directories", "files", "tracks")
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.directories = {}  # name -> IndexDirectory
+        self.files = ()  # the names of any files that aren't tracks
+        self.tracks = ()  # IndexTracks, in name order
+
+    @property
+    def basename(self):
+        return self.name
+
+    @property
+    def path(self):
+        names = []
+        directory = self
+
+        while directory is not None:
+            names.append(directory.name)
+            directory = directory.parent
+
+        return os.path.join(*reversed(names))
+
+    def listdir(self):
+        """
+        Returns the (subdirectories, files) directly inside this directory, like `Directory.listdir` - so that
+        `RuleEngine` rules can check index entries, too.
+        """
+
+        return list(self.directories), [*self.files, *(track.name for track in self.tracks)]
+
+    def walk(self):
+        """
+        Yields this directory and every directory beneath it (top-down).
+        """
+
+        stack = [self]
+
+        while stack:
+            directory = stack.pop()
+            yield directory
+            stack.extend(reversed(list(directory.directories.values())))
+
+    def __getstate__(self):
+        return self.name, self.parent, self.directories, self.files, self.tracks
+
+    def __setstate__(self, state):
+        self.name, self.parent, self.directories, self.files, self.tracks = state
+
+
+class LibraryIndex:
+    """
+    A compact, in-memory index of one or more library trees: directory names (interned, in a prefix tree), file names
+    and, for every track, its size, mtime and artist/album/recording date - nothing else. Small enough to keep a
+    million-track library around in a long-running process, and to save/load as a whole.
+    """
+
+    def __init__(self):
+        self.roots = {}  # root path -> IndexDirectory
+
+    def add(self, path, snapshot, catalog=None, tag_extractor=None, read_tags=True):
+        """
+        Indexes the tree beneath `path` (re-indexing it if it was already indexed).
+
+        :param snapshot: The `LibrarySnapshot` to read the tree from.
+        :param catalog: An optional `Catalog` (so that unchanged tracks' tags needn't be parsed again).
+        :param tag_extractor: An optional `TagExtractor` to read tags with.
+        :param read_tags: Whether to read tracks' tags at all (otherwise only their names, sizes and mtimes are known).
+        """
+
+        path = os.path.normpath(path)
+
+        with metrics.phase("indexing"):
+            root = IndexDirectory(sys.intern(path))
+            self.roots[path] = root
+
+            self.add_directory(root, snapshot.get(path), catalog, tag_extractor, read_tags)
+
+        return root
+
+    def add_directory(self, directory, snapshot_directory, catalog, tag_extractor, read_tags):
+        path = directory.path
+
+        files, tracks = [], []
+
+        for name in sorted(snapshot_directory.files):
+            track_type = Track.get_track_type(name)
+
+            if track_type is None:
+                files.append(sys.intern(name))
+                continue
+
+            size, mtime = snapshot_directory.files[name]
+            tracks.append(track_type(os.path.join(path, name), catalog=catalog, stat=(size, mtime)))
+
+        if read_tags and tracks:
+            if tag_extractor:
+                tag_extractor.extract(tracks)
+
+            directory.tracks = tuple(
+                IndexTrack(
+                    sys.intern(track.basename), track.stat[0], track.stat[1], LibraryIndex.intern(track.artist),
+                    LibraryIndex.intern(track.album), LibraryIndex.intern(track.recording_date)
+                )
+                for track in tracks
+            )
+        else:
+            directory.tracks = tuple(IndexTrack(sys.intern(track.basename), *track.stat) for track in tracks)
+
+        directory.files = tuple(files)
+
+        for name, snapshot_subdirectory in sorted(snapshot_directory.directories.items()):
+            subdirectory = IndexDirectory(sys.intern(name), directory)
+            directory.directories[subdirectory.name] = subdirectory
+
+            self.add_directory(subdirectory, snapshot_subdirectory, catalog, tag_extractor, read_tags)
+
+    @staticmethod
+    def intern(value):
+        return sys.intern(value) if value else value
+
+    def find(self, path):
+        """
+        Returns the IndexDirectory at `path`, or None if it isn't indexed.
+        """
+
+        path = os.path.normpath(path)
+
+        for root_path, root in self.roots.items():
+            if path == root_path:
+                return root
+
+            if path.startswith(root_path.rstrip(os.sep) + os.sep):
+                directory = root
+
+                for name in path[len(root_path):].strip(os.sep).split(os.sep):
+                    directory = directory.directories.get(name)
+
+                    if directory is None:
+                        return None
+
+                return directory
+
+        return None
+
+    def iter_tracks(self, path=None):
+        """
+        Yields (directory, track) for every indexed track (beneath `path`, if given).
+        """
+
+        roots = [self.find(path)] if path else list(self.roots.values())
+
+        for root in roots:
+            for directory in root.walk() if root else []:
+                for track in directory.tracks:
+                    yield directory, track
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.roots, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        index = LibraryIndex()
+
+        with open(path, "rb") as f:
+            index.roots = pickle.load(f)
+
+        # interning doesn't survive pickling
+        for root in index.roots.values():
+            for directory in root.walk():
+                directory.name = sys.intern(directory.name)
+
+                for track in directory.tracks:
+                    track.artist = LibraryIndex.intern(track.artist)
+                    track.album = LibraryIndex.intern(track.album)
+                    track.recording_date = LibraryIndex.intern(track.recording_date)
+
+        return index
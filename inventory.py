@@ -0,0 +1,162 @@
+import os
+import gzip
+import json
+
+from metrics import metrics
+
+
+class Inventory:
+    """
+    An incrementally updated inventory of the artists and albums directories.
+
+    The last run's listing is kept in a state file (alongside each artist directory's mtime and each album directory's
+    inode). An artist directory is only listed again if its mtime has changed - i.e. if an album was added to, removed
+    from or renamed within it - so an hourly run over an unchanged library costs one listing of each top-level directory
+    plus a stat per artist.
+
+    The inventory is written as NDJSON (one album per line, optionally gzip-compressed), along with a diff of the albums
+    that were added, removed or renamed/moved since the last run (renames are told apart from removals by inode).
+    """
+
+    STATE = "inventory.state.json"
+
+    def __init__(self, inventory_path, compress=False):
+        """
+        :param inventory_path: The directory to write the inventory (and keep its state) in.
+        :param compress: Whether to gzip the inventory and diff.
+        """
+
+        self.inventory_path = inventory_path
+        self.compress = compress
+
+    @property
+    def state_path(self):
+        return os.path.join(self.inventory_path, Inventory.STATE)
+
+    def get_output_path(self, name):
+        return os.path.join(self.inventory_path, f"{name}.ndjson" + (".gz" if self.compress else ""))
+
+    def load_state(self):
+        if not os.path.isfile(self.state_path):
+            return {"artists": {}, "albums": {"mtime": None, "albums": {}}}
+
+        with open(self.state_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        # written to the side and swapped in, so that an interrupted run leaves the last state intact
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def update(self, artists_directory, albums_directory):
+        """
+        Brings the inventory up to date, and writes it (and the diff) out.
+
+        :return: The list of changes since the last run.
+        """
+
+        previous = self.load_state()
+
+        with metrics.phase("inventory_scan"):
+            state = {
+                "artists": self.scan_artists(artists_directory, previous["artists"]),
+                "albums": self.scan_directory(albums_directory, previous["albums"])
+            }
+
+        changes = Inventory.diff(previous, state)
+
+        self.write("inventory", Inventory.iter_records(state))
+        self.write("inventory-diff", changes)
+        self.save_state(state)
+
+        return changes
+
+    def scan_artists(self, artists_directory, previous):
+        artists = {}
+
+        with os.scandir(artists_directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    artists[entry.name] = self.scan_directory(entry.path, previous.get(entry.name))
+
+        return artists
+
+    @staticmethod
+    def scan_directory(path, previous=None):
+        """
+        Returns {"mtime", "albums": {name: inode}} for a directory, reusing `previous` if the directory's mtime hasn't
+        changed.
+        """
+
+        mtime = os.stat(path).st_mtime_ns
+
+        if previous and previous["mtime"] == mtime:
+            metrics.count("directories_skipped")
+            return previous
+
+        metrics.count("directories_visited")
+
+        with os.scandir(path) as entries:
+            return {"mtime": mtime, "albums": {e.name: e.inode() for e in entries if e.is_dir()}}
+
+    @staticmethod
+    def iter_albums(state):
+        """
+        Yields (record, inode) for every album in a state, where the record identifies the album.
+        """
+
+        for artist, directory in sorted(state["artists"].items()):
+            for album, inode in sorted(directory["albums"].items()):
+                yield {"directory": "artists", "artist": artist, "album": album}, inode
+
+        for album, inode in sorted(state["albums"]["albums"].items()):
+            yield {"directory": "albums", "album": album}, inode
+
+    @staticmethod
+    def iter_records(state):
+        for artist, directory in sorted(state["artists"].items()):
+            if not directory["albums"]:
+                yield {"directory": "artists", "artist": artist, "album": None}
+
+        yield from (record for record, inode in Inventory.iter_albums(state))
+
+    @staticmethod
+    def diff(previous, current):
+        """
+        Returns the albums "added", "removed" or "renamed" (within or across directories) between two states.
+        """
+
+        before = {tuple(record.values()): (record, inode) for record, inode in Inventory.iter_albums(previous)}
+        after = {tuple(record.values()): (record, inode) for record, inode in Inventory.iter_albums(current)}
+
+        inodes_before = {inode: record for k, (record, inode) in before.items() if inode and k not in after}
+        inodes_after = {inode for k, (record, inode) in after.items() if inode and k not in before}
+
+        changes = []
+
+        for k, (record, inode) in after.items():
+            if k in before:
+                continue
+
+            if inode in inodes_before:
+                changes.append({"change": "renamed", **record, "from": inodes_before[inode]})
+            else:
+                changes.append({"change": "added", **record})
+
+        for k, (record, inode) in before.items():
+            if k not in after and not (inode and inode in inodes_after):
+                changes.append({"change": "removed", **record})
+
+        return changes
+
+    def write(self, name, records):
+        path = self.get_output_path(name)
+        opener = gzip.open if self.compress else open
+
+        with opener(path + ".tmp", "wt", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        os.replace(path + ".tmp", path)
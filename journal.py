@@ -0,0 +1,271 @@
+import os
+import json
+import shutil
+
+from transport import MigrationTransport
+
+
+class MigrationJournal:
+    """
+    A write-ahead journal for staging/unstaging. Every album move is written down (and fsync'ed) before it starts and
+    after it finishes, so that an interrupted migration can be resumed - without rescanning or re-reading tags - and
+    any half-copied album rolled back.
+
+    The journal is a file of JSON lines:
+
+        {"event": "start", "command": "stage"}
+        {"event": "pending", "source": "...", "target": "..."}   (one per album, written up front)
+        {"event": "moving", "source": "...", "target": "..."}
+        {"event": "copied", "source": "...", "target": "..."}    (cross-device moves only: the copy is verified)
+        {"event": "done", "source": "...", "target": "..."}      (or "failed", if the move raised)
+
+    It's removed once a migration completes - but kept if any move failed, so that the next run of the same command
+    can retry them. While a journal is kept, no other migration may start.
+    """
+
+    FLAGS = {"stage": "-s", "unstage": "-u"}
+
+    def __init__(self, path, transport=None):
+        """
+        :param path: Where to keep the journal.
+        :param transport: The `MigrationTransport` that actually moves albums.
+        """
+
+        self.path = path
+        self.transport = transport or MigrationTransport()
+        self.file = None
+
+    def load(self):
+        """
+        Returns the journal's entries (ignoring a final line that was only partially written).
+        """
+
+        if not os.path.isfile(self.path):
+            return []
+
+        entries = []
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+
+        return entries
+
+    def begin(self, command, moves):
+        """
+        Starts a new journal for `command`, listing every (source, target) move it's about to make.
+
+        :return: False (and nothing is started) if another migration's journal is still unfinished.
+        """
+
+        self.close()
+
+        if not self.can_begin():
+            return False
+
+        self.file = open(self.path, "w", encoding="utf-8")
+
+        self.write({"event": "start", "command": command})
+
+        for source, target in moves:
+            self.write({"event": "pending", "source": source, "target": target}, sync=False)
+
+        self.sync()
+
+        return True
+
+    def can_begin(self):
+        """
+        Whether a new migration may start - i.e. there's no unfinished (or failed) one journaled.
+        """
+
+        entries = self.load()
+
+        if not entries:
+            return True
+
+        unfinished = entries[0].get("command")
+
+        print(f"ERROR: an unfinished '{unfinished}' migration is journaled in '{self.path}'.")
+        print(f"ERROR: Run `lydia.py {MigrationJournal.FLAGS.get(unfinished, '')}` to finish it before starting "
+              "another.")
+
+        return False
+
+    def get_unfinished(self, command):
+        """
+        Returns the (source, target) moves that an interrupted run of `command` never completed (or that failed) - or
+        None if there was no interrupted run of it.
+        """
+
+        entries = self.load()
+
+        if not entries or entries[0] != {"event": "start", "command": command}:
+            return None
+
+        done = {(e["source"], e["target"]) for e in entries if e["event"] == "done"}
+
+        return [(e["source"], e["target"]) for e in entries if e["event"] == "pending" and (e["source"], e["target"])
+                not in done]
+
+    def resume(self, command, catalog=None, verbose=True):
+        """
+        Finishes (or rolls back) whichever move was in flight when `command` was interrupted, then carries out the
+        moves it never got to.
+
+        :param catalog: An optional `Catalog` to keep up to date.
+        :return: False if there was nothing to resume.
+        """
+
+        moves = self.get_unfinished(command)
+
+        if moves is None:
+            return False
+
+        print(f"INFO: Resuming an interrupted migration ({len(moves)} albums remaining)...")
+
+        entries = self.load()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+        for source, target in moves:
+            events = []
+
+            for e in entries:
+                if e.get("source") == source and e.get("target") == target:
+                    # a failed attempt was already cleaned up after by the transport; only the latest one matters
+                    events = [] if e["event"] == "failed" else events + [e["event"]]
+
+            if "moving" in events and not self.recover(source, target, "copied" in events, verbose):
+                if catalog:
+                    catalog.relocate(source, target)
+
+                continue
+
+            if not os.path.exists(source):
+                print(f"WARNING: '{source}' no longer exists; skipping it.")
+                continue
+
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                self.move(source, target)
+
+                if catalog:
+                    catalog.relocate(source, target)
+
+                if verbose:
+                    print(f"INFO: Succesfully moved '{source}' to '{target}'.")
+
+            except Exception as e:
+                print(f"ERROR: failed to move {source}.")
+                print(e)
+
+        self.finish()
+
+        return True
+
+    def recover(self, source, target, copied, verbose=True):
+        """
+        Deals with a move that was interrupted part-way through.
+
+        :param copied: Whether the move's (cross-device) copy had already been verified.
+        :return: True if the move still needs to be carried out.
+        """
+
+        if copied or not os.path.exists(source):
+            # the album is safely at its target; at most, the source still needs cleaning up
+            if os.path.exists(source):
+                shutil.rmtree(source)
+
+            self.write({"event": "done", "source": source, "target": target})
+
+            if verbose:
+                print(f"INFO: Finished moving '{source}' to '{target}'.")
+
+            return False
+
+        if os.path.exists(target):
+            shutil.rmtree(target)
+
+            if verbose:
+                print(f"INFO: Rolled back a partial copy of '{source}' at '{target}'.")
+
+        return True
+
+    def move(self, source, destination):
+        """
+        Moves `source` to (or into) `destination` with the transport, journaling each step.
+        """
+
+        target = os.path.join(destination, os.path.basename(source)) if os.path.isdir(destination) else destination
+        entry = {"source": source, "target": target}
+
+        # a target that exists before the move starts must never be mistaken for a partial copy when recovering
+        if os.path.lexists(target):
+            self.write({"event": "failed", **entry})
+            raise FileExistsError(f"'{target}' already exists.")
+
+        self.write({"event": "moving", **entry})
+
+        try:
+            target = self.transport.move(source, target, on_copied=lambda: self.write({"event": "copied", **entry}))
+        except Exception:
+            self.write({"event": "failed", **entry})  # the transport has already cleaned up after itself
+            raise
+
+        self.write({"event": "done", **entry})
+
+        return target
+
+    def write(self, entry, sync=True):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+
+        self.file.write(json.dumps(entry) + "\n")
+
+        if sync:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def finish(self):
+        """
+        Removes the journal once a migration has completed - unless any of its moves failed.
+
+        :return: Whether the journal was removed.
+        """
+
+        self.close()
+
+        failed = self.get_failed()
+
+        if failed:
+            print(f"WARNING: {len(failed)} moves failed; keeping '{self.path}' so that they can be retried.")
+            return False
+
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+        return True
+
+    def get_failed(self):
+        """
+        Returns the (source, target) moves whose last attempt failed.
+        """
+
+        last = {}
+
+        for e in self.load():
+            if "source" in e:
+                last[(e["source"], e["target"])] = e["event"]
+
+        return [move for move, event in last.items() if event == "failed"]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
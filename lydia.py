@@ -1,7 +1,26 @@
 import argparse
+import cProfile
 import json
+import socket
 
 from models import *
+from catalog import Catalog
+from snapshot import LibrarySnapshot
+from workers import TagExtractor
+from metrics import metrics
+from watch import AlbumWatcher
+from plan import Plan
+from transport import LinkTransport, MigrationTransport
+from prune import Pruner
+from rules import ARTIST_RULES, RuleEngine
+from journal import MigrationJournal
+from retag import Retagger
+from index import LibraryIndex
+from scanner import AsyncScanner
+from duplicates import DuplicateFinder
+from covers import CoverCache
+from inventory import Inventory
+from query import QueryIndex
 
 
 class ArgumentParser:
@@ -27,15 +46,163 @@ class ArgumentParser:
 
         self.parser.add_argument("-i", "--inventory", dest="inventory", action="store_true")
 
+        self.parser.add_argument(
+            "--incremental", dest="incremental", action="store_true",
+            help="With `--inventory`, only re-lists artist directories that changed since the last run, and writes "
+                 "`inventory.ndjson` plus an `inventory-diff.ndjson` of added/removed/renamed albums."
+        )
+
+        self.parser.add_argument(
+            "--gzip", dest="gzip", action="store_true", help="Gzips the `--incremental` inventory and diff."
+        )
+
         self.parser.add_argument("-f", "--force", dest="force", action="store_true")
 
+        self.parser.add_argument(
+            "--prune", dest="prune", action="store_true",
+            help="Removes empty folders, and album/artist folders without any .mp3s or .flacs, from the artists and "
+                 "albums directories (as `album_validation_behavior` says)."
+        )
+
+        self.parser.add_argument(
+            "--index-out", dest="index_out",
+            help="Writes a compact index of the artists/albums directories (names, sizes and tags) to this file."
+        )
+
+        self.parser.add_argument(
+            "--index", dest="index",
+            help="Runs `--inventory` and `--query` against an index written by `--index-out`, not the disk."
+        )
+
+        self.parser.add_argument(
+            "--retag", dest="retag",
+            help="Retags albums from a JSON/CSV mapping of directory -> artist/album/year, rewriting only the files "
+                 "whose tags differ."
+        )
+
+        self.parser.add_argument(
+            "--dry-run", dest="dry_run", action="store_true", help="With `--retag`, only reports what would change."
+        )
+
+        self.parser.add_argument(
+            "--plan-out", dest="plan_out",
+            help="Writes the operations that cleaning/staging/unstaging would perform to this JSON file, without "
+                 "performing them."
+        )
+
+        self.parser.add_argument(
+            "--batch", dest="batch", action="store_true",
+            help="Plans every operation first, checks the plan for conflicts, then applies it in one batched pass."
+        )
+
+        self.parser.add_argument("--apply-plan", dest="apply_plan", help="Applies a plan written by `--plan-out`.")
+
+        self.parser.add_argument(
+            "-w", "--watch", dest="watch", action="store_true",
+            help="Watches the albums/artists directories, and validates/cleans albums as soon as they change."
+        )
+
+        self.parser.add_argument(
+            "--watch-migrate", dest="watch_migrate", action="store_true",
+            help="While watching, also migrates settled albums from the albums directory to the artists directory."
+        )
+
+        self.parser.add_argument(
+            "--debounce", dest="debounce", type=float, default=10.0,
+            help="While watching, the number of quiet seconds to wait for before handling a changed album."
+        )
+
+        self.parser.add_argument(
+            "-j", "--jobs", dest="jobs", type=int, default=1, help="The number of workers used to read tags."
+        )
+
+        self.parser.add_argument(
+            "--pool", dest="pool", choices=["thread", "process"], default="thread",
+            help="Read tags with threads (I/O-bound, e.g. network mounts) or processes (CPU-bound)."
+        )
+
+        self.parser.add_argument(
+            "--tag-backend", dest="tag_backend", choices=["native", "eyed3"], default="native",
+            help="Read ID3 tags with lydia's own minimal reader (falling back to eyed3 when needed), or always with "
+                 "eyed3."
+        )
+
+        self.parser.add_argument(
+            "--link", dest="link", choices=LinkTransport.LINK_TYPES,
+            help="With `-s`, stages albums as trees of hardlinks/reflinks (falling back to symlinks) instead of moving "
+                 "them; `-u` then just deletes the links."
+        )
+
+        self.parser.add_argument(
+            "--copy-jobs", dest="copy_jobs", type=int, default=4,
+            help="When staging/unstaging across file systems, the number of files to copy concurrently."
+        )
+
+        self.parser.add_argument(
+            "--verify", dest="verify", choices=["size", "hash"], default="size",
+            help="When staging/unstaging across file systems, how copied files are verified before their originals "
+                 "are removed."
+        )
+
+        self.parser.add_argument(
+            "--query", dest="query",
+            help="Lists the albums matching a query, e.g. `artist:\"joy division\" year:1979-1982` or `error:any` "
+                 "(see `query.py`)."
+        )
+
+        self.parser.add_argument(
+            "--query-index", dest="query_index",
+            help="With `--query`, answers from the query index saved in this file (building and saving it first if "
+                 "it doesn't exist yet)."
+        )
+
+        self.parser.add_argument(
+            "--find-duplicates", dest="find_duplicates", action="store_true",
+            help="Reports albums that exist more than once across the artists and albums directories (comparing their "
+                 "tracks' audio, not their names or tags)."
+        )
+
+        self.parser.add_argument(
+            "--extract-covers", dest="extract_covers", action="store_true",
+            help="Extracts one cover per album (from its tracks' embedded art) into `covers_directory`, where each "
+                 "distinct image is only stored once."
+        )
+
+        self.parser.add_argument(
+            "--async-scan", dest="async_scan", action="store_true",
+            help="Scans the configured directories (and reads the first track's tags in each) with many file system "
+                 "calls in flight at once, before running any command. Suits high-latency network shares."
+        )
+
+        self.parser.add_argument(
+            "--concurrency", dest="concurrency", type=int, default=32,
+            help="With `--async-scan`, the maximum number of file system calls in flight at once."
+        )
+
+        self.parser.add_argument(
+            "--serve", dest="serve", action="store_true",
+            help="Keeps the library warm in memory and serves commands from `client.py` over `socket_path` (see "
+                 "`config.json`) until shut down."
+        )
+
+        self.parser.add_argument(
+            "--port", dest="port", type=int, help="With `--serve`, listens on localhost:PORT instead of a Unix socket."
+        )
+
+        self.parser.add_argument(
+            "--metrics-out", dest="metrics_out",
+            help="Writes per-phase timings and counters (directories visited, tags parsed, etc.) to this JSON file."
+        )
+
+        self.parser.add_argument("--profile", dest="profile", help="Writes a cProfile dump of the run to this file.")
+
     def parse_and_sanitize_args(self):
 
         config = LydiaConfig()
 
         args = self.parser.parse_args()
 
-        if args.clean_albums:
+        if args.clean_albums or args.prune:
             if not config.albums_directory:
                 print("ERROR: An albums directory must be specified in lydia's `config.json` file..")
                 exit(1)
@@ -49,99 +216,449 @@ class ArgumentParser:
                 print("ERROR: Album validation behavior must be specified in lydia's `config.json` file.")
                 exit(1)
 
-        if args.clean_artists:
+        if args.clean_artists or args.prune:
             if not config.artists_directory:
                 print("ERROR: An artists directory must be specified in lydia's `config.json` file..")
                 exit(1)
 
+        if args.watch:
+            if not config.albums_directory or not config.artists_directory:
+                print("ERROR: Albums and artists directories must be specified in lydia's `config.json` file.")
+                exit(1)
+
+        if args.query:
+            if not args.query_index and (not config.albums_directory or not config.artists_directory):
+                print("ERROR: Albums and artists directories must be specified in lydia's `config.json` file.")
+                exit(1)
+
+            try:
+                QueryIndex.parse(args.query)
+            except ValueError as e:
+                print(f"ERROR: `--query` is not a valid query: {e}")
+                exit(1)
+
+        if args.find_duplicates:
+            if not config.albums_directory or not config.artists_directory:
+                print("ERROR: Albums and artists directories must be specified in lydia's `config.json` file.")
+                exit(1)
+
+        if args.extract_covers:
+            if not config.covers_directory:
+                print("ERROR: A covers directory must be specified in lydia's `config.json` file.")
+                exit(1)
+
+            if not config.albums_directory and not config.artists_directory:
+                print("ERROR: An albums or artists directory must be specified in lydia's `config.json` file.")
+                exit(1)
+
         if args.stage or args.unstage:
             if not config.staging_directory:
                 print("ERROR: A staging directory must be specified in lydia's `config.json` file.")
                 exit(1)
 
+        if args.link and (args.plan_out or args.batch):
+            print("ERROR: `--link` can't be planned; stage with links without `--plan-out`/`--batch`.")
+            exit(1)
+
+        if args.serve and not args.port and not config.socket_path:
+            print("ERROR: A socket path must be specified in lydia's `config.json` file (or a `--port` given).")
+            exit(1)
+
+        if args.serve and args.port and not config.server_token:
+            print("ERROR: A server token must be specified in lydia's `config.json` file to serve on a `--port`.")
+            exit(1)
+
+        if args.serve and not args.port and not hasattr(socket, "AF_UNIX"):
+            print("ERROR: Unix sockets aren't supported on this platform; serve on a `--port` instead.")
+            exit(1)
+
+        if args.jobs < 1:
+            print("ERROR: `--jobs` must be at least 1.")
+            exit(1)
+
+        if args.copy_jobs < 1:
+            print("ERROR: `--copy-jobs` must be at least 1.")
+            exit(1)
+
+        if args.concurrency < 1:
+            print("ERROR: `--concurrency` must be at least 1.")
+            exit(1)
+
         if args.inventory:
             if not config.inventory_path:
                 print("ERROR: An inventory path must be specified in lydia's `config.json` file.")
                 exit(1)
 
+            if args.incremental and (not config.albums_directory or not config.artists_directory):
+                print("ERROR: Albums and artists directories must be specified in lydia's `config.json` file.")
+                exit(1)
+
         return args
 
 
 class Lydia:
-    def __init__(self):
-        self.config = LydiaConfig()
+    def __init__(self, jobs=1, pool="thread", config=None, copy_jobs=4, verify="size", tag_backend="native"):
+        Mp3.tag_backend = tag_backend
+
+        self.config = config or LydiaConfig()
+        self.catalog = Catalog(self.config.catalog_path) if self.config.catalog_path else None
+        self.tag_extractor = TagExtractor(jobs=jobs, pool=pool)
+        self.transport = MigrationTransport(jobs=copy_jobs, verify=verify)
+
+        self.index = None
+        self.journal = None
+
+        if self.config.journal_path:
+            self.journal = MigrationJournal(self.config.journal_path, transport=self.transport)
+
+        # one snapshot per run, shared by every command (each directory is scanned the first time it's needed)
+        self.snapshot = LibrarySnapshot()
 
     def init(self, args):
 
+        metrics.enabled = args.metrics_out is not None
+        profiler = cProfile.Profile() if args.profile else None
+        # a plan that's only written out is reviewed before it's applied; one that's applied straight away isn't
+        plan = Plan(prompts="queue" if args.plan_out else "ask") if args.plan_out or args.batch else None
+
+        if profiler:
+            profiler.enable()
+
+        if args.async_scan:
+            self.scan(concurrency=args.concurrency)
+
         if args.clean_artists:
-            self.clean_artists_directory(args.force)
+            with metrics.phase("clean_artists_directory"):
+                self.clean_artists_directory(args.force, plan=plan)
 
         if args.clean_albums:
-            self.clean_albums_directory()
+            with metrics.phase("clean_albums_directory"):
+                self.clean_albums_directory(plan=plan)
 
-        if args.stage:
-            self.migrate_albums_to_staging_directory()
+        if args.prune:
+            with metrics.phase("prune"):
+                self.prune(plan=plan)
+
+        if args.stage and args.link:
+            with metrics.phase("link_albums_to_staging_directory"):
+                self.link_albums_to_staging_directory(link_type=args.link)
+
+        elif args.stage:
+            with metrics.phase("migrate_albums_to_staging_directory"):
+                self.migrate_albums_to_staging_directory(plan=plan)
 
         if args.unstage:
-            self.migrate_staging_to_albums_directory()
+            with metrics.phase("migrate_staging_to_albums_directory"):
+                self.migrate_staging_to_albums_directory(plan=plan)
 
-        if args.inventory:
-            self.create_inventory()
+        if plan is not None and args.plan_out:
+            for conflict in plan.find_conflicts():
+                print(f"WARNING: {conflict}")
+
+            plan.save(args.plan_out)
+            print(f"INFO: Wrote {len(plan.operations)} planned operations to '{args.plan_out}'.")
+
+        elif plan is not None:
+            with metrics.phase("apply_plan"):
+                self.apply_plan(plan)
+
+        if args.apply_plan:
+            with metrics.phase("apply_plan"):
+                self.apply_plan(Plan.load(args.apply_plan))
+
+        if args.retag:
+            with metrics.phase("retag"):
+                self.retag(args.retag, dry_run=args.dry_run)
+
+        if args.index:
+            self.index = LibraryIndex.load(args.index)
+
+        if args.index_out:
+            self.build_index().save(args.index_out)
+            print(f"INFO: Wrote an index of {sum(1 for t in self.index.iter_tracks())} tracks to '{args.index_out}'.")
+
+        if args.query:
+            self.query(args.query, index_path=args.query_index)
+
+        if args.find_duplicates:
+            self.find_duplicates()
+
+        if args.extract_covers:
+            with metrics.phase("extract_covers"):
+                self.extract_covers()
+
+        if args.inventory and args.incremental:
+            with metrics.phase("update_inventory"):
+                self.update_inventory(compress=args.gzip)
+
+        elif args.inventory:
+            with metrics.phase("create_inventory"):
+                self.create_inventory()
+
+        if args.watch:
+            self.watch(debounce=args.debounce, migrate=args.watch_migrate, force=args.force)
+
+        if args.serve:
+            from server import LydiaServer  # only imported to serve, so that lydia runs without Unix sockets
+
+            try:
+                server = LydiaServer(
+                    self, ("127.0.0.1", args.port) if args.port else self.config.socket_path,
+                    token=self.config.server_token
+                )
+            except (OSError, ValueError) as e:
+                print(f"ERROR: could not serve: {e}")
+                exit(1)
+
+            server.serve_forever()
+
+        if self.catalog:
+            self.catalog.close()
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        if args.metrics_out:
+            metrics.write(args.metrics_out)
+
+    def scan(self, concurrency=32, file_system=None):
+        """
+        Scans every configured directory into this run's snapshot with an `AsyncScanner`, so that no command has to
+        list a directory (or read an album's first track) one call at a time.
+
+        :param concurrency: The maximum number of file system calls in flight at once.
+        :param file_system: An optional `scanner.FileSystem` to scan through.
+        """
+
+        directories = [
+            d for d in (self.config.artists_directory, self.config.albums_directory, self.config.staging_directory)
+            if d and os.path.isdir(d)
+        ]
+
+        print(f"INFO: Scanning {', '.join(directories)}...")
+
+        AsyncScanner(file_system=file_system, concurrency=concurrency, catalog=self.catalog).scan(
+            self.snapshot, *directories
+        )
+
+    def apply_plan(self, plan):
+        """
+        Applies a plan in one batched pass - unless it has conflicts, in which case nothing is done at all.
+        """
+
+        conflicts = plan.find_conflicts()
+
+        if conflicts:
+            for conflict in conflicts:
+                print(f"ERROR: {conflict}")
+
+            print(f"ERROR: Refusing to apply a plan with {len(conflicts)} conflicts.")
+            return False
+
+        print(f"Applying {len(plan.operations)} planned operations...")
+
+        succeeded = plan.apply(jobs=self.tag_extractor.jobs, catalog=self.catalog, transport=self.transport)
+
+        if succeeded:
+            # the snapshot already holds the planned layout; it's now what's on disk, too
+            self.snapshot.settle()
+            print("Successfully applied the plan.")
+        else:
+            # some of the plan was carried out and some wasn't, so the snapshot can't be trusted; it's re-read on demand
+            self.snapshot.roots.clear()
+
+        return succeeded
+
+    def iter_artists(self, validate=True):
+        """
+        Yields each artist directory in the artists directory, one at a time. Their albums aren't read; iterate them
+        with `iter_albums`.
+        """
+
+        for artist_name in self.snapshot.listdir(self.config.artists_directory)[0]:
+            yield ArtistDirectory(
+                os.path.join(self.config.artists_directory, artist_name), validate=validate, catalog=self.catalog,
+                snapshot=self.snapshot, parse_albums=False
+            )
+
+    def iter_albums(self, artist=None, validate=True, parse_mp3s=True):
+        """
+        Yields each album directory of an `ArtistDirectory` (or, by default, of the albums directory), one at a time.
+        """
+
+        if artist is not None:
+            yield from artist.iter_album_directories(validate=validate, parse_mp3s=parse_mp3s)
+            return
+
+        for album_name in self.snapshot.listdir(self.config.albums_directory)[0]:
+            yield AlbumDirectory(
+                os.path.join(self.config.albums_directory, album_name), validate=validate, parse_mp3s=parse_mp3s,
+                catalog=self.catalog, snapshot=self.snapshot
+            )
 
-    def clean_artists_directory(self, force):
+    def iter_artist_directory_paths(self, artists_directory, batch_size=100):
         """
-        Validates/cleans each folder in the artists directory, then validates artists' album directories.
+        Yields the (path, artist directory within `artists_directory` - or None if its artist can't be determined) of
+        each album in the albums directory. Only the first track of each album is ever used to infer its artist; those
+        are read `batch_size` albums at a time, and no album is kept past its batch.
+        """
+
+        albums = []
+
+        for album in self.iter_albums():
+            albums.append(album)
+
+            if len(albums) == batch_size:
+                yield from self.get_artist_directory_paths(albums, artists_directory)
+                albums = []
+
+        yield from self.get_artist_directory_paths(albums, artists_directory)
+
+    def get_artist_directory_paths(self, albums, artists_directory):
+        self.tag_extractor.extract([album.tracks[0] for album in albums if album.tracks])
+
+        return [(album.path, album.get_artist_directory_path(artists_directory)) for album in albums]
+
+    def iter_tracks(self, album):
+        """
+        Yields each track of an `AlbumDirectory`, one at a time (their tags are only read when needed).
+        """
+
+        yield from AlbumDirectory.iter_tracks(album.path, catalog=self.catalog, snapshot=self.snapshot)
+
+    def retag(self, mapping_path, dry_run=False):
+        """
+        Retags albums from a JSON/CSV mapping of directory -> artist/album/year (see `Retagger.load_mapping`).
+        """
+
+        print(f"Retagging albums from '{mapping_path}'...")
+
+        retagger = Retagger(jobs=self.tag_extractor.jobs, pool=self.tag_extractor.pool, dry_run=dry_run)
+
+        return retagger.retag(Retagger.load_mapping(mapping_path))
+
+    def clean_artists_directory(self, force, plan=None, batch_size=100):
+        """
+        Validates/cleans the folders in the artists directory, then their album directories (see `RuleEngine`) - in
+        batches of `batch_size` artists, so that only one batch's artists and albums are ever held at once. Changes set
+        to "prompt" are asked about once per rule and batch.
+
+        :param force: Whether to remove empty artist/album folders (otherwise, they're only warned about).
+        :param plan: If given, changes are added to this `Plan` rather than carried out.
+        :return: {rule name: the number of artists/albums fixed}.
         """
 
         artists_dir = self.config.artists_directory
 
         print(f"Cleaning '{artists_dir}'...\n")
 
-        artist_directories = [ArtistDirectory(os.path.join(artists_dir, a)) for a in os.listdir(artists_dir)]
+        fixed = {}
+        artists = []
 
-        for artist in artist_directories:
+        for artist in self.iter_artists(validate=False):
 
             if artist.basename.startswith("_"):
                 print(f"Skipped {artist.basename}.")
                 continue
 
-            if not artist.validator.is_valid:
-                artist.clean(force=force)
+            artists.append(artist)
+
+            if len(artists) == batch_size:
+                self.clean_artists(artists, force, fixed, plan=plan)
+                artists = []
 
-            for album in artist.album_directories:
+        if artists:
+            self.clean_artists(artists, force, fixed, plan=plan)
+
+        print(f"Successfully cleaned {artists_dir}.")
+
+        return fixed
+
+    def clean_artists(self, artists, force, fixed, plan=None):
+        """
+        Cleans a batch of artist directories as `ARTIST_RULES` say, then all of their albums as `ALBUM_RULES` say.
+
+        :param fixed: {rule name: the number of artists/albums fixed}, which this batch's fixes are added to.
+        """
+
+        behavior = self.config.album_validation_behavior
+        overrides = {"empty": "force" if force else "warn"}
+
+        results = [RuleEngine(behavior, rules=ARTIST_RULES, overrides=overrides).apply(artists, plan=plan)]
+
+        albums = []
+
+        # albums are listed from wherever their (possibly renamed) artists are now; deleted artists have no path
+        for artist in artists:
+            if artist.path is None:
+                continue
+
+            for album in self.iter_albums(artist, validate=False):
 
                 if album.basename.startswith("_"):
                     print(f"Skipped {album.basename}!")
                     continue
 
-                if not album.validator.is_valid:
-                    album.clean(force=force)
+                albums.append(album)
 
-        print(f"Successfully cleaned {artists_dir}.")
+        results.append(RuleEngine(behavior, overrides=overrides).apply(albums, plan=plan))
 
-    def clean_albums_directory(self):
+        for result in results:
+            for rule, count in result.items():
+                fixed[rule] = fixed.get(rule, 0) + count
+
+    def clean_albums_directory(self, plan=None):
         """
-        Validates/sanitizes each folder in the albums directory, then moves albums to the archival directory.
+        Validates/sanitizes every folder in the albums directory at once, as `album_validation_behavior` says (see
+        `RuleEngine`).
+
+        :param plan: If given, changes are added to this `Plan` rather than carried out.
+        :return: {rule name: the number of albums fixed}.
         """
 
         albums_dir = self.config.albums_directory
 
         print(f"Cleaning {albums_dir}...")
 
-        for album_name in os.listdir(albums_dir):
-            album = AlbumDirectory(os.path.join(albums_dir, album_name))
+        albums = []
+
+        for album in self.iter_albums(validate=False):
 
             if album.basename.startswith("_"):
                 print(f"Skipped {album.basename} due to leading underscores in album name...")
                 continue
 
-            album.clean()
+            albums.append(album)
+
+        fixed = RuleEngine(self.config.album_validation_behavior).apply(albums, plan=plan)
 
         print(f"Successfully cleaned {albums_dir}.")
 
-    def migrate_albums_to_staging_directory(self):
+        return fixed
+
+    def prune(self, plan=None):
+        """
+        Removes empty and audioless folders from the artists and albums directories, in one pass (see `Pruner`).
+
+        :param plan: If given, removals are added to this `Plan` rather than carried out.
+        :return: The paths of the removed folders.
+        """
+
+        behavior = self.config.album_validation_behavior
+
+        pruner = Pruner(
+            self.snapshot, catalog=self.catalog, empty=behavior["remove_empty_folders"],
+            audioless=behavior["remove_folders_with_no_mp3s_or_flacs"]
+        )
+
+        return pruner.prune([(self.config.artists_directory, 2), (self.config.albums_directory, 1)], plan=plan)
+
+    def migrate_albums_to_staging_directory(self, plan=None):
         """
         Creates artist directories in the staging directory, and migrates albums into them from the albums directory.
+
+        :param plan: If given, changes are added to this `Plan` rather than carried out.
         """
 
         albums_dir = self.config.albums_directory
@@ -149,15 +666,43 @@ class Lydia:
 
         print(f"Migrating {albums_dir} to {staging_dir}...")
 
-        for album_name in os.listdir(albums_dir):
-            album = AlbumDirectory(os.path.join(albums_dir, album_name))
-            album.migrate(staging_dir)
+        journal = self.journal if plan is None else None
+
+        if journal and journal.resume("stage", catalog=self.catalog):
+            print(f"Successfully migrated {albums_dir} to {staging_dir}.")
+            return
+
+        # every album's target is journaled up front, so targets are worked out in a first pass (keeping just their
+        # paths), and albums are only read again, one at a time, to be moved
+        moves = []
+
+        for album_path, artist_directory_path in self.iter_artist_directory_paths(staging_dir):
+            if not artist_directory_path:
+                print(f"WARNING: could not migrate {os.path.basename(album_path)} - the artist name could not be "
+                      "determined from the contents of this directory.")
+                continue
+
+            moves.append((album_path, os.path.join(artist_directory_path, os.path.basename(album_path))))
+
+        if journal and not journal.begin("stage", moves):
+            return
+
+        for album_path, target in moves:
+            album = AlbumDirectory(
+                album_path, validate=False, parse_mp3s=False, catalog=self.catalog, snapshot=self.snapshot
+            )
+            album.migrate_to(os.path.dirname(target), plan=plan, transport=journal or self.transport)
+
+        if journal:
+            journal.finish()
 
         print(f"Successfully migrated {albums_dir} to {staging_dir}.")
 
-    def migrate_staging_to_albums_directory(self):
+    def migrate_staging_to_albums_directory(self, plan=None):
         """
         Moves all artists' albums in the staging directory back to the albums directory.
+
+        :param plan: If given, changes are added to this `Plan` rather than carried out.
         """
 
         albums_dir = self.config.albums_directory
@@ -165,46 +710,284 @@ class Lydia:
 
         print(f"Migrating {staging_dir} to {albums_dir}...")
 
-        for artist_dir in os.listdir(staging_dir):
-            for album_dir in os.listdir(os.path.join(staging_dir, artist_dir)):
-                album = AlbumDirectory(os.path.join(staging_dir, artist_dir, album_dir))
-                album.move(albums_dir)
+        journal = self.journal if plan is None else None
+
+        if journal and journal.resume("unstage", catalog=self.catalog):
+            print(f"Successfully migrated {staging_dir} to {albums_dir}.")
+            return
+
+        if journal and not journal.can_begin():
+            return
+
+        snapshot = self.snapshot
+
+        # albums that were only staged as links are simply unlinked; they never left the albums directory
+        linked_paths = self.unlink_staging_directory(plan=plan)
+
+        album_paths = [
+            os.path.join(staging_dir, artist_dir, album_dir)
+            for artist_dir in snapshot.listdir(staging_dir)[0]
+            for album_dir in snapshot.listdir(os.path.join(staging_dir, artist_dir))[0]
+            if os.path.join(staging_dir, artist_dir, album_dir) not in linked_paths
+        ]
+
+        if journal and not journal.begin(
+            "unstage", [(p, os.path.join(albums_dir, os.path.basename(p))) for p in album_paths]
+        ):
+            return
+
+        for album_path in album_paths:
+            album = AlbumDirectory(album_path, parse_mp3s=False, catalog=self.catalog, snapshot=snapshot)
+            album.move(albums_dir, plan=plan, transport=journal or self.transport)
+
+        if journal:
+            journal.finish()
 
         print(f"Successfully migrated {staging_dir} to {albums_dir}.")
 
+    def link_albums_to_staging_directory(self, link_type="hardlink"):
+        """
+        Mirrors the albums directory into the staging directory's artist directories as trees of links (see
+        `LinkTransport`), leaving every album where it is.
+        """
+
+        albums_dir = self.config.albums_directory
+        staging_dir = self.config.staging_directory
+
+        print(f"Linking {albums_dir} to {staging_dir}...")
+
+        transport = LinkTransport(link_type=link_type)
+        linked_paths = LinkTransport.load_manifest(staging_dir)
+
+        for album_path, artist_directory_path in self.iter_artist_directory_paths(staging_dir):
+            basename = os.path.basename(album_path)
+
+            if not artist_directory_path:
+                print(f"WARNING: could not link {basename} - the artist name could not be determined.")
+                continue
+
+            try:
+                transport.link_tree(album_path, os.path.join(artist_directory_path, basename))
+                linked_paths.append(os.path.join(artist_directory_path, basename))
+            except OSError as e:
+                print(f"ERROR: failed to link {album_path}.")
+                print(e)
+
+        LinkTransport.save_manifest(staging_dir, linked_paths)
+
+        # the staging directory is read again the next time it's needed
+        self.snapshot.remove(staging_dir)
+
+        print(f"Successfully linked {albums_dir} to {staging_dir} ({dict(transport.links)}).")
+
+    def unlink_staging_directory(self, plan=None):
+        """
+        Deletes the album link trees (and any artist directories left empty) that `link_albums_to_staging_directory`
+        created in the staging directory.
+
+        :param plan: If given, the deletes are added to this `Plan` rather than carried out.
+        :return: The paths of the link trees.
+        """
+
+        staging_dir = self.config.staging_directory
+        linked_paths = [p for p in LinkTransport.load_manifest(staging_dir) if os.path.isdir(p)]
+
+        for path in linked_paths:
+            Directory(path, catalog=self.catalog, snapshot=self.snapshot).delete(prompt=False, plan=plan)
+
+        if plan is None:
+            for artist_path in {os.path.dirname(p) for p in linked_paths}:
+                if os.path.isdir(artist_path) and not os.listdir(artist_path):
+                    os.rmdir(artist_path)
+                    self.snapshot.remove(artist_path)
+
+            LinkTransport.remove_manifest(staging_dir)
+
+        return set(linked_paths)
+
+    def watch(self, debounce=10.0, migrate=False, force=False):
+        """
+        Validates/cleans (and optionally migrates) albums as they arrive in (or change within) the albums and artists
+        directories, until interrupted.
+        """
+
+        AlbumWatcher(self.config, catalog=self.catalog, debounce=debounce, migrate=migrate, force=force).run()
+
+    def build_query_index(self):
+        """
+        Builds a `QueryIndex` of every album in the artists and albums directories - with the artists, titles and
+        years lydia infers for them, and the rules they (and, separately, their artist directories) break.
+
+        Albums are read from the (compact) `LibraryIndex` - the one loaded with `--index`, or one built first - rather
+        than as `AlbumDirectory`s.
+        """
+
+        artists_dir, albums_dir = self.config.artists_directory, self.config.albums_directory
+
+        if self.index is None or not self.index.find(artists_dir) or not self.index.find(albums_dir):
+            self.build_index()
+
+        index = QueryIndex()
+
+        album_rules = RuleEngine(self.config.album_validation_behavior)
+        artist_rules = RuleEngine(self.config.album_validation_behavior, rules=ARTIST_RULES)
+
+        with metrics.phase("query_indexing"):
+            for artist in self.index.find(artists_dir).directories.values():
+                artist_errors = [e.upper() for e in artist_rules.get_errors([artist])[0]]
+                albums = list(artist.directories.values())
+
+                for album, errors in zip(albums, album_rules.get_errors(albums)):
+                    track = album.tracks[0] if album.tracks else None
+
+                    index.add(
+                        album.path, "artists", artist.name, AlbumDirectory.infer_title_from(album.name, track),
+                        AlbumDirectory.infer_year_from(album.name, track), [e.upper() for e in errors], artist_errors
+                    )
+
+            albums = list(self.index.find(albums_dir).directories.values())
+
+            for album, errors in zip(albums, album_rules.get_errors(albums)):
+                track = album.tracks[0] if album.tracks else None
+
+                index.add(
+                    album.path, "albums", AlbumDirectory.infer_artist_from(album.name, track),
+                    AlbumDirectory.infer_title_from(album.name, track),
+                    AlbumDirectory.infer_year_from(album.name, track), [e.upper() for e in errors]
+                )
+
+        return index
+
+    def query(self, query, index_path=None):
+        """
+        Prints (and returns) the albums matching a query (see `QueryIndex`).
+
+        :param index_path: An optional file to load the query index from (or, if it doesn't exist, to save it to).
+        """
+
+        try:
+            QueryIndex.parse(query)
+        except ValueError as e:
+            print(f"ERROR: '{query}' is not a valid query: {e}")
+            return []
+
+        if index_path and os.path.isfile(index_path):
+            index = QueryIndex.load(index_path)
+        else:
+            index = self.build_query_index()
+
+            if index_path:
+                index.save(index_path)
+
+        albums = index.query(query)
+
+        for album in albums:
+            print(album)
+
+        print(f"INFO: {len(albums)} of {len(index.albums)} albums matched.")
+
+        return albums
+
+    def find_duplicates(self):
+        """
+        Reports albums that exist more than once across the artists and albums directories.
+
+        :return: The duplicate groups (see `DuplicateFinder.find`).
+        """
+
+        finder = DuplicateFinder(jobs=self.tag_extractor.jobs, pool=self.tag_extractor.pool)
+        return finder.find(self.snapshot, self.config.artists_directory, self.config.albums_directory)
+
+    def extract_covers(self):
+        """
+        Extracts every album's cover into the (content-addressed) cover cache; see `CoverCache`.
+
+        :return: The `CoverCache`.
+        """
+
+        print(f"INFO: Extracting covers into '{self.config.covers_directory}'...")
+
+        covers = CoverCache(self.config.covers_directory)
+        covers.update(self.snapshot, self.config.artists_directory, self.config.albums_directory)
+
+        return covers
+
+    def build_index(self, read_tags=True):
+        """
+        Indexes the artists and albums directories into a (compact, in-memory) `LibraryIndex`.
+        """
+
+        self.index = LibraryIndex()
+
+        for directory in (self.config.artists_directory, self.config.albums_directory):
+            print(f"INFO: Indexing '{directory}'...")
+            self.index.add(directory, self.snapshot, self.catalog, self.tag_extractor, read_tags=read_tags)
+
+        return self.index
+
     def create_inventory(self):
+        artists = self.index.find(self.config.artists_directory) if self.index else None
+        albums = self.index.find(self.config.albums_directory) if self.index else None
+
+        if artists and albums:
+            print("INFO: Creating inventory from the index ...")
+
+            self.write_inventory(
+                {name: list(artist.directories) for name, artist in artists.directories.items()},
+                list(albums.directories)
+            )
+            return
+
         print("INFO: Creating inventory from base artist directory ...")
 
         artist_inventory = {}
 
-        artist_dirs = [
-            ArtistDirectory(os.path.join(self.config.artists_directory, a), validate=False, parse_mp3s=False)
-            for a in os.listdir(self.config.artists_directory)
-        ]
-
-        for artist in artist_dirs:
+        for artist in self.iter_artists(validate=False):
             try:
-                artist_inventory[artist.basename] = [album.basename for album in artist.album_directories]
+                artist_inventory[artist.basename] = [
+                    album.basename for album in self.iter_albums(artist, validate=False, parse_mp3s=False)
+                ]
             except TypeError as e:
                 print(e)
 
-        with open(os.path.join(self.config.inventory_path, "artists.json"), 'w', encoding='utf-8') as f:
-            json.dump(artist_inventory, f, indent=4)
-
         print("INFO: Creating inventory from base albums directory ...")
         album_inventory = []
 
-        album_dirs = [
-            AlbumDirectory(os.path.join(self.config.albums_directory, a), validate=False)
-            for a in os.listdir(self.config.albums_directory)
-        ]
-
-        for album in album_dirs:
+        for album in self.iter_albums(validate=False, parse_mp3s=False):
             album_inventory.append(album.basename)
 
+        self.write_inventory(artist_inventory, album_inventory)
+
+    def update_inventory(self, compress=False):
+        """
+        Incrementally updates the inventory (see `Inventory`).
+
+        :param compress: Whether to gzip the inventory and diff.
+        :return: The albums added, removed or renamed since the last update.
+        """
+
+        print("INFO: Updating inventory ...")
+
+        changes = Inventory(self.config.inventory_path, compress=compress).update(
+            self.config.artists_directory, self.config.albums_directory
+        )
+
+        for change in ("added", "removed", "renamed"):
+            print(f"INFO: {sum(1 for c in changes if c['change'] == change)} albums {change}.")
+
+        return changes
+
+    def write_inventory(self, artist_inventory, album_inventory):
+        with open(os.path.join(self.config.inventory_path, "artists.json"), 'w', encoding='utf-8') as f:
+            json.dump(artist_inventory, f, indent=4)
+
         with open(os.path.join(self.config.inventory_path, "albums.json"), 'w', encoding='utf-8') as f:
             json.dump(album_inventory, f, indent=4)
 
 
 if __name__ == "__main__":
-    Lydia().init(ArgumentParser().parse_and_sanitize_args())
+    arguments = ArgumentParser().parse_and_sanitize_args()
+    Lydia(
+        jobs=arguments.jobs, pool=arguments.pool, copy_jobs=arguments.copy_jobs, verify=arguments.verify,
+        tag_backend=arguments.tag_backend
+    ).init(arguments)
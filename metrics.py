@@ -0,0 +1,57 @@
+import json
+import time
+import contextlib
+from collections import defaultdict
+
+
+class Metrics:
+    """
+    Collects per-phase wall times and counters (directories visited, files stat'ed, tags parsed, bytes moved, renames
+    performed, etc.) over the course of a lydia run, and writes them out as a JSON report.
+
+    Phases may nest, so each phase's time is inclusive of any phases it contains.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.phase_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def reset(self):
+        self.__init__()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times the enclosed block, adding it to the total for the `name` phase.
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+            self.phase_calls[name] += 1
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def report(self):
+        return {
+            "wall_seconds": time.perf_counter() - self.started,
+            "phases": {
+                name: {"seconds": seconds, "calls": self.phase_calls[name]} for name, seconds in self.phases.items()
+            },
+            "counters": dict(self.counters)
+        }
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=4)
+
+
+# lydia's metrics are process-wide: they're collected from deep inside Directory/Mp3/validators
+metrics = Metrics()
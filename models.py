@@ -2,37 +2,165 @@ import re
 import os
 import json
 import shutil
+import struct
 from enum import Enum
 from eyed3 import id3
 
+from metrics import metrics
+
 id3.log.setLevel("ERROR")
 
+# album basename patterns (compiled once; they're matched against every album directory)
+STANDARD_YEAR_REGEX = re.compile(r"^\d{4}\s-\s")
+YEAR_IN_PARENTHESES_OR_BRACKETS_WITH_HYPHEN_REGEX = re.compile(r"^(\(\d{4}\)|\[\d{4}\])\s-\s")
+HAS_SOMETHING_THAT_LOOKS_REMOTELY_LIKE_A_YEAR_REGEX = re.compile(r"(17\d{2}|18\d{2}|19\d{2}|20\d{2})")
+HAS_HYPHEN_REGEX = re.compile(r"\s-\s(.*)")
+VALID_YEAR_AND_HYPHEN_REGEX = re.compile(r"(17|18|19|20)\d{2}\s-\s.+")
+YYYY_MM_DD_REGEX = re.compile(r"^\d{4}-\d{2}-\d{2}\s.*")
+YEAR_HYPHEN_AND_TITLE_REGEX = re.compile(r"\d{4}\s-\s.+")
+LEADING_YEAR_REGEX = re.compile(r"^\d{4}\s-")
+DOUBLE_LEADING_YEAR_REGEX = re.compile(r"^(\d{4}\s-\s)\1")
+YYYY_MM_DD_AND_TITLE_REGEX = re.compile(r"^(\d{4})-\d{2}-\d{2}\s+(?:-\s+)?(.+)")
+CJK_REGEX = re.compile("[\u2E80-\u9FFF]")
+
+
+def is_lowercase(name):
+    """
+    Whether a basename has no uppercase letters. Any chinese/japanese/korean character makes the whole name count as
+    lowercase (so '坂本龍一 Live At BUDOKAN' is left as it is); other letters without case count as lowercase too.
+    """
+
+    return CJK_REGEX.search(name) is not None or name == name.lower()
+
 
 class Directory:
     """
     Represents a file system directory (base class for lots of Lydia-specific directory types).
     """
 
-    def __init__(self, path):
+    def __init__(self, path, catalog=None, snapshot=None):
         """
         :param path: The path to this directory.
+        :param catalog: An optional `Catalog` used to avoid re-reading unchanged directory listings/tags.
+        :param snapshot: An optional `LibrarySnapshot` to read directory listings from (instead of the file system).
         """
 
         self.path = path
         self.dirname = os.path.dirname(path)
         self.basename = os.path.basename(self.path)
+        self.catalog = catalog
+        self.snapshot = snapshot
+
+        self._all_nested_files = None
+
+    @property
+    def all_nested_files(self):
+        """
+        Every file beneath this directory - walked the first time it's needed (artist directories seldom need it).
+        """
+
+        if self._all_nested_files is None:
+            self._all_nested_files = []
+
+            with metrics.phase("walk"):
+                for root, directories, files in self.walk():
+                    for filename in files:
+                        self._all_nested_files.append(os.path.join(root, filename))
+
+        return self._all_nested_files
+
+    def walk(self):
+        """
+        Walks this directory (top-down, like `os.walk`), preferring the snapshot, then the catalog, then the disk.
+        """
+
+        if self.snapshot:
+            return self.snapshot.walk(self.path)
+
+        if self.catalog:
+            return self.catalog.walk(self.path)
+
+        return Directory.walk_disk(self.path)
+
+    @staticmethod
+    def walk_disk(path):
+        for entry in os.walk(path):
+            metrics.count("directories_visited")
+            yield entry
+
+    def listdir(self):
+        """
+        Returns the (subdirectories, files) directly inside this directory.
+        """
+
+        return Directory.list_directory(self.path, catalog=self.catalog, snapshot=self.snapshot)
+
+    @staticmethod
+    def list_directory(path, catalog=None, snapshot=None):
+        if snapshot:
+            return snapshot.listdir(path)
+
+        if catalog:
+            return catalog.listdir(path)
+
+        path, directories, files = Directory.walk_disk(path).__next__()
+        return directories, files
+
+    def get_size(self):
+        """
+        Returns the total size (in bytes) of every file beneath this directory.
+        """
+
+        size = 0
+
+        for filepath in self.all_nested_files:
+            stat = self.snapshot.stat(filepath) if self.snapshot else None
+
+            if stat is None:
+                metrics.count("files_stated")
+                size += os.path.getsize(filepath)
+            else:
+                size += stat[0]
+
+        return size
+
+    def relocate(self, new_path, planned=False):
+        """
+        Points this object (and anything it holds onto) at `new_path` after the directory has been renamed/moved.
+
+        :param planned: Whether the rename/move has only been planned (in which case the catalog, which mirrors what's
+            actually on disk, is left alone).
+        """
+
+        if self.path is None:
+            return
+
+        if self.catalog and not planned:
+            self.catalog.relocate(self.path, new_path)
+
+        if self.snapshot:
+            self.snapshot.relocate(self.path, new_path, planned=planned)
 
-        self.all_nested_files = []
+        if self._all_nested_files is not None:
+            self._all_nested_files = [new_path + f[len(self.path):] for f in self._all_nested_files]
 
-        for root, directories, files in os.walk(self.path):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                self.all_nested_files.append(filepath)
+        self.path = new_path
+        self.dirname = os.path.dirname(new_path)
+        self.basename = os.path.basename(new_path)
 
-    def rename(self, new_basename, prompt=True, verbose=True):
+    def rename(self, new_basename, prompt=True, verbose=True, plan=None):
+        """
+        :param plan: If given, the rename is only added to this `Plan` (and never prompted for).
+        """
 
         new_basename = new_basename.replace("?", "")
 
+        if plan is not None:
+            plan.rename(self.path, os.path.join(self.dirname, new_basename))
+            self.relocate(os.path.join(self.dirname, new_basename), planned=True)
+
+            return True
+
         if prompt:
             print(f"Would you like to change '{self.basename}' to '{new_basename}' in '{self.dirname}'?")
 
@@ -42,12 +170,12 @@ class Directory:
 
                 print("Okay, will do!")
                 os.rename(self.path, os.path.join(self.dirname, new_basename))
+                metrics.count("renames")
 
                 if verbose:
                     print(f"INFO: Succesfully renamed '{self.basename}' to '{new_basename}'.")
 
-                self.path = os.path.join(self.dirname, new_basename)
-                self.basename = new_basename
+                self.relocate(os.path.join(self.dirname, new_basename))
 
                 return True
 
@@ -59,19 +187,33 @@ class Directory:
         else:
             try:
                 os.rename(self.path, os.path.join(self.dirname, new_basename))
+                metrics.count("renames")
             except FileExistsError:
                 print(f"WARNING: the '{os.path.join(self.dirname, new_basename)}' directory already exists.")
                 self.delete(prompt=True)
 
-            self.path = os.path.join(self.dirname, new_basename)
-            self.basename = new_basename
+            self.relocate(os.path.join(self.dirname, new_basename))
 
             return True
 
-    def delete(self, prompt=True, verbose=True):
+    def delete(self, prompt=True, verbose=True, plan=None):
+        """
+        :param plan: If given, the delete is only added to this `Plan` (and never prompted for).
+        """
 
         path = self.path
 
+        if plan is not None:
+            plan.delete(self.path)
+
+            if self.snapshot:
+                self.snapshot.remove(self.path)
+
+            self.path = None
+            self.basename = None
+
+            return True
+
         if prompt:
             print(f"Would you like to delete '{path}' ?")
 
@@ -80,6 +222,13 @@ class Directory:
             if user_input in ("y", "yes"):
                 print("Okay, will do!")
                 shutil.rmtree(self.path)
+                metrics.count("deletes")
+
+                if self.catalog:
+                    self.catalog.forget(self.path)
+
+                if self.snapshot:
+                    self.snapshot.remove(self.path)
 
                 if verbose:
                     print(f"INFO: Succesfully deleted '{path}'.")
@@ -95,10 +244,27 @@ class Directory:
                 return False
         else:
             shutil.rmtree(self.path)
+            metrics.count("deletes")
+
+            if self.catalog:
+                self.catalog.forget(self.path)
+
+            if self.snapshot:
+                self.snapshot.remove(self.path)
+
             self.path = None
             self.basename = None
 
-    def move(self, new_path, ask_permission=False, verbose=True):
+    def move(self, new_path, ask_permission=False, verbose=True, plan=None, transport=None):
+        """
+        :param plan: If given, the move is only added to this `Plan` (and never prompted for).
+        :param transport: An optional `MigrationTransport` to carry out the move with (defaults to `shutil.move`).
+        """
+
+        if plan is not None:
+            self.relocate(plan.move(self.path, new_path), planned=True)
+
+            return True
 
         if ask_permission:
             print(f"Would you like to move '{self.path}' to '{new_path}'?")
@@ -115,14 +281,18 @@ class Directory:
                 print("Okay, will do!")
 
         try:
-            shutil.move(self.path, new_path)
+            if metrics.enabled:
+                metrics.count("bytes_moved", self.get_size())
+
+            with metrics.phase("move"):
+                new_path = transport.move(self.path, new_path) if transport else shutil.move(self.path, new_path)
+
+            metrics.count("moves")
 
             if verbose:
                 print(f"INFO: Succesfully moved '{self.path}' to '{new_path}'.")
 
-            self.path = new_path
-            self.dirname = os.path.dirname(new_path)
-            self.basename = os.path.basename(new_path)
+            self.relocate(new_path)
 
             return True
 
@@ -131,17 +301,493 @@ class Directory:
             print(e)
 
 
-class Mp3:
-    def __init__(self, path):
+class Track:
+    """
+    An audio file whose tag fields (artist, album and recording date) are read lazily - and cached in the catalog.
+    Subclasses say how those fields are parsed.
+    """
+
+    def __init__(self, path, catalog=None, stat=None, disk_path=None, fields=None):
         """
-        :param path: The path to this .mp3 file.
+        Nothing is read from the file until one of its tag fields is first accessed.
+
+        :param path: The path to this file.
+        :param catalog: An optional `Catalog`; if it holds this file's tag fields (and the file hasn't changed since),
+            the file is not parsed at all.
+        :param stat: The file's (size, mtime), if already known (e.g. from a `LibrarySnapshot`).
+        :param disk_path: Where the file currently is on disk, if that differs from `path` (i.e. while a rename/move of
+            its album is only planned).
+        :param fields: The file's tag fields, if they've already been read (e.g. by an `AsyncScanner`).
         """
 
         self.path = path
+        self.disk_path = disk_path or path
         self.basename = os.path.basename(self.path)
+        self.catalog = catalog
+        self.stat = stat
+
+        self._fields = fields
+
+    @staticmethod
+    def get_track_type(path):
+        """
+        Returns the `Track` subclass for a file (by extension), or None if it isn't a track lydia knows how to read.
+        """
+
+        return {".mp3": Mp3, ".flac": Flac}.get(os.path.splitext(path)[1].lower())
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.load_tag_fields()
+
+        return self._fields
+
+    @property
+    def artist(self):
+        return self.fields["artist"]
+
+    @property
+    def album(self):
+        return self.fields["album"]
+
+    @property
+    def recording_date(self):
+        return self.fields["recording_date"]
 
-        self.id_tag = id3.Tag()
-        self.id_tag.parse(self.path)
+    def load_tag_fields(self):
+        """
+        Reads this file's tag fields from the catalog if it's up to date, otherwise parses the file.
+        """
+
+        fields = self.load_cached_tag_fields()
+
+        if fields is None:
+            fields = self.parse_tag_fields()
+            self.set_tag_fields(fields)
+
+        return fields
+
+    def load_cached_tag_fields(self):
+        """
+        Returns this file's tag fields if they're already known (or are in the catalog and still up to date), without
+        parsing the file.
+        """
+
+        if self._fields is not None or not self.catalog:
+            return self._fields
+
+        if self.stat is None:
+            stat = os.stat(self.disk_path)
+            self.stat = (stat.st_size, stat.st_mtime_ns)
+            metrics.count("files_stated")
+
+        size, mtime = self.stat
+        self._fields = self.catalog.get_tag_fields(self.disk_path, size, mtime)
+
+        return self._fields
+
+    def set_tag_fields(self, fields):
+        """
+        Stores tag fields that were parsed elsewhere (e.g. by a worker pool), updating the catalog if there is one.
+        """
+
+        self._fields = fields
+
+        if self.catalog:
+            size, mtime = self.stat
+            self.catalog.put_tag_fields(self.disk_path, size, mtime, fields)
+
+    def parse_tag_fields(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def read_tag_fields(path, backend="native"):
+        """
+        Parses the tag fields of the track at `path`, whatever its type (a function of just a path, so it can run in a
+        worker process).
+        """
+
+        return Track.get_track_type(path).read_tag_fields(path, backend=backend)
+
+
+class Mp3(Track):
+    """
+    An .mp3 file, tagged with ID3.
+    """
+
+    # "native" tries `Id3v2Reader` first (falling back to eyed3 for anything it can't handle); "eyed3" is always eyed3
+    tag_backend = "native"
+
+    def __init__(self, path, catalog=None, stat=None, disk_path=None, fields=None):
+        Track.__init__(self, path, catalog=catalog, stat=stat, disk_path=disk_path, fields=fields)
+
+        self._id_tag = None
+
+    @property
+    def id_tag(self):
+        """
+        The file's whole eyed3 `Tag` (cover art included), parsed the first time it's needed and kept from then on.
+        Tag fields never need it; see `parse_tag_fields`.
+        """
+
+        if self._id_tag is None:
+            with metrics.phase("tag_parsing"):
+                self._id_tag = id3.Tag()
+                self._id_tag.parse(self.disk_path)
+
+            metrics.count("tags_parsed")
+
+        return self._id_tag
+
+    def parse_tag_fields(self):
+        """
+        Reads this file's tag fields with the native reader if possible (which seeks past cover art and every other
+        frame lydia doesn't use), and eyed3 otherwise. eyed3's tag is thrown away once the fields are out of it, so
+        that an album's tracks don't each hold onto a copy of its cover art.
+        """
+
+        if self._id_tag is not None:
+            return Mp3.get_tag_fields(self._id_tag)
+
+        if Mp3.tag_backend == "native":
+            with metrics.phase("tag_parsing"):
+                fields = Id3v2Reader.read_tag_fields(self.disk_path)
+
+            if fields is not None:
+                metrics.count("tags_parsed")
+                metrics.count("tags_parsed_natively")
+                return fields
+
+        with metrics.phase("tag_parsing"):
+            fields = Mp3.read_tag_fields(self.disk_path, backend="eyed3")
+
+        metrics.count("tags_parsed")
+
+        return fields
+
+    @staticmethod
+    def read_tag_fields(path, backend="native"):
+        """
+        Parses the tag fields of the .mp3 file at `path` (a function of just a path, so it can run in a worker process).
+
+        :param backend: Either "native" or "eyed3" (see `Mp3.tag_backend`).
+        """
+
+        fields = Id3v2Reader.read_tag_fields(path) if backend == "native" else None
+
+        if fields is None:
+            id_tag = id3.Tag()
+            id_tag.parse(path)
+            fields = Mp3.get_tag_fields(id_tag)
+
+        return fields
+
+    @staticmethod
+    def get_tag_fields(id_tag):
+        """
+        Returns the (only) ID3 fields lydia cares about, as strings or None.
+        """
+
+        return {
+            "artist": id_tag.artist,
+            "album": id_tag.album,
+            "recording_date": str(id_tag.recording_date) if id_tag.recording_date else None
+        }
+
+
+class Id3v2Reader:
+    """
+    A minimal ID3v2.3/ID3v2.4 reader for the only frames lydia uses (TPE1, TALB and TDRC/TYER). Just the tag header,
+    the frame headers and those frames' payloads are read; everything else (cover art included) is seeked past.
+
+    Anything unusual - ID3v2.2, unsynchronisation, extended headers, compressed/encrypted frames, dates eyed3 would
+    have to normalise, etc. - is left to eyed3 (`read_tag_fields` returns None).
+    """
+
+    TAG_HEADER = struct.Struct(">3sBBB4s")
+    FRAME_HEADER = struct.Struct(">4s4sH")
+
+    FIELDS = {b"TPE1": "artist", b"TALB": "album", b"TDRC": "recording_date", b"TYER": "recording_date"}
+    DATE_FRAMES = {b"TDRC", b"TYER", b"TDAT", b"TIME", b"TRDA"}
+    ENCODINGS = {0: "latin_1", 1: "utf_16", 2: "utf_16_be", 3: "utf_8"}
+
+    FRAME_ID_REGEX = re.compile(rb"^[A-Z0-9]{4}$")
+    DATE_REGEX = re.compile(r"^\d{4}(-(0[1-9]|1[0-2])(-(0[1-9]|[12]\d|3[01]))?)?$")
+
+    @staticmethod
+    def read_tag_fields(path):
+        """
+        Returns the .mp3 file's {"artist", "album", "recording_date"} fields, or None if eyed3 should parse it instead.
+        """
+
+        fields = {"artist": None, "album": None, "recording_date": None}
+        seen = set()
+
+        with open(path, "rb") as f:
+            if f.read(3) != b"ID3":
+                return None  # no ID3v2 tag (though eyed3 may still find an ID3v1 one)
+
+            f.seek(0)
+
+            try:
+                for version, frame_id, frame_size, is_supported in Id3v2Reader.iter_frames(f):
+                    if frame_id in Id3v2Reader.DATE_FRAMES and frame_id != (b"TDRC" if version == 4 else b"TYER"):
+                        return None
+
+                    if frame_id not in Id3v2Reader.FIELDS:
+                        continue
+
+                    if frame_id in seen or not is_supported:
+                        return None
+
+                    seen.add(frame_id)
+
+                    text = Id3v2Reader.decode(f.read(frame_size))
+
+                    if text is None:
+                        return None
+
+                    fields[Id3v2Reader.FIELDS[frame_id]] = text
+            except ValueError:
+                return None
+
+        if fields["recording_date"] is not None and not Id3v2Reader.DATE_REGEX.match(fields["recording_date"]):
+            return None
+
+        return fields
+
+    @staticmethod
+    def iter_frames(f):
+        """
+        Walks the frame headers of the ID3v2 tag at the start of `f`, yielding (version, frame id, frame size, whether
+        the frame's flags are supported) for each frame, with `f` positioned at its payload - which may be read or
+        ignored, since every frame is seeked to from its header. Yields nothing if there's no tag.
+
+        :raises ValueError: If the tag (or a frame) is one only eyed3 can read.
+        """
+
+        header = f.read(Id3v2Reader.TAG_HEADER.size)
+
+        if header[:3] != b"ID3":
+            return
+
+        if len(header) < Id3v2Reader.TAG_HEADER.size:
+            raise ValueError("the tag header is truncated")
+
+        magic, version, revision, flags, size = Id3v2Reader.TAG_HEADER.unpack(header)
+
+        # 0x80 = unsynchronisation, 0x40 = extended header
+        if version not in (3, 4) or flags & 0xC0 or any(b & 0x80 for b in size):
+            raise ValueError(f"ID3v2.{version} tags with flags {flags:#04x} aren't supported")
+
+        tag_end = Id3v2Reader.TAG_HEADER.size + Id3v2Reader.syncsafe(size)
+
+        # v2.4: grouping, compression, encryption, unsynchronisation, data length; v2.3: compression, encryption,
+        # grouping
+        unsupported_frame_flags = 0x004F if version == 4 else 0x00E0
+
+        position = Id3v2Reader.TAG_HEADER.size
+
+        while position + Id3v2Reader.FRAME_HEADER.size <= tag_end:
+            f.seek(position)
+            frame_header = f.read(Id3v2Reader.FRAME_HEADER.size)
+
+            if len(frame_header) < Id3v2Reader.FRAME_HEADER.size or frame_header[0] == 0:
+                return  # padding
+
+            frame_id, frame_size, frame_flags = Id3v2Reader.FRAME_HEADER.unpack(frame_header)
+
+            if not Id3v2Reader.FRAME_ID_REGEX.match(frame_id):
+                raise ValueError(f"{frame_id!r} isn't a valid frame id")
+
+            if version == 4:
+                if any(b & 0x80 for b in frame_size):
+                    # not syncsafe (a common tagger bug eyed3 knows how to work around)
+                    raise ValueError(f"the size of {frame_id!r} isn't syncsafe")
+
+                frame_size = Id3v2Reader.syncsafe(frame_size)
+            else:
+                frame_size = int.from_bytes(frame_size, "big")
+
+            position += Id3v2Reader.FRAME_HEADER.size + frame_size
+
+            if position > tag_end:
+                raise ValueError(f"{frame_id!r} overruns the tag")
+
+            yield version, frame_id, frame_size, not frame_flags & unsupported_frame_flags
+
+    @staticmethod
+    def decode(data):
+        """
+        Decodes a text frame's payload the way eyed3 does - or returns None if it can't be.
+        """
+
+        if not data or data[0] not in Id3v2Reader.ENCODINGS:
+            return None
+
+        encoding, text = Id3v2Reader.ENCODINGS[data[0]], data[1:]
+
+        if encoding.startswith("utf_16") and len(text) % 2 != 0 and text[-1:] == b"\x00":
+            text = text[:-1]
+
+        try:
+            return str(text, encoding).rstrip("\x00")
+        except UnicodeDecodeError:
+            return None
+
+    @staticmethod
+    def syncsafe(data):
+        return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+class Flac(Track):
+    """
+    A .flac file, tagged with a Vorbis comment. Only its STREAMINFO and VORBIS_COMMENT metadata blocks are ever read
+    (never its audio frames); besides the usual fields, it also knows its `duration`.
+    """
+
+    def parse_tag_fields(self):
+        with metrics.phase("tag_parsing"):
+            fields = Flac.read_tag_fields(self.disk_path)
+
+        metrics.count("tags_parsed")
+
+        return fields
+
+    @property
+    def duration(self):
+        return self.fields.get("duration")
+
+    @staticmethod
+    def read_tag_fields(path, backend="native"):
+        """
+        Parses the tag fields of the .flac file at `path` (lydia has only one FLAC backend, so `backend` is ignored).
+        """
+
+        fields = {"artist": None, "album": None, "recording_date": None, "duration": None}
+        comments = FlacReader.read_metadata(path, fields)
+
+        for name, field in (("ARTIST", "artist"), ("ALBUM", "album"), ("DATE", "recording_date")):
+            if comments.get(name):
+                fields[field] = comments[name][0]
+
+        return fields
+
+
+class FlacReader:
+    """
+    Reads a .flac file's metadata blocks, seeking past everything but STREAMINFO and VORBIS_COMMENT.
+    """
+
+    STREAMINFO = 0
+    VORBIS_COMMENT = 4
+
+    @staticmethod
+    def read_metadata(path, fields):
+        """
+        Sets `fields["duration"]` (in seconds) from STREAMINFO, and returns the Vorbis comments as {NAME: [values]}.
+        """
+
+        comments = {}
+
+        with open(path, "rb") as f:
+            if not FlacReader.find_stream(f):
+                print(f"WARNING: '{path}' is not a FLAC file.")
+                return comments
+
+            for block_type, length in FlacReader.iter_blocks(f):
+                if block_type == FlacReader.STREAMINFO:
+                    fields["duration"] = FlacReader.get_duration(f.read(length))
+                elif block_type == FlacReader.VORBIS_COMMENT:
+                    comments = FlacReader.get_comments(f.read(length))
+
+                if fields["duration"] is not None and comments:
+                    break
+
+        return comments
+
+    @staticmethod
+    def find_stream(f):
+        """
+        Positions `f` at the first metadata block header of the FLAC stream it holds.
+
+        :return: Whether `f` holds a FLAC stream at all.
+        """
+
+        magic = f.read(4)
+
+        # some taggers put an ID3v2 tag in front of the stream
+        if magic[:3] == b"ID3":
+            header = magic + f.read(6)
+            footer = 10 if header[5] & 0x10 else 0
+            f.seek(10 + Id3v2Reader.syncsafe(header[6:10]) + footer)
+            magic = f.read(4)
+
+        return magic == b"fLaC"
+
+    @staticmethod
+    def iter_blocks(f):
+        """
+        Walks the metadata block headers from where `find_stream` left `f`, yielding (block type, length) for each
+        block with `f` positioned at its data - which may be read or ignored, since every block is seeked past from its
+        header. Once every block has been walked, `f` is left where the audio frames start.
+        """
+
+        position = f.tell()
+        is_last = False
+
+        while not is_last:
+            f.seek(position)
+            header = f.read(4)
+
+            if len(header) < 4:
+                return
+
+            is_last, block_type, length = header[0] & 0x80, header[0] & 0x7F, int.from_bytes(header[1:], "big")
+            position += 4 + length
+
+            yield block_type, length
+
+        f.seek(position)
+
+    @staticmethod
+    def get_duration(streaminfo):
+        if len(streaminfo) < 18:
+            return None
+
+        # 20 bits of sample rate, 3 of channels, 5 of bits per sample, then 36 of total samples
+        packed = int.from_bytes(streaminfo[10:18], "big")
+        sample_rate, total_samples = packed >> 44, packed & 0xFFFFFFFFF
+
+        return total_samples / sample_rate if sample_rate and total_samples else None
+
+    @staticmethod
+    def get_comments(block):
+        """
+        Parses a VORBIS_COMMENT block (little-endian lengths; "NAME=value" UTF-8 strings) into {NAME: [values]}.
+        """
+
+        comments = {}
+
+        offset = 4 + int.from_bytes(block[0:4], "little")  # skip the vendor string
+        count = int.from_bytes(block[offset:offset + 4], "little")
+        offset += 4
+
+        for _ in range(count):
+            if offset + 4 > len(block):
+                break  # truncated (or corrupt)
+
+            length = int.from_bytes(block[offset:offset + 4], "little")
+            comment = block[offset + 4:offset + 4 + length].decode("utf-8", errors="replace")
+            offset += 4 + length
+
+            name, separator, value = comment.partition("=")
+
+            if separator:
+                comments.setdefault(name.upper(), []).append(value)
+
+        return comments
 
 
 class BaseArtistsDirectory(Directory):
@@ -169,44 +815,64 @@ class ArtistDirectory(Directory):
     An artist directory is assumed to contain only album-related subdirectories.
     """
 
-    def __init__(self, path, validate=True, parse_mp3s=True):
-        Directory.__init__(self, path)
+    def __init__(self, path, validate=True, parse_mp3s=True, catalog=None, snapshot=None, parse_albums=True):
+        """
+        :param parse_albums: Whether to read every album directory up front (into `album_directories`); if not, use
+            `iter_album_directories` to read them one at a time.
+        """
 
-        self.album_directories = self.get_album_directories(validate, parse_mp3s)
+        Directory.__init__(self, path, catalog=catalog, snapshot=snapshot)
+
+        self.album_directories = self.get_album_directories(validate, parse_mp3s) if parse_albums else None
 
         if validate:
             self.validator = ArtistDirectoryValidator(self)
 
-    def clean(self, force=False):
+    def relocate(self, new_path, planned=False):
+        Directory.relocate(self, new_path, planned=planned)
+
+        for album_directory in self.album_directories or []:
+            album_directory.relocate(os.path.join(new_path, album_directory.basename), planned=planned)
+
+    def clean(self, force=False, plan=None):
         for error in self.validator.validation_errors:
             if error == ArtistDirectoryValidationError.IS_EMPTY:
                 if force:
-                    self.delete()
+                    self.delete(plan=plan)
                 else:
                     print(f"WARNING: would have deleted '{self.basename}'.")
                 break
             else:
                 if error == ArtistDirectoryValidationError.BASENAME_NOT_LOWERCASE:
-                    self.rename(self.basename.lower(), prompt=False)
+                    self.rename(self.basename.lower(), prompt=False, plan=plan)
 
                 if error == ArtistDirectoryValidationError.HAS_LOOSE_FILES:
                     print(f"WARNING: '{self.path}' has loose files.")
 
     def get_album_directories(self, validate=True, parse_mp3s=True):
-        dirs = []
+        return list(self.iter_album_directories(validate, parse_mp3s))
 
-        for subdir in os.listdir(self.path):
-            if os.path.isdir(os.path.join(self.path, subdir)):
-                dirs.append(AlbumDirectory(os.path.join(self.path, subdir), validate=validate, parse_mp3s=parse_mp3s))
+    def iter_album_directories(self, validate=True, parse_mp3s=True):
+        """
+        Yields this artist's album directories one at a time, so that only one is ever held in memory.
+        """
+
+        subdirs, files = self.listdir()
 
-        return dirs
+        for subdir in subdirs:
+            yield AlbumDirectory(
+                os.path.join(self.path, subdir), validate=validate, parse_mp3s=parse_mp3s, catalog=self.catalog,
+                snapshot=self.snapshot
+            )
 
 
 class ArtistDirectoryValidator:
     def __init__(self, artist_directory):
         self.artist_directory = artist_directory
         self.validation_errors = []
-        self.validate()
+
+        with metrics.phase("validation"):
+            self.validate()
 
     @property
     def is_valid(self):
@@ -240,20 +906,17 @@ class ArtistDirectoryValidator:
 
     @property
     def validate_basename_is_lowercase(self):
-        # if the basename is chinese/japanese/korean, let's just say it's lowercase
-        if any(re.match("[\u2E80-\u9FFF]", letter) for letter in self.artist_directory.basename):
-            return True
-
-        return all(letter.islower() for letter in self.artist_directory.basename if letter.isalpha())
+        return is_lowercase(self.artist_directory.basename)
 
     @property
     def validate_no_loose_files(self):
-        contents = [os.path.join(self.artist_directory.path, c) for c in os.listdir(self.artist_directory.path)]
-        return any(os.path.isfile(c) for c in contents) is False
+        subdirs, files = self.artist_directory.listdir()
+        return len(files) == 0
 
     @property
     def validate_is_not_empty(self):
-        return os.listdir(self.artist_directory.path) != []
+        subdirs, files = self.artist_directory.listdir()
+        return len(subdirs) + len(files) > 0
 
 
 class ArtistDirectoryValidationError(Enum):
@@ -268,62 +931,141 @@ class AlbumDirectory(Directory):
     An album directory is assumed to contain only .mp3 files.
     """
 
-    def __init__(self, path, validate=True, parse_mp3s=True):
-        Directory.__init__(self, path)
+    def __init__(self, path, validate=True, parse_mp3s=True, catalog=None, snapshot=None):
+        Directory.__init__(self, path, catalog=catalog, snapshot=snapshot)
+
+        self._assumptions = {}
 
         if parse_mp3s:
-            self.mp3s = self.get_mp3s(self.path)
+            self.tracks = self.get_tracks(self.path, catalog=self.catalog, snapshot=self.snapshot)
+            self.mp3s = [track for track in self.tracks if isinstance(track, Mp3)]
 
         if validate:
             self.validator = AlbumDirectoryValidator(self)
 
+    def relocate(self, new_path, planned=False):
+        old_path = self.path
+
+        Directory.relocate(self, new_path, planned=planned)
+        self.invalidate_assumptions()
+
+        for track in getattr(self, "tracks", []):
+            if not planned:
+                track.disk_path = new_path + track.disk_path[len(old_path):]
+
+            track.path = new_path + track.path[len(old_path):]
 
     @staticmethod
-    def get_mp3s(path):
-        mp3s = []
+    def get_mp3s(path, catalog=None, snapshot=None):
+        """
+        Lists the .mp3 files directly inside an album directory (in name order). Their tags are only read when needed.
+        """
+
+        return [track for track in AlbumDirectory.iter_tracks(path, catalog, snapshot) if isinstance(track, Mp3)]
+
+    @staticmethod
+    def get_tracks(path, catalog=None, snapshot=None):
+        """
+        Lists the .mp3 and .flac files directly inside an album directory (in name order).
+        """
+
+        return list(AlbumDirectory.iter_tracks(path, catalog=catalog, snapshot=snapshot))
+
+    @staticmethod
+    def iter_tracks(path, catalog=None, snapshot=None):
+        """
+        Yields the .mp3 and .flac files directly inside an album directory (in name order), one at a time. Their tags
+        are only read when needed.
+        """
+
+        dirs, files = Directory.list_directory(path, catalog=catalog, snapshot=snapshot)
+
+        for file in sorted(files):
+            track_type = Track.get_track_type(file)
 
-        path, dirs, files = os.walk(path).__next__()
+            if track_type is None:
+                continue
 
-        for file in files:
-            if file.lower().endswith(".mp3"):
-                mp3s.append(Mp3(os.path.join(path, file)))
+            filepath = os.path.join(path, file)
 
-        return mp3s
+            if snapshot:
+                yield track_type(
+                    filepath, catalog=catalog, stat=snapshot.stat(filepath), disk_path=snapshot.get_disk_path(filepath),
+                    fields=snapshot.get_tag_fields(filepath)
+                )
+            else:
+                yield track_type(filepath, catalog=catalog)
+
+    def invalidate_assumptions(self):
+        """
+        Forgets this album's inferred year/title/artist (they're recomputed the next time they're needed).
+        """
+
+        self._assumptions = {}
+
+    def get_assumption(self, name, infer):
+        """
+        Infers one of this album's properties the first time it's needed, then remembers it until the album is
+        renamed or moved.
+        """
+
+        if name not in self._assumptions:
+            metrics.count("album_inferences")
+            self._assumptions[name] = infer()
+
+        return self._assumptions[name]
 
     @property
     def assumed_year(self):
-        standard_year_regex = r"^\d{4}\s-\s"
-        year_in_parentheses_with_hyphen_regex = r"^\(\d{4}\)\s-\s"
-        year_in_brackets_with_hyphen_regex = r"^\[\d{4}\]\s-\s"
-        has_something_that_looks_remotely_like_a_year_regex = r"(17\d{2}|18\d{2}|19\d{2}|20\d{2})"
-
-        if re.match(standard_year_regex, self.basename):
-            return self.basename[:4]
-        if re.match(year_in_parentheses_with_hyphen_regex, self.basename) \
-                or re.match(year_in_brackets_with_hyphen_regex, self.basename):
-            return self.basename[1:5]
-        elif len(self.mp3s) > 0 and self.mp3s[0].id_tag.recording_date:
-            return str(self.mp3s[0].id_tag.recording_date)
-        elif re.match(has_something_that_looks_remotely_like_a_year_regex, self.basename):
-            return re.findall(has_something_that_looks_remotely_like_a_year_regex, self.basename)[0]
-
-        return None
+        return self.get_assumption("year", self.infer_year)
 
     @property
     def assumed_title(self):
-        has_hyphen_regex = re.compile(r"\s-\s(.*)")
-        has_hyphen_regex_match = has_hyphen_regex.search(self.basename)
+        return self.get_assumption("title", self.infer_title)
+
+    @property
+    def assumed_artist(self):
+        return self.get_assumption("artist", self.infer_artist)
+
+    def infer_year(self):
+        return AlbumDirectory.infer_year_from(self.basename, self.tracks[0] if self.tracks else None)
+
+    def infer_title(self):
+        return AlbumDirectory.infer_title_from(self.basename, self.tracks[0] if self.tracks else None)
+
+    def infer_artist(self):
+        return AlbumDirectory.infer_artist_from(self.basename, self.tracks[0] if self.tracks else None)
+
+    # the inferences themselves only need an album's basename and its first track (a `Track`, or anything else with
+    # its fields - e.g. a `LibraryIndex` entry), or None if it has none
+
+    @staticmethod
+    def infer_year_from(basename, track):
+        if STANDARD_YEAR_REGEX.match(basename):
+            return basename[:4]
+        if YEAR_IN_PARENTHESES_OR_BRACKETS_WITH_HYPHEN_REGEX.match(basename):
+            return basename[1:5]
+        elif track is not None and track.recording_date:
+            return track.recording_date
+
+        year = HAS_SOMETHING_THAT_LOOKS_REMOTELY_LIKE_A_YEAR_REGEX.match(basename)
+
+        return year.group(1) if year else None
+
+    @staticmethod
+    def infer_title_from(basename, track):
+        has_hyphen_regex_match = HAS_HYPHEN_REGEX.search(basename)
 
         if has_hyphen_regex_match:
             return has_hyphen_regex_match.group(1).lower().replace(":", "_")
-        elif len(self.mp3s) > 0 and str(self.mp3s[0].id_tag.recording_date):
-            return str(self.mp3s[0].id_tag.album).lower().replace(":", "_")
+        elif track is not None and str(track.recording_date):
+            return str(track.album).lower().replace(":", "_")
 
-    @property
-    def assumed_artist(self):
-        if len(self.mp3s) > 0 and str(self.mp3s[0].id_tag.artist):
+    @staticmethod
+    def infer_artist_from(basename, track):
+        if track is not None and str(track.artist):
 
-            assumed_artist_name = str(self.mp3s[0].id_tag.artist).lower().strip()
+            assumed_artist_name = str(track.artist).lower().strip()
 
             if "," in assumed_artist_name or assumed_artist_name == "none":
                 print(f"WARNING: it's a bad idea to assume the artist is literally named '{assumed_artist_name}'.")
@@ -331,21 +1073,17 @@ class AlbumDirectory(Directory):
 
             return assumed_artist_name
 
-        print(f"WARNING: could not determine the artist associated with {self.basename}.")
+        print(f"WARNING: could not determine the artist associated with {basename}.")
         return None
 
     @property
     def basename_is_lowercase(self):
-        # if the basename is chinese/japanese/korean, let's just say it's lowercase
-        if any(re.match("[\u2E80-\u9FFF]", letter) for letter in self.basename):
-            return True
-
-        return all(letter.islower() for letter in self.basename if letter.isalpha())
+        return is_lowercase(self.basename)
 
     @property
     def basename_has_valid_year_and_hyphen(self):
         try:
-            return re.match(r"(17|18|19|20)\d{2}\s-\s.+", self.basename) is not None
+            return VALID_YEAR_AND_HYPHEN_REGEX.match(self.basename) is not None
         except Exception as e:
             print(e)
             return True
@@ -353,19 +1091,20 @@ class AlbumDirectory(Directory):
     @property
     def basename_in_yyyy_mm_dd_format(self):
         try:
-            return re.match(r"^\d{4}-\d{2}-\d{2}\s.*", self.basename) is not None
+            return YYYY_MM_DD_REGEX.match(self.basename) is not None
         except Exception as e:
             print(e)
             return True
 
     @property
     def has_no_subdirectories(self):
-        path, dirs, files = os.walk(self.path).__next__()
+        dirs, files = self.listdir()
         return len(dirs) == 0
 
     @property
     def is_empty(self):
-        return os.listdir(self.path) == []
+        dirs, files = self.listdir()
+        return len(dirs) + len(files) == 0
 
     @property
     def has_mp3s_or_flacs(self):
@@ -374,41 +1113,63 @@ class AlbumDirectory(Directory):
 
     @property
     def has_year_hyphen_and_title(self):
-        return re.match(r"\d{4}\s-\s.+", self.basename)
+        return YEAR_HYPHEN_AND_TITLE_REGEX.match(self.basename)
 
     @property
     def has_double_leading_year(self):
-        return self.basename[0:7] == self.basename[7:14] \
-               and re.match(r"^\d{4}\s-", self.basename[0:7]) is not None \
-               and re.match(r"^\d{4}\s-", self.basename[7:14]) is not None
+        return DOUBLE_LEADING_YEAR_REGEX.match(self.basename) is not None
 
-    def clean(self, force=False):
+    def clean(self, force=False, plan=None):
         for error in self.validator.validation_errors:
             if error == AlbumDirectoryValidationError.IS_EMPTY:
                 if force:
-                    self.delete()
+                    self.delete(plan=plan)
                 else:
                     print(f"WARNING: would have deleted '{self.basename}'.")
                 break
             elif error == AlbumDirectoryValidationError.BASENAME_NOT_LOWERCASE:
-                self.rename(self.basename.lower(), prompt=False)
+                self.rename(self.basename.lower(), prompt=False, plan=plan)
 
-    def migrate(self, artists_directory, verbose=True):
+    def get_artist_directory_path(self, artists_directory):
+        """
+        Returns the artist directory (within `artists_directory`) that this album would be migrated to - or None if
+        its artist can't be determined.
+        """
 
         if not self.assumed_artist:
-            print(f"WARNING: could not migrate {self.basename} - the artist name could not be determined from the contents of this "
-                  "directory.")
             return None
 
-        artist_directory_path = os.path.join(
+        return os.path.join(
             artists_directory,
             self.assumed_artist.lower().replace("/", "").replace(":", "_").replace('\"', '\'')
         )
 
-        if not os.path.isdir(artist_directory_path):
+    def migrate(self, artists_directory, verbose=True, plan=None, transport=None):
+
+        artist_directory_path = self.get_artist_directory_path(artists_directory)
+
+        if not artist_directory_path:
+            print(f"WARNING: could not migrate {self.basename} - the artist name could not be determined from the contents of this "
+                  "directory.")
+            return None
+
+        self.migrate_to(artist_directory_path, verbose=verbose, plan=plan, transport=transport)
+
+    def migrate_to(self, artist_directory_path, verbose=True, plan=None, transport=None):
+        """
+        Moves this album into an artist directory, creating it first if need be.
+        """
+
+        if plan is not None:
+            plan.mkdir(artist_directory_path)
+
+        elif not os.path.isdir(artist_directory_path):
             os.mkdir(artist_directory_path)
 
-        self.move(artist_directory_path, verbose=verbose)
+            if self.snapshot:
+                self.snapshot.mkdir(artist_directory_path)
+
+        self.move(artist_directory_path, verbose=verbose, plan=plan, transport=transport)
 
 
 class AlbumDirectoryValidationError(Enum):
@@ -421,7 +1182,9 @@ class AlbumDirectoryValidator:
     def __init__(self, album_directory):
         self.album_directory = album_directory
         self.validation_errors = []
-        self.validate()
+
+        with metrics.phase("validation"):
+            self.validate()
 
     @property
     def is_valid(self):
@@ -447,21 +1210,22 @@ class AlbumDirectoryValidator:
 
     @property
     def validate_basename_is_lowercase(self):
-        # if the basename is chinese/japanese/korean, let's just say it's lowercase
-        if any(re.match("[\u2E80-\u9FFF]", letter) for letter in self.album_directory.basename):
-            return True
-
-        return all(letter.islower() for letter in self.album_directory.basename if letter.isalpha())
+        return is_lowercase(self.album_directory.basename)
 
     @property
     def validate_is_not_empty(self):
-        return os.listdir(self.album_directory.path) != []
+        subdirs, files = self.album_directory.listdir()
+        return len(subdirs) + len(files) > 0
 
 
 class LydiaConfig:
-    def __init__(self):
+    def __init__(self, config_file_path=None):
+        """
+        :param config_file_path: The path to a config file (defaults to the `config.json` next to lydia).
+        """
+
         self.executing_directory = os.path.dirname(os.path.abspath(__file__))
-        self.config_file_path = os.path.join(self.executing_directory, "config.json")
+        self.config_file_path = config_file_path or os.path.join(self.executing_directory, "config.json")
 
         with open(self.config_file_path) as config_file:
             config = json.load(config_file)
@@ -470,6 +1234,11 @@ class LydiaConfig:
             self.artists_directory = config["artists_directory"]
             self.staging_directory = config["staging_directory"]
             self.inventory_path = config["inventory_path"]
+            self.catalog_path = config.get("catalog_path", os.path.join(self.executing_directory, "catalog.db"))
+            self.journal_path = config.get("journal_path", os.path.join(self.executing_directory, "journal.jsonl"))
+            self.socket_path = config.get("socket_path", os.path.join(self.executing_directory, "lydia.sock"))
+            self.server_token = config.get("server_token")
+            self.covers_directory = config.get("covers_directory", os.path.join(self.executing_directory, "covers"))
 
             self.album_validation_behavior = {
                 "rename_as_lowercase":
@@ -0,0 +1,327 @@
+import os
+import json
+import shutil
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class OperationType(Enum):
+
+    MKDIR = "mkdir"
+    RENAME = "rename"
+    MOVE = "move"
+    DELETE = "delete"
+
+
+class Operation:
+    """
+    A single planned file system operation.
+    """
+
+    def __init__(self, operation_type, source, target=None):
+        """
+        :param operation_type: An `OperationType`.
+        :param source: The path being created/renamed/moved/deleted.
+        :param target: The (full, final) path being renamed/moved to.
+        """
+
+        self.operation_type = operation_type
+        self.source = source
+        self.target = target
+
+    def __repr__(self):
+        if self.target is None:
+            return f"{self.operation_type.value} '{self.source}'"
+
+        return f"{self.operation_type.value} '{self.source}' -> '{self.target}'"
+
+    def to_dict(self):
+        return {"type": self.operation_type.value, "source": self.source, "target": self.target}
+
+    @staticmethod
+    def from_dict(operation):
+        return Operation(OperationType(operation["type"]), operation["source"], operation.get("target"))
+
+
+class Plan:
+    """
+    An ordered list of file system operations (mkdirs, renames, moves and deletes) that lydia *would* perform.
+
+    Plans can be checked for collisions (including case-only ones) without touching the disk, saved for review, and
+    applied in a single batched pass - with runs of independent moves carried out in parallel.
+    """
+
+    # what a change whose behavior is "prompt" does while it's being planned: "ask" (the plan is about to be applied, so
+    # ask now), "queue" (add it unasked; the plan is only being written out for review) or "skip" (there's nobody to
+    # ask, so leave it out and report it)
+    PROMPTS = ("ask", "queue", "skip")
+
+    def __init__(self, operations=None, prompts="ask"):
+        if prompts not in Plan.PROMPTS:
+            raise ValueError(f"'{prompts}' is not a valid prompt mode; expected one of {Plan.PROMPTS}.")
+
+        self.operations = []
+        self.states = {}  # path -> the operations that created/vacated it (see `record`)
+        self.prompts = prompts
+
+        for operation in operations or []:
+            self.add(operation)
+
+    @staticmethod
+    def get_prompts(plan):
+        """
+        Returns what "prompt" behaviors should do with (or without) `plan`; without one, changes are carried out as
+        they're made, so they're always asked about.
+        """
+
+        return "ask" if plan is None else plan.prompts
+
+    def add(self, operation):
+        self.operations.append(operation)
+        Plan.record(self.states, operation, len(self.operations))
+
+    def mkdir(self, path):
+        if not self.is_dir(path):
+            self.add(Operation(OperationType.MKDIR, path))
+
+    def rename(self, source, target):
+        self.add(Operation(OperationType.RENAME, source, target))
+
+    def move(self, source, target):
+        """
+        Plans a move of `source` to `target` - or *into* `target`, if `target` is (or will be) a directory.
+        """
+
+        if self.is_dir(target):
+            target = os.path.join(target, os.path.basename(source))
+
+        self.add(Operation(OperationType.MOVE, source, target))
+
+        return target
+
+    def delete(self, path):
+        self.add(Operation(OperationType.DELETE, path))
+
+    def is_dir(self, path):
+        """
+        Whether `path` will be a directory once this plan (so far) has been applied.
+        """
+
+        exists = Plan.get_planned_state(self.states, path)
+        return os.path.isdir(path) if exists is None else exists
+
+    @staticmethod
+    def record(states, operation, index):
+        """
+        Records the paths an operation creates/vacates, as (operation index, exists afterwards, moved from) entries.
+        """
+
+        if operation.operation_type == OperationType.MKDIR:
+            states.setdefault(operation.source, []).append((index, True, None))
+            return
+
+        states.setdefault(operation.source, []).append((index, False, None))
+
+        if operation.target is not None:
+            states.setdefault(operation.target, []).append((index, True, operation.source))
+
+    @staticmethod
+    def get_planned_state(states, path, before=None):
+        """
+        Returns whether `path` exists according to the planned operations (before the `before`th one) on it, or on one
+        of its parents - or None if no planned operation affects it.
+        """
+
+        latest = None
+
+        for ancestor in Plan.get_ancestors(path):
+            for index, exists, origin in reversed(states.get(ancestor, [])):
+                if before is None or index < before:
+                    if latest is None or index > latest[0]:
+                        latest = (index, exists, origin, ancestor)
+                    break
+
+        if latest is None:
+            return None
+
+        index, exists, origin, ancestor = latest
+
+        if ancestor == path or not exists:
+            return exists
+
+        if origin is None:
+            return False  # nothing exists inside a freshly planned (empty) directory
+
+        # whatever is inside a moved/renamed directory is whatever was inside it beforehand
+        origin_path = origin + path[len(ancestor):]
+        origin_exists = Plan.get_planned_state(states, origin_path, index)
+
+        return os.path.lexists(origin_path) if origin_exists is None else origin_exists
+
+    def find_conflicts(self):
+        """
+        Returns a description of every operation that would collide with the disk or with another planned operation.
+        """
+
+        conflicts = []
+
+        states = {}
+        targets = {}  # case-folded path -> planned path
+
+        def exists(path):
+            planned = Plan.get_planned_state(states, path)
+            return os.path.lexists(path) if planned is None else planned
+
+        for index, operation in enumerate(self.operations, start=1):
+            is_mkdir = operation.operation_type == OperationType.MKDIR
+            source, target = operation.source, operation.source if is_mkdir else operation.target
+
+            if not is_mkdir and not exists(source):
+                conflicts.append(f"{operation}: the source does not exist (or was already moved/deleted).")
+
+            elif target is not None:
+                if not is_mkdir:
+                    targets.pop(os.path.normcase(source).casefold(), None)
+
+                key = os.path.normcase(target).casefold()
+
+                if key in targets and targets[key] != target:
+                    conflicts.append(f"{operation}: differs only in case from another target, '{targets[key]}'.")
+                elif key in targets and not is_mkdir:
+                    conflicts.append(f"{operation}: another operation already targets '{target}'.")
+                elif not is_mkdir and exists(target) and not Plan.is_case_only_rename(source, target):
+                    conflicts.append(f"{operation}: the target already exists.")
+
+                targets[key] = target
+
+            Plan.record(states, operation, index)
+
+        return conflicts
+
+    def apply(self, jobs=1, catalog=None, verbose=True, transport=None):
+        """
+        Carries out every operation in order; consecutive moves that don't touch each other's paths run in parallel.
+
+        :param transport: An optional `MigrationTransport` to carry out moves with (defaults to `shutil.move`).
+
+        :return: True if every operation succeeded. Stops at the first failure.
+        """
+
+        batch = []
+        batch_paths = set()  # the sources/targets of the batched moves...
+        batch_parents = set()  # ... and every directory above them
+
+        for operation in self.operations:
+            if operation.operation_type == OperationType.MOVE:
+                paths = (operation.source, operation.target)
+                ancestors = [a for p in paths for a in Plan.get_ancestors(p)]
+
+                if any(p in batch_parents for p in paths) or any(a in batch_paths for a in ancestors):
+                    if not self.apply_moves(batch, jobs, catalog, verbose, transport):
+                        return False
+
+                    batch, batch_paths, batch_parents = [], set(), set()
+
+                batch.append(operation)
+                batch_paths.update(paths)
+                batch_parents.update(a for a in ancestors if a not in paths)
+                continue
+
+            if not self.apply_moves(batch, jobs, catalog, verbose, transport):
+                return False
+
+            batch, batch_paths, batch_parents = [], set(), set()
+
+            if not Plan.apply_operation(operation, catalog, verbose, transport):
+                return False
+
+        return self.apply_moves(batch, jobs, catalog, verbose, transport)
+
+    @staticmethod
+    def apply_moves(operations, jobs, catalog, verbose, transport=None):
+        if len(operations) <= 1 or jobs <= 1:
+            return all(Plan.apply_operation(o, catalog, verbose, transport) for o in operations)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(lambda o: Plan.apply_operation(o, None, verbose, transport), operations))
+
+        # the catalog's (SQLite) connection belongs to this thread
+        if catalog:
+            for operation, succeeded in zip(operations, results):
+                if succeeded:
+                    catalog.relocate(operation.source, operation.target)
+
+        return all(results)
+
+    @staticmethod
+    def apply_operation(operation, catalog=None, verbose=True, transport=None):
+        try:
+            if operation.operation_type == OperationType.MKDIR:
+                os.makedirs(operation.source, exist_ok=True)
+
+            elif operation.operation_type == OperationType.RENAME:
+                os.rename(operation.source, operation.target)
+                metrics.count("renames")
+
+            elif operation.operation_type == OperationType.MOVE:
+                with metrics.phase("move"):
+                    if transport:
+                        transport.move(operation.source, operation.target)
+                    else:
+                        shutil.move(operation.source, operation.target)
+
+                metrics.count("moves")
+
+            elif operation.operation_type == OperationType.DELETE:
+                shutil.rmtree(operation.source)
+                metrics.count("deletes")
+
+        except OSError as e:
+            print(f"ERROR: failed to {operation}.")
+            print(e)
+            return False
+
+        if catalog and operation.operation_type in (OperationType.RENAME, OperationType.MOVE):
+            catalog.relocate(operation.source, operation.target)
+        elif catalog and operation.operation_type == OperationType.DELETE:
+            catalog.forget(operation.source)
+
+        if verbose:
+            print(f"INFO: Succesfully applied {operation}.")
+
+        return True
+
+    @staticmethod
+    def is_case_only_rename(source, target):
+        if source == target or source.casefold() != target.casefold():
+            return False
+
+        # on a case-sensitive file system, the target may well be a different directory altogether
+        return not os.path.lexists(target) or os.path.samefile(source, target)
+
+    @staticmethod
+    def get_ancestors(path):
+        """
+        Yields `path` and every directory above it.
+        """
+
+        while True:
+            yield path
+
+            parent = os.path.dirname(path)
+
+            if parent == path:
+                return
+
+            path = parent
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"operations": [operation.to_dict() for operation in self.operations]}, f, indent=4)
+
+    @staticmethod
+    def load(path):
+        with open(path, encoding="utf-8") as f:
+            return Plan([Operation.from_dict(operation) for operation in json.load(f)["operations"]])
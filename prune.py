@@ -0,0 +1,150 @@
+import os
+
+from models import Directory, Track
+from plan import Plan
+from metrics import metrics
+
+
+class Pruner:
+    """
+    Removes empty folders, and album/artist folders without any .mp3s or .flacs, from the artists and albums
+    directories - in a single bottom-up pass over a `LibrarySnapshot`, rather than a walk per folder.
+
+    What happens to each kind of folder is up to its `album_validation_behavior` (`remove_empty_folders` and
+    `remove_folders_with_no_mp3s_or_flacs`): "force" removes them, "prompt" asks about all of them at once, and "skip"
+    leaves them alone.
+    """
+
+    BEHAVIORS = ("force", "prompt", "skip")
+
+    def __init__(self, snapshot, catalog=None, empty="skip", audioless="skip"):
+        """
+        :param snapshot: The `LibrarySnapshot` to read the trees from.
+        :param catalog: An optional `Catalog` (kept in step with any removals).
+        :param empty: What to do with folders that contain no files at all (however deeply nested).
+        :param audioless: What to do with album/artist folders that contain files, but no .mp3s or .flacs.
+        """
+
+        for behavior in (empty, audioless):
+            if behavior not in Pruner.BEHAVIORS:
+                raise ValueError(f"'{behavior}' is not a valid behavior; expected one of {Pruner.BEHAVIORS}.")
+
+        self.snapshot = snapshot
+        self.catalog = catalog
+        self.behaviors = {"empty": empty, "audioless": audioless}
+
+    def find(self, root, depth):
+        """
+        Returns the (path, reason) of every prunable folder beneath `root` - only the outermost, where they're nested -
+        where reason is "empty" or "audioless".
+
+        :param depth: How deep beneath `root` album folders are (1 for the albums directory, 2 for the artists
+            directory). Audioless folders are only pruned down to that depth - deeper ones hold artwork, scans, etc.
+        """
+
+        root = os.path.normpath(root)
+        contents = {}  # path -> (has files, has audio)
+
+        # post-order: a folder's contents are known once all of its subfolders' are
+        stack = [(root, self.snapshot.get(root), False)]
+
+        with metrics.phase("prune_scan"):
+            while stack:
+                path, directory, visited = stack.pop()
+
+                if not visited:
+                    stack.append((path, directory, True))
+                    stack.extend(
+                        (os.path.join(path, name), subdirectory, False)
+                        for name, subdirectory in directory.directories.items()
+                    )
+                    continue
+
+                has_files, has_audio = bool(directory.files), any(Track.get_track_type(f) for f in directory.files)
+
+                for name in directory.directories:
+                    subdirectory_has_files, subdirectory_has_audio = contents[os.path.join(path, name)]
+                    has_files, has_audio = has_files or subdirectory_has_files, has_audio or subdirectory_has_audio
+
+                contents[path] = has_files, has_audio
+
+        prunable = []
+        stack = [(root, self.snapshot.get(root), 0)]
+
+        while stack:
+            path, directory, level = stack.pop()
+
+            for name, subdirectory in sorted(directory.directories.items(), reverse=True):
+                subdirectory_path = os.path.join(path, name)
+                has_files, has_audio = contents[subdirectory_path]
+
+                if name.startswith("_"):
+                    continue  # by convention, lydia leaves these alone
+
+                if not has_files:
+                    prunable.append((subdirectory_path, "empty"))
+                elif not has_audio and level < depth:
+                    prunable.append((subdirectory_path, "audioless"))
+                else:
+                    stack.append((subdirectory_path, subdirectory, level + 1))
+
+        return sorted(prunable)
+
+    def prune(self, roots, plan=None):
+        """
+        Finds and removes prunable folders beneath each of `roots`, as their behaviors say.
+
+        :param roots: (path, depth) pairs; see `find`.
+        :param plan: If given, removals are added to this `Plan` rather than carried out; its `prompts` say whether
+            "prompt" behaviors still ask (see `Plan.PROMPTS`).
+        :return: The paths of the removed folders.
+        """
+
+        prunable = [
+            (path, reason) for root, depth in roots if root and os.path.isdir(root)
+            for path, reason in self.find(root, depth) if self.behaviors[reason] != "skip"
+        ]
+
+        forced = [path for path, reason in prunable if self.behaviors[reason] == "force"]
+        prompted = [path for path, reason in prunable if self.behaviors[reason] == "prompt"]
+
+        prompts = Plan.get_prompts(plan)
+
+        if prompted and prompts == "skip":
+            print(f"WARNING: skipped deleting {len(prompted)} folders, since that needs to be confirmed:")
+
+            for path in prompted:
+                print(f"    {path}")
+
+            prompted = []
+
+        elif prompted and prompts == "ask":
+            print(f"Would you like to delete these {len(prompted)} folders?")
+
+            for path in prompted:
+                print(f"    {path}")
+
+            if input().lower() not in ("y", "yes"):
+                print("Okay, I won't delete these.")
+                prompted = []
+            else:
+                print("Okay, will do!")
+
+        removed = []
+
+        for path in sorted(forced + prompted):
+            try:
+                Directory(path, catalog=self.catalog, snapshot=self.snapshot).delete(prompt=False, plan=plan)
+            except OSError as e:
+                print(f"ERROR: failed to delete '{path}'.")
+                print(e)
+                continue
+
+            removed.append(path)
+
+            if plan is None:
+                print(f"INFO: Succesfully deleted '{path}'.")
+
+        print(f"INFO: Pruned {len(removed)} of {len(prunable)} prunable folders.")
+
+        return removed
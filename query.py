@@ -0,0 +1,227 @@
+import re
+import sys
+import shlex
+import pickle
+import bisect
+
+from metrics import metrics
+
+
+class AlbumRecord:
+    """
+    What a `QueryIndex` knows about an album: where it is, who it's by, what it's called, when it's from and what's
+    wrong with it (and with its artist directory).
+    """
+
+    __slots__ = ("path", "directory", "artist", "title", "year", "errors", "artist_errors")
+
+    def __init__(self, path, directory, artist, title, year, errors, artist_errors=()):
+        self.path = path
+        self.directory = directory  # "artists" or "albums"
+        self.artist = artist
+        self.title = title
+        self.year = year
+        self.errors = errors
+        self.artist_errors = artist_errors
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in AlbumRecord.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(AlbumRecord.__slots__, state):
+            setattr(self, slot, value)
+
+    def __str__(self):
+        errors = [*self.errors, *(f"ARTIST_{e}" for e in self.artist_errors)]
+        errors = f" [{', '.join(errors)}]" if errors else ""
+        return f"{self.year or '????'}  {self.artist or '?'} - {self.title or '?'}  ({self.path}){errors}"
+
+
+class QueryIndex:
+    """
+    Answers questions about the library ("which albums by this artist do we have?", "what's missing a year?", "what's
+    from 1979-1982?") from memory, without touching the disk.
+
+    Albums are held in a list; an inverted index maps each (lowercase, word-level) token of their artists and titles to
+    the albums that contain it, a sorted list of (year, album) pairs answers year ranges by bisection, and each
+    validation error maps to the albums that have it. A query is a conjunction of terms, each of which is a set lookup
+    (or a slice, for years):
+
+        joy                     "joy" is a token of the artist or title
+        artist:"joy division"   every token is in the artist (title: works likewise)
+        year:1979 year:1979-1982 year:none
+        error:empty error:year_plus_title error:any error:none
+        artist_error:lowercase artist_error:loose_files artist_error:any
+        in:artists in:albums
+
+    Errors are the names of the `RuleEngine` rules an album breaks (`ALBUM_RULES`) - and, separately, the ones its
+    artist directory breaks (`ARTIST_RULES`).
+    """
+
+    TOKEN_REGEX = re.compile(r"\w+")
+    YEAR_REGEX = re.compile(r"^(\d{4})(?:-(\d{4}))?$")
+    FIELDS = ("artist", "title", "year", "error", "artist_error", "in", "any")
+
+    def __init__(self):
+        self.albums = []
+        self.tokens = {"artist": {}, "title": {}}  # field -> token -> {album ids}
+        self.years = []  # sorted (year, album id)
+        self.errors = {}  # error name -> {album ids}
+        self.artist_errors = {}  # error name -> {the ids of albums whose artist directories have it}
+        self.directories = {}  # "artists"/"albums" -> {album ids}
+
+    def add(self, path, directory, artist, title, year, errors=(), artist_errors=()):
+        """
+        Adds an album to the index.
+
+        :param directory: Which directory the album is in: "artists" or "albums".
+        :param errors: The names of the album's validation errors.
+        :param artist_errors: The names of its artist directory's validation errors.
+        """
+
+        album_id = len(self.albums)
+        year = str(year)[:4] if year else None
+
+        self.albums.append(AlbumRecord(
+            path, sys.intern(directory), QueryIndex.intern(artist), title, QueryIndex.intern(year),
+            tuple(sys.intern(e) for e in errors), tuple(sys.intern(e) for e in artist_errors)
+        ))
+
+        for field, value in (("artist", artist), ("title", title)):
+            for token in QueryIndex.tokenize(value):
+                self.tokens[field].setdefault(sys.intern(token), set()).add(album_id)
+
+        if year and year.isdigit():
+            bisect.insort(self.years, (int(year), album_id))
+
+        for error in errors:
+            self.errors.setdefault(error, set()).add(album_id)
+
+        for error in artist_errors:
+            self.artist_errors.setdefault(error, set()).add(album_id)
+
+        self.directories.setdefault(directory, set()).add(album_id)
+
+    @staticmethod
+    def intern(value):
+        return sys.intern(value) if value else value
+
+    @staticmethod
+    def tokenize(value):
+        return QueryIndex.TOKEN_REGEX.findall(str(value).lower()) if value else []
+
+    def query(self, query):
+        """
+        :param query: A string of (implicitly AND-ed) terms; see the class docstring.
+        :return: The matching `AlbumRecord`s, by artist, year and title.
+        :raises ValueError: If the query isn't valid (see `parse`).
+        """
+
+        terms = QueryIndex.parse(query)
+
+        with metrics.phase("query"):
+            matches = set(range(len(self.albums)))
+
+            for field, value in terms:
+                matches &= self.match(field, value)
+
+                if not matches:
+                    break
+
+            return sorted(
+                (self.albums[i] for i in matches), key=lambda a: (a.artist or "", a.year or "", a.title or "", a.path)
+            )
+
+    @staticmethod
+    def parse(query):
+        """
+        Splits a query into its (field, value) terms - checking every one of them, before any is matched.
+
+        :raises ValueError: If the query has unbalanced quotes, an unknown field or an invalid year.
+        """
+
+        terms = []
+
+        for term in shlex.split(query):
+            field, separator, value = term.partition(":")
+
+            if not separator:
+                field, value = "any", term
+
+            field, value = field.lower(), value.lower()
+
+            if field not in QueryIndex.FIELDS:
+                raise ValueError(
+                    f"'{field}' is not a valid query field; expected one of {', '.join(QueryIndex.FIELDS[:-1])}."
+                )
+
+            if field == "year" and value != "none" and not QueryIndex.YEAR_REGEX.match(value):
+                raise ValueError(f"'{value}' is not a valid year; expected e.g. 1979, 1979-1982 or none.")
+
+            terms.append((field, value))
+
+        return terms
+
+    def match(self, field, value):
+        """
+        Returns the ids of the albums matching a single (parsed) term.
+        """
+
+        if field in ("artist", "title"):
+            return self.match_tokens(field, QueryIndex.tokenize(value))
+
+        if field == "any":
+            tokens = QueryIndex.tokenize(value)
+            return self.match_tokens("artist", tokens) | self.match_tokens("title", tokens)
+
+        if field == "year":
+            return self.match_years(value)
+
+        if field in ("error", "artist_error"):
+            return self.match_errors(self.errors if field == "error" else self.artist_errors, value)
+
+        if field == "in":
+            return set(self.directories.get(value, ()))
+
+    def match_tokens(self, field, tokens):
+        matches = None
+
+        for token in tokens:
+            albums = self.tokens[field].get(token, set())
+            matches = set(albums) if matches is None else matches & albums
+
+        return matches or set()
+
+    def match_errors(self, errors, value):
+        if value in ("any", "none"):
+            matches = set.union(set(), *errors.values())
+            return matches if value == "any" else set(range(len(self.albums))) - matches
+
+        return set(errors.get(value.upper(), ()))
+
+    def match_years(self, value):
+        if value == "none":
+            return {i for i, album in enumerate(self.albums) if not album.year or not album.year.isdigit()}
+
+        match = QueryIndex.YEAR_REGEX.match(value)
+
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+
+        low = bisect.bisect_left(self.years, (start, -1))
+        high = bisect.bisect_right(self.years, (end, len(self.albums)))
+
+        return {album_id for year, album_id in self.years[low:high]}
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        index = QueryIndex()
+
+        with open(path, "rb") as f:
+            index.__dict__.update(pickle.load(f))
+
+        return index
@@ -0,0 +1,187 @@
+import os
+import csv
+import json
+import functools
+from collections import Counter
+
+from eyed3 import id3
+
+from metrics import metrics
+from workers import TagExtractor
+
+
+class Retagger:
+    """
+    Bulk-retags albums from a mapping of directories to the artist/album/year their tracks should carry.
+
+    Every track is compared against the mapping first, and only tracks that actually differ are written - in place
+    (into the existing tag's padding) whenever the new tag fits, so that the audio doesn't have to be copied. Files are
+    processed across a worker pool.
+    """
+
+    FIELDS = ("artist", "album", "year")
+
+    def __init__(self, jobs=1, pool="thread", dry_run=False, verbose=True):
+        """
+        :param jobs: The number of workers.
+        :param pool: Either "thread" or "process".
+        :param dry_run: Whether to only report the changes that would be made.
+        :param verbose: Whether to report every changed file.
+        """
+
+        if pool not in TagExtractor.POOLS:
+            raise ValueError(f"'{pool}' is not a valid pool; expected one of {list(TagExtractor.POOLS)}.")
+
+        self.jobs = max(1, jobs)
+        self.pool = pool
+        self.dry_run = dry_run
+        self.verbose = verbose
+
+    @staticmethod
+    def load_mapping(path):
+        """
+        Loads a mapping of directory -> {"artist", "album", "year"} (any of which may be omitted) from either a JSON
+        object or a CSV file with `directory,artist,album,year` columns.
+        """
+
+        with open(path, encoding="utf-8", newline="") as f:
+            if path.lower().endswith(".csv"):
+                rows = {row["directory"]: row for row in csv.DictReader(f)}
+            else:
+                rows = json.load(f)
+
+        return {
+            directory: {field: str(fields[field]) for field in Retagger.FIELDS if fields.get(field)}
+            for directory, fields in rows.items()
+        }
+
+    def find_tracks(self, mapping):
+        """
+        Returns the (path, fields) of every .mp3 file beneath the mapping's directories. Where directories are nested
+        (e.g. an artist and one of their albums), the more specific directory's fields win.
+        """
+
+        tracks = {}
+
+        for directory in sorted(mapping, key=lambda d: len(os.path.normpath(d))):
+            if not os.path.isdir(directory):
+                print(f"WARNING: '{directory}' is not a directory.")
+                continue
+
+            for root, directories, files in os.walk(directory):
+                for file in sorted(files):
+                    path = os.path.join(root, file)
+
+                    if file.lower().endswith(".mp3"):
+                        tracks.setdefault(path, {}).update(mapping[directory])
+                    elif file.lower().endswith(".flac"):
+                        print(f"WARNING: retagging .flac files isn't supported yet; skipped '{path}'.")
+
+        return sorted(tracks.items())
+
+    def retag(self, mapping):
+        """
+        Retags every track beneath the mapping's directories that needs it.
+
+        :return: How many tracks were "unchanged", written "in_place", "rewritten", (would have been) "changed" in a
+            dry run, or "failed".
+        """
+
+        tracks = self.find_tracks(mapping)
+        retag_file = functools.partial(Retagger.retag_file, dry_run=self.dry_run)
+        paths, fields = [path for path, f in tracks], [f for path, f in tracks]
+
+        with metrics.phase("retagging"):
+            if self.jobs == 1 or len(tracks) <= 1:
+                results = list(map(retag_file, paths, fields))
+            else:
+                with TagExtractor.POOLS[self.pool](max_workers=self.jobs) as executor:
+                    chunksize = 1 if self.pool == "thread" else max(1, len(tracks) // (self.jobs * 4))
+                    results = list(executor.map(retag_file, paths, fields, chunksize=chunksize))
+
+        summary = Counter()
+
+        for path, (status, changes) in zip(paths, results):
+            summary[status] += 1
+            metrics.count(f"tracks_{status}")
+
+            if status == "failed":
+                print(f"ERROR: failed to retag '{path}': {changes}")
+            elif status != "unchanged" and self.verbose:
+                verb = "would update" if status == "changed" else "updated"
+                print(f"INFO: {verb} {', '.join(f'{k} to {v!r}' for k, v in changes.items())} in '{path}'.")
+
+        print(
+            f"INFO: Retagged {summary['in_place'] + summary['rewritten']} tracks ({summary['in_place']} in place); "
+            f"{summary['unchanged']} were already correct."
+        )
+
+        return dict(summary)
+
+    @staticmethod
+    def retag_file(path, fields, dry_run=False):
+        """
+        Brings a single .mp3 file's tag in line with `fields` (a function of just its arguments, so it can run in a
+        worker process).
+
+        :return: (status, changes) - where status is one of "unchanged", "changed" (dry runs), "in_place",
+            "rewritten" or "failed" (with an error message in place of the changes).
+        """
+
+        try:
+            tag = id3.Tag()
+
+            if not tag.parse(path):
+                tag = id3.Tag()
+
+            changes = Retagger.get_changes(tag, fields)
+
+            if not changes or dry_run:
+                return ("changed" if changes else "unchanged"), changes
+
+            if "artist" in changes:
+                tag.artist = changes["artist"]
+
+            if "album_artist" in changes:
+                tag.album_artist = changes["album_artist"]
+
+            if "album" in changes:
+                tag.album = changes["album"]
+
+            if "year" in changes:
+                tag.recording_date = changes["year"]
+
+            is_id3v2 = tag.file_info is not None and tag.version[0] == 2
+            tag_size = tag.file_info.tag_size if is_id3v2 else None
+
+            tag.save(path, version=tag.version if is_id3v2 else id3.ID3_V2_4)
+
+            # eyed3 only rewrites the whole file when the new tag doesn't fit into the old one
+            return ("in_place" if tag_size == tag.file_info.tag_size else "rewritten"), changes
+
+        except Exception as e:
+            return "failed", str(e)
+
+    @staticmethod
+    def get_changes(tag, fields):
+        """
+        Returns the fields (of a parsed `id3.Tag`) that differ from `fields`. Like the artist, the album artist is
+        set to the mapped artist.
+        """
+
+        changes = {}
+
+        if fields.get("artist"):
+            if tag.artist != fields["artist"]:
+                changes["artist"] = fields["artist"]
+
+            if tag.album_artist != fields["artist"]:
+                changes["album_artist"] = fields["artist"]
+
+        if fields.get("album") and tag.album != fields["album"]:
+            changes["album"] = fields["album"]
+
+        if fields.get("year") and str(tag.recording_date or "") != fields["year"]:
+            changes["year"] = fields["year"]
+
+        return changes
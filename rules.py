@@ -0,0 +1,282 @@
+from models import (
+    VALID_YEAR_AND_HYPHEN_REGEX, DOUBLE_LEADING_YEAR_REGEX, YYYY_MM_DD_AND_TITLE_REGEX, is_lowercase
+)
+from plan import Plan
+from metrics import metrics
+
+
+class Rule:
+    """
+    A single, declarative validation rule: a check that flags the directories breaking it, and what to do about them.
+
+    Name rules only look at basenames (so a whole batch of names can be checked without touching the disk); content
+    rules look at a directory's listing, through its snapshot.
+    """
+
+    ACTIONS = ("rename", "delete", "warn")
+
+    def __init__(self, name, behavior, action, check_name=None, check_directory=None, fix=None, description=None):
+        """
+        :param name: e.g. "lowercase".
+        :param behavior: The `album_validation_behavior` ("force", "prompt" or "skip") that applies to this rule - or
+            None, if it's only ever warned about.
+        :param action: "rename", "delete" or "warn".
+        :param check_name: basename -> whether it breaks this rule.
+        :param check_directory: `Directory` -> whether it breaks this rule (for rules that need more than a name).
+        :param fix: (basename, `Directory` or None) -> the basename it should be renamed to, or None if that can't be
+            worked out. Only for "rename" rules.
+        :param description: How to describe a directory that breaks this rule, e.g. "is empty".
+        """
+
+        if action not in Rule.ACTIONS:
+            raise ValueError(f"'{action}' is not a valid action; expected one of {Rule.ACTIONS}.")
+
+        self.name = name
+        self.behavior = behavior
+        self.action = action
+        self.check_name = check_name
+        self.check_directory = check_directory
+        self.fix = fix
+        self.description = description or f"breaks the '{name}' rule"
+
+    @property
+    def is_name_rule(self):
+        return self.check_name is not None
+
+    def check(self, directory):
+        if self.is_name_rule:
+            return self.check_name(directory.basename)
+
+        return self.check_directory(directory)
+
+
+def fix_double_leading_year(basename, directory=None):
+    return basename[7:]
+
+
+def fix_yyyy_mm_dd(basename, directory=None):
+    match = YYYY_MM_DD_AND_TITLE_REGEX.match(basename)
+    return f"{match.group(1)} - {match.group(2)}" if match else None
+
+
+def fix_year_plus_title(basename, directory=None):
+    """
+    Renames an album as '<year> - <title>', from what can be inferred of it (see `AlbumDirectory.assumed_year` and
+    `assumed_title`).
+    """
+
+    if directory is None:
+        return None
+
+    year, title = directory.assumed_year, directory.assumed_title
+
+    if not year or not title or title == "none":
+        return None
+
+    new_basename = f"{str(year)[:4]} - {title.replace('/', '_')}"
+
+    return new_basename if VALID_YEAR_AND_HYPHEN_REGEX.match(new_basename) else None
+
+
+def has_loose_files(directory):
+    subdirs, files = directory.listdir()
+    return len(files) > 0
+
+
+def is_empty(directory):
+    subdirs, files = directory.listdir()
+    return len(subdirs) + len(files) == 0
+
+
+# rules run in order, and each sees the names left by the ones before it (e.g. '1979 - 1979 - Closer' loses its
+# double year before it's checked for year-plus-title, then for uppercase letters)
+ALBUM_RULES = [
+    Rule(
+        "double_leading_year", "rename_as_year_plus_title", "rename",
+        check_name=lambda name: DOUBLE_LEADING_YEAR_REGEX.match(name) is not None, fix=fix_double_leading_year,
+        description="has a double leading year"
+    ),
+    Rule(
+        "yyyy_mm_dd", "rename_as_year_plus_title", "rename",
+        check_name=lambda name: YYYY_MM_DD_AND_TITLE_REGEX.match(name) is not None, fix=fix_yyyy_mm_dd,
+        description="is in yyyy-mm-dd format"
+    ),
+    Rule(
+        "year_plus_title", "rename_as_year_plus_title", "rename",
+        check_name=lambda name: VALID_YEAR_AND_HYPHEN_REGEX.match(name) is None, fix=fix_year_plus_title,
+        description="isn't in 'year - title' format"
+    ),
+    Rule(
+        "lowercase", "rename_as_lowercase", "rename",
+        check_name=lambda name: not is_lowercase(name), fix=lambda name, directory=None: name.lower(),
+        description="looks like it has uppercase letters"
+    ),
+    Rule("empty", "remove_empty_folders", "delete", check_directory=is_empty, description="is empty"),
+]
+
+ARTIST_RULES = [
+    Rule(
+        "lowercase", "rename_as_lowercase", "rename",
+        check_name=lambda name: not is_lowercase(name), fix=lambda name, directory=None: name.lower(),
+        description="looks like it has uppercase letters"
+    ),
+    Rule("empty", "remove_empty_folders", "delete", check_directory=is_empty, description="is empty"),
+    Rule("loose_files", None, "warn", check_directory=has_loose_files, description="has loose files"),
+]
+
+
+class RuleEngine:
+    """
+    Evaluates a list of `Rule`s over a whole batch of directories (or bare basenames) at once - one rule at a time,
+    rather than one directory at a time - and fixes what breaks them as `album_validation_behavior` says: "force" fixes
+    them, "prompt" asks about all of a rule's fixes at once, and "skip" leaves them be.
+    """
+
+    BEHAVIORS = ("force", "prompt", "skip")
+
+    def __init__(self, behavior, rules=None, overrides=None):
+        """
+        :param behavior: The `album_validation_behavior` from `LydiaConfig`.
+        :param rules: The rules to evaluate (defaults to `ALBUM_RULES`).
+        :param overrides: {rule name: "force", "prompt", "skip" or "warn"} for rules whose policy doesn't come from
+            `behavior` (e.g. removing empty artists, which only `--force` does).
+        """
+
+        self.rules = ALBUM_RULES if rules is None else rules
+        self.policies = {}
+
+        for rule in self.rules:
+            if overrides and rule.name in overrides:
+                self.policies[rule.name] = overrides[rule.name]
+                continue
+
+            policy = behavior.get(rule.behavior, "skip") if rule.behavior else "warn"
+
+            if rule.behavior and policy not in RuleEngine.BEHAVIORS:
+                raise ValueError(
+                    f"'{policy}' is not a valid behavior for '{rule.behavior}'; expected one of {RuleEngine.BEHAVIORS}."
+                )
+
+            self.policies[rule.name] = policy
+
+    def validate_names(self, basenames):
+        """
+        Checks a batch of basenames against every name rule, without touching the disk.
+
+        :return: {rule name: [the basenames that break it]}.
+        """
+
+        with metrics.phase("validation"):
+            return {
+                rule.name: [name for name in basenames if rule.check_name(name)]
+                for rule in self.rules if rule.is_name_rule
+            }
+
+    def validate(self, directories):
+        """
+        Checks a batch of `Directory`s against every rule (as they are now; see `apply` for rules that build on each
+        other).
+
+        :return: {rule name: [the directories that break it]}.
+        """
+
+        with metrics.phase("validation"):
+            return {rule.name: [d for d in directories if d.path and rule.check(d)] for rule in self.rules}
+
+    def get_errors(self, directories):
+        """
+        Checks a batch of `Directory`s against every rule, like `validate`.
+
+        :return: The names of the rules each directory breaks, in the same order as `directories`.
+        """
+
+        broken = {name: {id(d) for d in directories} for name, directories in self.validate(directories).items()}
+
+        return [[rule.name for rule in self.rules if id(d) in broken[rule.name]] for d in directories]
+
+    def apply(self, directories, plan=None):
+        """
+        Checks a batch of `Directory`s against each rule in turn, and fixes them as their rules' behaviors say.
+
+        :param plan: If given, renames and deletes are added to this `Plan` rather than carried out; its `prompts` say
+            whether "prompt" behaviors still ask (see `Plan.PROMPTS`).
+        :return: {rule name: the number of directories fixed}.
+        """
+
+        fixed = {}
+
+        for rule in self.rules:
+            policy = self.policies[rule.name]
+
+            if policy == "skip":
+                continue
+
+            with metrics.phase("validation"):
+                broken = [d for d in directories if d.path and rule.check(d)]
+
+            if policy == "warn":
+                for directory in broken:
+                    print(f"WARNING: '{directory.path}' {rule.description}.")
+                continue
+
+            if rule.action == "rename":
+                changes = [(d, rule.fix(d.basename, d)) for d in broken]
+
+                for directory, new_basename in changes:
+                    if not new_basename:
+                        print(f"WARNING: '{directory.path}' {rule.description}, but can't be renamed automatically.")
+
+                changes = [(d, new_basename) for d, new_basename in changes if new_basename not in (None, d.basename)]
+            else:
+                changes = [(d, None) for d in broken]
+
+            if changes and policy == "prompt":
+                prompts = Plan.get_prompts(plan)
+
+                if prompts == "skip":
+                    RuleEngine.report_skipped(rule, changes)
+                    continue
+
+                if prompts == "ask" and not RuleEngine.confirm(rule, changes):
+                    continue
+
+            fixed[rule.name] = 0
+
+            for directory, new_basename in changes:
+                try:
+                    if rule.action == "rename":
+                        directory.rename(new_basename, prompt=False, plan=plan)
+                    else:
+                        directory.delete(prompt=False, plan=plan)
+                except OSError as e:
+                    print(f"ERROR: failed to fix '{directory.path}' ({rule.description}).")
+                    print(e)
+                    continue
+
+                fixed[rule.name] += 1
+
+        return fixed
+
+    @staticmethod
+    def report_skipped(rule, changes):
+        print(f"WARNING: skipped {len(changes)} '{rule.name}' fixes, since they need to be confirmed:")
+
+        for directory, new_basename in changes:
+            print(f"    {directory.path}" + (f" -> {new_basename}" if new_basename else ""))
+
+    @staticmethod
+    def confirm(rule, changes):
+        if rule.action == "rename":
+            print(f"Would you like to rename these {len(changes)} folders ({rule.name})?")
+        else:
+            print(f"Would you like to delete these {len(changes)} folders?")
+
+        for directory, new_basename in changes:
+            print(f"    {directory.path}" + (f" -> {new_basename}" if new_basename else ""))
+
+        if input().lower() not in ("y", "yes"):
+            print(f"Okay, I won't {rule.action} these.")
+            return False
+
+        print("Okay, will do!")
+        return True
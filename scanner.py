@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from models import Mp3, Track
+from metrics import metrics
+from snapshot import LibrarySnapshot, SnapshotDirectory
+
+
+class FileSystem:
+    """
+    The (blocking) file system calls an `AsyncScanner` makes - one call per directory listing and per tag read.
+    """
+
+    def scandir(self, path):
+        """
+        Returns a directory's mtime, its subdirectories' names and its files' {name: (size, mtime)}.
+        """
+
+        mtime = os.stat(path).st_mtime_ns
+        directories, files = [], {}
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # symlinks to directories are listed as files, as in `LibrarySnapshot.scan`
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.name)
+                else:
+                    files[entry.name] = LibrarySnapshot.stat_file(entry)
+
+        return mtime, directories, files
+
+    def read_tag_fields(self, path, backend="native"):
+        return Track.read_tag_fields(path, backend=backend)
+
+
+class LatencyFileSystem(FileSystem):
+    """
+    A `FileSystem` that adds a fixed delay to every call - standing in for a high-latency network share - and keeps
+    track of how many calls were in flight at once.
+    """
+
+    def __init__(self, latency=0.01):
+        """
+        :param latency: The number of seconds every call takes (on top of the actual work).
+        """
+
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.calls += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            time.sleep(self.latency)
+            return function(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def scandir(self, path):
+        return self.call(FileSystem.scandir, self, path)
+
+    def read_tag_fields(self, path, backend="native"):
+        return self.call(FileSystem.read_tag_fields, self, path, backend=backend)
+
+
+class AsyncScanner:
+    """
+    Builds a `LibrarySnapshot` with many directory listings (and tag reads) in flight at once, for file systems where
+    every call is slow but many can run in parallel (e.g. SMB/NFS shares). Blocking calls run on a thread pool; an
+    asyncio event loop keeps up to `concurrency` of them busy.
+
+    The resulting snapshot feeds lydia's validators and migrations as usual - without any further listings, and with
+    the tags that were read already attached.
+    """
+
+    def __init__(self, file_system=None, concurrency=32, tags="first", catalog=None):
+        """
+        :param file_system: The `FileSystem` to scan (defaults to the local one).
+        :param concurrency: The maximum number of calls in flight at once.
+        :param tags: Which tracks' tags to read while scanning: "first" (the first track in each directory - all that
+            lydia needs to infer an album's artist/year/title), "all" or "none".
+        :param catalog: An optional `Catalog`; tracks with up-to-date entries aren't read again.
+        """
+
+        if tags not in ("first", "all", "none"):
+            raise ValueError(f"'{tags}' is not a valid tags option; expected 'first', 'all' or 'none'.")
+
+        self.file_system = file_system or FileSystem()
+        self.concurrency = max(1, concurrency)
+        self.tags = tags
+        self.catalog = catalog
+
+    def scan(self, snapshot, *paths):
+        """
+        Scans each of `paths` into `snapshot` (replacing whatever it held for them).
+        """
+
+        with metrics.phase("scan"):
+            roots = asyncio.run(self.scan_paths([os.path.normpath(p) for p in paths]))
+
+        for path, root in roots.items():
+            snapshot.roots[path] = root
+
+        return snapshot
+
+    async def scan_paths(self, paths):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            self.executor = executor
+            roots = await asyncio.gather(*(self.scan_directory(path, os.path.basename(path)) for path in paths))
+
+        return dict(zip(paths, roots))
+
+    async def call(self, function, *args):
+        # the semaphore is only held for the blocking call itself, never while waiting on subdirectories
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def scan_directory(self, path, name):
+        mtime, directory_names, files = await self.call(self.file_system.scandir, path)
+
+        metrics.count("directories_visited")
+        metrics.count("files_stated", len(files))
+
+        directory = SnapshotDirectory(name, mtime)
+        directory.files = files
+
+        tracks = sorted(f for f in files if Track.get_track_type(f))
+        tracks = tracks[:1] if self.tags == "first" else tracks if self.tags == "all" else []
+
+        subdirectories = await asyncio.gather(
+            *(self.scan_subdirectory(os.path.join(path, n), n) for n in directory_names),
+            *(self.read_tag_fields(directory, path, name) for name in tracks)
+        )
+
+        for subdirectory in subdirectories[:len(directory_names)]:
+            if subdirectory is not None:
+                directory.directories[subdirectory.name] = subdirectory
+
+        return directory
+
+    async def scan_subdirectory(self, path, name):
+        try:
+            return await self.scan_directory(path, name)
+        except OSError as e:
+            print(f"WARNING: could not scan '{path}'.")
+            print(e)
+
+    async def read_tag_fields(self, directory, path, name):
+        size, mtime = directory.files[name]
+        track_path = os.path.join(path, name)
+
+        fields = self.catalog.get_tag_fields(track_path, size, mtime) if self.catalog else None
+
+        if fields is None:
+            try:
+                fields = await self.call(self.file_system.read_tag_fields, track_path, Mp3.tag_backend)
+            except Exception as e:
+                print(f"WARNING: could not read the tags of '{track_path}'.")
+                print(e)
+                return
+
+            metrics.count("tags_parsed")
+
+            if self.catalog:
+                self.catalog.put_tag_fields(track_path, size, mtime, fields)
+
+        directory.tags[name] = fields
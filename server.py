@@ -0,0 +1,292 @@
+import io
+import os
+import hmac
+import json
+import stat
+import shlex
+import threading
+import contextlib
+import socketserver
+
+from plan import Plan
+from metrics import metrics
+from watch import InotifyEventSource, PollingEventSource
+
+
+class LydiaRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request per line and writes one JSON response per line, until the client hangs up. The connection
+    is closed on the first line that isn't a JSON object (or doesn't carry the server's token), so that nothing which
+    merely reaches the port - e.g. a web page POSTing to localhost - gets any of its lines run.
+    """
+
+    def handle(self):
+        lydia_server = self.server.lydia_server
+
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.respond({"ok": False, "error": f"invalid request: {e}"})
+                break
+
+            if not isinstance(request, dict):
+                self.respond({"ok": False, "error": "invalid request: expected a JSON object"})
+                break
+
+            if not lydia_server.is_authorized(request.pop("token", None)):
+                self.respond({"ok": False, "error": "invalid request: missing or wrong token"})
+                break
+
+            self.respond(lydia_server.handle(request))
+
+            if lydia_server.stopping:
+                break
+
+    def respond(self, response):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+# Unix sockets aren't available everywhere (e.g. on older versions of Windows), where only `--port` works
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixServer(socketserver.UnixStreamServer):
+        pass
+
+
+class TcpServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class LydiaServer:
+    """
+    Keeps a `Lydia` (its snapshot, catalog and query index) warm between commands, and serves commands to clients
+    (see `client.py`) over a Unix socket or a localhost TCP port - one JSON object per line each way.
+
+    Requests are handled one at a time, on the thread that called `serve_forever`. A background thread watches the
+    library (with inotify, or by polling) and only the directories that changed are re-read before the next command.
+    """
+
+    COMMANDS = (
+        "ping", "clean_artists", "clean_albums", "stage", "unstage", "inventory", "query", "lookup", "refresh",
+        "shutdown"
+    )
+
+    # commands that change the library (after which the query indexes are out of date)
+    MUTATING_COMMANDS = ("clean_artists", "clean_albums", "stage", "unstage")
+
+    def __init__(self, lydia, address, token=None, event_source=None, watch=True):
+        """
+        :param lydia: The `Lydia` to run commands with.
+        :param address: A Unix socket path, or a (host, port) tuple to listen on.
+        :param token: The secret every request must carry (as "token"). Required for TCP, which - unlike a Unix
+            socket - any local process (or web page) can connect to.
+        :param event_source: Where library changes come from (defaults to inotify, falling back to polling).
+        :param watch: Whether to watch the library for changes at all.
+        """
+
+        if isinstance(address, tuple) and not token:
+            raise ValueError("A token is required to serve over TCP.")
+
+        self.lydia = lydia
+        self.address = address
+        self.token = token
+        self.stopping = False
+
+        self.query_index = None
+        self.changed_paths = set()
+        self.lock = threading.Lock()
+
+        self.roots = [
+            os.path.normpath(d) for d in (
+                lydia.config.artists_directory, lydia.config.albums_directory, lydia.config.staging_directory
+            ) if d and os.path.isdir(d)
+        ]
+
+        if isinstance(address, tuple):
+            self.server = TcpServer(address, LydiaRequestHandler)
+        elif not LydiaServer.supports_unix_sockets():
+            raise ValueError("Unix sockets aren't supported on this platform; listen on a port instead.")
+        else:
+            if os.path.lexists(address):
+                if not LydiaServer.is_socket(address):
+                    raise FileExistsError(f"'{address}' already exists, and isn't a socket.")
+
+                os.remove(address)  # left behind by a server that didn't shut down cleanly
+
+            self.server = UnixServer(address, LydiaRequestHandler)
+
+        self.server.lydia_server = self
+
+        self.event_source = event_source
+
+        if watch and event_source is None:
+            self.event_source = InotifyEventSource(self.roots) if InotifyEventSource.is_supported() \
+                else PollingEventSource(self.roots, interval=30.0, track_files=[])
+
+        if self.event_source:
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    def is_authorized(self, token):
+        return not self.token or (isinstance(token, str) and hmac.compare_digest(token.encode(), self.token.encode()))
+
+    @staticmethod
+    def is_socket(path):
+        return os.path.lexists(path) and stat.S_ISSOCK(os.lstat(path).st_mode)
+
+    @staticmethod
+    def supports_unix_sockets():
+        return hasattr(socketserver, "UnixStreamServer")
+
+    def watch(self):
+        while not self.stopping:
+            paths = self.event_source.read(timeout=1.0)
+
+            if paths:
+                with self.lock:
+                    self.changed_paths.update(paths)
+
+    def serve_forever(self):
+        print(f"INFO: Serving on {self.address}...")
+
+        # the whole library is scanned once, up front; afterwards, only what changes is read again
+        for root in self.roots:
+            self.lydia.snapshot.get(root)
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        self.server.server_close()
+
+        if self.event_source:
+            self.event_source.close()
+
+        if not isinstance(self.address, tuple) and LydiaServer.is_socket(self.address):
+            os.remove(self.address)
+
+    def refresh(self):
+        """
+        Re-reads the directories that changed since the last command (and drops the query index if anything did).
+
+        :return: The number of directories re-read.
+        """
+
+        with self.lock:
+            paths, self.changed_paths = self.changed_paths, set()
+
+        directories = set()
+
+        for path in paths:
+            directories.add(os.path.dirname(path))
+
+            if os.path.isdir(path):
+                directories.add(path)
+
+        # parents first, so that a new directory is scanned whole (once) rather than synced level by level
+        for directory in sorted(directories, key=len):
+            self.lydia.snapshot.sync(directory)
+
+        if directories:
+            self.invalidate()
+
+        return len(directories)
+
+    def invalidate(self):
+        """
+        Drops the query indexes, so that they're rebuilt (from the snapshot) the next time they're needed.
+        """
+
+        self.query_index = None
+        self.lydia.index = None
+
+    def handle(self, request):
+        """
+        Runs a single command, capturing everything it prints.
+
+        :param request: {"command": one of `COMMANDS`, ...its arguments}.
+        :return: {"ok": whether it succeeded, "output": what it printed, "result": what it returned} - or {"ok":
+            False, "error": why not}.
+        """
+
+        command = request.get("command")
+
+        if command not in LydiaServer.COMMANDS:
+            return {"ok": False, "error": f"'{command}' is not a valid command; expected one of {LydiaServer.COMMANDS}"}
+
+        output = io.StringIO()
+
+        try:
+            with contextlib.redirect_stdout(output), metrics.phase(f"serve_{command}"):
+                self.refresh()
+                result = getattr(self, f"run_{command}")(**{k: v for k, v in request.items() if k != "command"})
+
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}", "output": output.getvalue()}
+
+        finally:
+            # even a command that failed part-way may have changed the library
+            if command in LydiaServer.MUTATING_COMMANDS:
+                self.invalidate()
+
+            if self.lydia.catalog:
+                self.lydia.catalog.commit()
+
+        return {"ok": result is not False, "output": output.getvalue(), "result": result}
+
+    def run_ping(self):
+        return "pong"
+
+    def run_clean_artists(self, force=False):
+        # commands run as a batch (planned, then applied); there's nobody to answer prompts, so changes that need
+        # confirming are skipped (and reported) rather than made
+        plan = Plan(prompts="skip")
+        self.lydia.clean_artists_directory(force, plan=plan)
+
+        return self.lydia.apply_plan(plan)
+
+    def run_clean_albums(self):
+        plan = Plan(prompts="skip")
+        self.lydia.clean_albums_directory(plan=plan)
+
+        return self.lydia.apply_plan(plan)
+
+    def run_stage(self):
+        self.lydia.migrate_albums_to_staging_directory()
+
+    def run_unstage(self):
+        self.lydia.migrate_staging_to_albums_directory()
+
+    def run_inventory(self, incremental=False, gzip=False):
+        if incremental:
+            return self.lydia.update_inventory(compress=gzip)
+
+        self.lydia.create_inventory()
+
+    def run_query(self, query):
+        if self.query_index is None:
+            self.query_index = self.lydia.build_query_index()
+
+        return [str(album) for album in self.query_index.query(query)]
+
+    def run_lookup(self, artist=None, album=None):
+        terms = [f"{field}:{shlex.quote(value)}" for field, value in (("artist", artist), ("title", album)) if value]
+        return self.run_query(" ".join(terms))
+
+    def run_refresh(self):
+        self.lydia.snapshot.roots.clear()
+        self.invalidate()
+
+        for root in self.roots:
+            self.lydia.snapshot.get(root)
+
+    def run_shutdown(self):
+        self.stopping = True
+
+        # `shutdown` waits for `serve_forever` to return, so it can't be called from the thread running it
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
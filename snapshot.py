@@ -0,0 +1,304 @@
+import os
+
+from metrics import metrics
+
+
+class SnapshotDirectory:
+    """
+    A single directory in a `LibrarySnapshot`.
+    """
+
+    __slots__ = ("name", "mtime", "directories", "files", "origin", "tags")
+
+    def __init__(self, name, mtime):
+        """
+        :param name: The basename of this directory.
+        :param mtime: The directory's modification time (in nanoseconds).
+        """
+
+        self.name = name
+        self.mtime = mtime
+        self.directories = {}  # name -> SnapshotDirectory
+        self.files = {}  # name -> (size, mtime)
+        self.origin = None  # where this directory really is on disk, while a rename/move of it is only planned
+        self.tags = {}  # name -> tag fields, for any tracks whose tags were read while scanning (see `AsyncScanner`)
+
+
+class LibrarySnapshot:
+    """
+    An in-memory picture of one or more directory trees (names, entry types, sizes and mtimes), built with a single
+    `os.scandir` pass per directory. `Directory` objects (and their validators) read from a snapshot instead of hitting
+    the file system over and over again.
+    """
+
+    def __init__(self, *paths):
+        """
+        :param paths: The root directories to scan.
+        """
+
+        self.roots = {}
+
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        """
+        Scans (or re-scans) the tree beneath `path` and adds it to this snapshot.
+        """
+
+        path = os.path.normpath(path)
+
+        with metrics.phase("scan"):
+            self.roots[path] = LibrarySnapshot.scan(path)
+
+        return self.roots[path]
+
+    @staticmethod
+    def scan(path):
+        directory = SnapshotDirectory(os.path.basename(path), os.stat(path).st_mtime_ns)
+        metrics.count("directories_visited")
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # like `os.walk`, symlinks to directories are never followed (a link to a parent would never end);
+                # they're listed as files
+                if entry.is_dir(follow_symlinks=False):
+                    try:
+                        directory.directories[entry.name] = LibrarySnapshot.scan(entry.path)
+                    except OSError as e:
+                        print(f"WARNING: could not scan '{entry.path}'.")
+                        print(e)
+                else:
+                    directory.files[entry.name] = LibrarySnapshot.stat_file(entry)
+                    metrics.count("files_stated")
+
+        return directory
+
+    @staticmethod
+    def stat_file(entry):
+        """
+        Returns a file's (size, mtime) - a symlink's target's, unless it's dangling.
+        """
+
+        try:
+            stat = entry.stat()
+        except OSError:
+            stat = entry.stat(follow_symlinks=False)
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def find(self, path):
+        """
+        Returns the (parent, SnapshotDirectory) found at `path`, or (None, None) if `path` is not in this snapshot.
+        """
+
+        path = os.path.normpath(path)
+
+        for root_path, root in self.roots.items():
+            if path == root_path:
+                return None, root
+
+            if path.startswith(root_path.rstrip(os.sep) + os.sep):
+                parent, directory = None, root
+
+                for name in path[len(root_path):].strip(os.sep).split(os.sep):
+                    parent, directory = directory, directory.directories.get(name)
+
+                    if directory is None:
+                        return None, None
+
+                return parent, directory
+
+        return None, None
+
+    def get(self, path):
+        """
+        Returns the SnapshotDirectory at `path`, scanning it from disk first if it isn't part of this snapshot yet.
+        """
+
+        parent, directory = self.find(path)
+
+        if directory is None:
+            directory = self.add(path)
+
+        return directory
+
+    def listdir(self, path):
+        """
+        Returns the (subdirectories, files) directly inside `path`.
+        """
+
+        directory = self.get(path)
+        return list(directory.directories), list(directory.files)
+
+    def walk(self, path):
+        """
+        A drop-in replacement for `os.walk` (top-down) that reads from this snapshot.
+        """
+
+        try:
+            directory = self.get(path)
+        except OSError:
+            return
+
+        yield from LibrarySnapshot.walk_directory(path, directory)
+
+    @staticmethod
+    def walk_directory(path, directory):
+        yield path, list(directory.directories), list(directory.files)
+
+        for name, subdirectory in directory.directories.items():
+            yield from LibrarySnapshot.walk_directory(os.path.join(path, name), subdirectory)
+
+    def stat(self, path):
+        """
+        Returns the (size, mtime) of a file, or None if it isn't part of this snapshot.
+        """
+
+        parent, directory = self.find(os.path.dirname(path))
+
+        if directory is None:
+            return None
+
+        return directory.files.get(os.path.basename(path))
+
+    def sync(self, path):
+        """
+        Brings a single directory's entries up to date with the disk: new subdirectories are scanned (whole), missing
+        ones are dropped and files are re-stat'ed - but subdirectories that are still there are kept as they are.
+
+        :return: The up-to-date SnapshotDirectory, or None if `path` isn't part of this snapshot (or no longer exists).
+        """
+
+        parent, directory = self.find(path)
+
+        if directory is None:
+            return None
+
+        if not os.path.isdir(path):
+            self.remove(path)
+            return None
+
+        directories, files = {}, {}
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                elif entry.name in directory.directories:
+                    directories[entry.name] = directory.directories[entry.name]
+                else:
+                    directories[entry.name] = LibrarySnapshot.scan(entry.path)
+
+        metrics.count("directories_visited")
+        metrics.count("files_stated", len(files))
+
+        directory.mtime = os.stat(path).st_mtime_ns
+        directory.tags = {name: t for name, t in directory.tags.items() if files.get(name) == directory.files.get(name)}
+        directory.directories, directory.files = directories, files
+
+        return directory
+
+    def settle(self):
+        """
+        Marks every planned rename/move as carried out (i.e. once a `Plan` has been applied).
+        """
+
+        for root in self.roots.values():
+            stack = [root]
+
+            while stack:
+                directory = stack.pop()
+                directory.origin = None
+                stack.extend(directory.directories.values())
+
+    def get_tag_fields(self, path):
+        """
+        Returns the tag fields of a track if they were read while scanning, or None.
+        """
+
+        parent, directory = self.find(os.path.dirname(path))
+
+        if directory is None:
+            return None
+
+        return directory.tags.get(os.path.basename(path))
+
+    def get_disk_path(self, path):
+        """
+        Returns where `path` currently is on disk, which only differs from `path` while a rename/move of it (or of one
+        of its parents) is planned but not yet applied.
+        """
+
+        path = os.path.normpath(path)
+
+        for root_path, root in self.roots.items():
+            if path != root_path and not path.startswith(root_path.rstrip(os.sep) + os.sep):
+                continue
+
+            disk_path, directory = root.origin or root_path, root
+
+            for name in path[len(root_path):].strip(os.sep).split(os.sep) if path != root_path else []:
+                directory = directory.directories.get(name) if directory else None
+
+                if directory is not None and directory.origin:
+                    disk_path = directory.origin
+                else:
+                    disk_path = os.path.join(disk_path, name)
+
+            return disk_path
+
+        return path
+
+    def relocate(self, old_path, new_path, planned=False):
+        """
+        Mirrors a rename/move of the directory at `old_path` to `new_path`.
+
+        :param planned: Whether the rename/move has only been planned (so the directory is still at `old_path` on disk).
+        """
+
+        origin = self.get_disk_path(old_path) if planned else None
+        parent, directory = self.find(old_path)
+
+        if directory is None:
+            return
+
+        directory.origin = origin
+
+        if parent is not None:
+            del parent.directories[directory.name]
+        else:
+            del self.roots[os.path.normpath(old_path)]
+
+        new_parent_path, directory.name = os.path.split(os.path.normpath(new_path))
+        new_grandparent, new_parent = self.find(new_parent_path)
+
+        if new_parent is not None:
+            new_parent.directories[directory.name] = directory
+
+    def remove(self, path):
+        """
+        Mirrors a delete of the directory at `path`.
+        """
+
+        parent, directory = self.find(path)
+
+        if directory is None:
+            return
+
+        if parent is not None:
+            del parent.directories[directory.name]
+        else:
+            del self.roots[os.path.normpath(path)]
+
+    def mkdir(self, path):
+        """
+        Mirrors the creation of an (empty) directory at `path`.
+        """
+
+        parent_path, name = os.path.split(os.path.normpath(path))
+        grandparent, parent = self.find(parent_path)
+
+        if parent is not None and name not in parent.directories:
+            parent.directories[name] = SnapshotDirectory(name, os.stat(path).st_mtime_ns)
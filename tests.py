@@ -1,11 +1,73 @@
+import os
+import re
+import gzip
+import hashlib
+import json
+import sys
+import shutil
+import socket
+import subprocess
+import inspect
+import contextlib
+import io
+import gc
+import tempfile
+import threading
 import unittest
+from unittest import mock
+
+from eyed3 import id3
+
+from benchmarks import Benchmark, SyntheticLibrary
+from catalog import Catalog
+from client import send
+from covers import CoverCache
+from duplicates import DuplicateFinder
+from lydia import Lydia
+from metrics import metrics
 from eyed3_utils import Eyed3Utils
+from index import LibraryIndex
+from inventory import Inventory
+from journal import MigrationJournal
+from models import AlbumDirectory, ArtistDirectory, Flac, Id3v2Reader, Mp3, is_lowercase
+from plan import Plan, OperationType
+from prune import Pruner
+from query import QueryIndex
+from retag import Retagger
+from rules import RuleEngine
+from server import LydiaServer
+from scanner import AsyncScanner, LatencyFileSystem
+from snapshot import LibrarySnapshot
+from transport import LinkTransport, MigrationTransport
+from watch import AlbumWatcher, InotifyEventSource, PollingEventSource
+from workers import TagExtractor
+
+
+def create_mp3(path, artist=None, album=None, year=None, audio=b"\x00" * 413):
+    """
+    Writes a tiny (single silent MPEG frame) .mp3 file carrying an ID3v2 tag.
+    """
+
+    with open(path, "wb") as f:
+        f.write(b"\xff\xfb\x90\x64" + audio)
+
+    tag = id3.Tag()
+    tag.artist = artist
+    tag.album = album
+    tag.recording_date = year
+    tag.save(path)
 
 
 class LydiaTests(unittest.TestCase):
 
     eyed3_utils = Eyed3Utils()
 
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
     def test_fix_idv3_metadata(self):
         artist_directory = ""
         album_directory = ""
@@ -18,3 +80,1130 @@ class LydiaTests(unittest.TestCase):
 
         self.assertTrue(True)
 
+    def test_catalog_skips_parsing_unchanged_mp3s(self):
+        album_path = os.path.join(self.directory, "Closer")
+        os.mkdir(album_path)
+        create_mp3(os.path.join(album_path, "01 - Atrocity Exhibition.mp3"), "Joy Division", "Closer", "1980")
+
+        catalog = Catalog(os.path.join(self.directory, "catalog.db"))
+
+        album = AlbumDirectory(album_path, validate=False, catalog=catalog)
+        self.assertEqual(album.assumed_artist, "joy division")
+        self.assertEqual(album.assumed_year, "1980")
+
+        with mock.patch.object(id3.Tag, "parse") as parse:
+            album = AlbumDirectory(album_path, validate=False, catalog=catalog)
+            self.assertEqual(album.assumed_artist, "joy division")
+            parse.assert_not_called()
+
+        catalog.close()
+
+    def test_mp3s_are_parsed_lazily(self):
+        album_path = os.path.join(self.directory, "Unknown Pleasures")
+        os.mkdir(album_path)
+
+        for i in range(3):
+            create_mp3(os.path.join(album_path, f"0{i} - track.mp3"), "Joy Division", "Unknown Pleasures", "1979")
+
+        with mock.patch.object(id3.Tag, "parse") as parse:
+            album = AlbumDirectory(album_path)
+            album.clean()
+            parse.assert_not_called()
+
+        album.assumed_artist
+        album.assumed_year
+
+        self.assertIsNotNone(album.mp3s[0]._fields)
+        self.assertTrue(all(mp3._fields is None for mp3 in album.mp3s[1:]))
+
+    def test_snapshot_is_shared_by_directories_and_validators(self):
+        album_path = os.path.join(self.directory, "joy division", "1980 - closer")
+        os.makedirs(album_path)
+        create_mp3(os.path.join(album_path, "01 - atrocity exhibition.mp3"), "Joy Division", "Closer", "1980")
+        open(os.path.join(self.directory, "joy division", "cover.jpg"), "w").close()
+
+        snapshot = LibrarySnapshot(self.directory)
+
+        with mock.patch("os.scandir") as scandir, mock.patch("os.walk") as walk, mock.patch("os.listdir") as listdir:
+            artist = ArtistDirectory(os.path.join(self.directory, "joy division"), snapshot=snapshot)
+
+            for patched in (scandir, walk, listdir):
+                patched.assert_not_called()
+
+        album = artist.album_directories[0]
+
+        self.assertEqual([album.basename for album in artist.album_directories], ["1980 - closer"])
+        self.assertEqual(album.mp3s[0].stat, snapshot.stat(album.mp3s[0].path))
+        self.assertFalse(artist.validator.validate_no_loose_files)
+        self.assertTrue(album.validator.is_valid)
+
+        album.rename("1980 - closer (remaster)", prompt=False)
+        self.assertEqual(snapshot.listdir(artist.path)[0], ["1980 - closer (remaster)"])
+
+    def test_scans_never_follow_symlinked_directories(self):
+        album_path = os.path.join(self.directory, "joy division", "1980 - closer")
+        os.makedirs(album_path)
+        create_mp3(os.path.join(album_path, "01 - atrocity exhibition.mp3"), "Joy Division", "Closer", "1980")
+
+        os.symlink("..", os.path.join(self.directory, "joy division", "loop"))
+        os.symlink("nowhere", os.path.join(self.directory, "joy division", "dangling"))
+
+        for snapshot in (LibrarySnapshot(self.directory), AsyncScanner().scan(LibrarySnapshot(), self.directory)):
+            subdirectories, files = snapshot.listdir(os.path.join(self.directory, "joy division"))
+
+            self.assertEqual(subdirectories, ["1980 - closer"])
+            self.assertEqual(sorted(files), ["dangling", "loop"])
+
+    def test_tag_extractor_preserves_order(self):
+        paths = [os.path.join(self.directory, f"{i:02} - track.mp3") for i in range(8)]
+
+        for i, path in enumerate(paths):
+            create_mp3(path, f"artist {i}", "album", str(1970 + i))
+
+        for pool in ("thread", "process"):
+            mp3s = [Mp3(path) for path in paths]
+            TagExtractor(jobs=4, pool=pool).extract(mp3s)
+
+            self.assertEqual([mp3.artist for mp3 in mp3s], [f"artist {i}" for i in range(8)])
+            self.assertEqual([mp3.recording_date for mp3 in mp3s], [str(1970 + i) for i in range(8)])
+
+    def test_benchmarks_run_against_a_synthetic_library(self):
+        library = SyntheticLibrary(self.directory, albums=10, tracks_per_album=2)
+        results = Benchmark(library).run()
+
+        self.assertEqual(sorted(results), sorted(Benchmark.BENCHMARKS))
+        self.assertTrue(all(seconds >= 0 for seconds in results.values()))
+
+        # the last benchmark leaves behind a freshly generated (and re-tagged) library
+        album = AlbumDirectory(os.path.join(library.artists_directory, "joy division 0", "1950 - unknown pleasures 0"))
+        self.assertEqual(album.assumed_artist, "joy division 0")
+        self.assertEqual(album.assumed_year, "1950")
+
+    def test_metrics_count_phases_and_operations(self):
+        library = SyntheticLibrary(self.directory, albums=10, tracks_per_album=2)
+        library.generate()
+
+        metrics.reset()
+        metrics.enabled = True
+
+        snapshot = LibrarySnapshot(library.albums_directory)
+
+        albums = [
+            AlbumDirectory(os.path.join(library.albums_directory, album_name), snapshot=snapshot)
+            for album_name in snapshot.listdir(library.albums_directory)[0]
+        ]
+
+        for album in albums:
+            album.migrate(library.staging_directory, verbose=False)
+
+        album = next(album for album in albums if album.mp3s)
+        report = metrics.report()
+
+        self.assertIn("scan", report["phases"])
+        self.assertIn("validation", report["phases"])
+        self.assertEqual(report["counters"]["moves"], 1)
+        self.assertEqual(report["counters"]["tags_parsed"], 1)
+        self.assertEqual(report["counters"]["bytes_moved"], 2 * os.path.getsize(album.mp3s[0].path))
+
+        metrics.reset()
+
+    def test_watcher_cleans_and_migrates_only_changed_albums(self):
+        library = SyntheticLibrary(self.directory, albums=5, downloaded_albums=0)
+        library.generate()
+
+        # missing its year, which (like `-a`) the watcher fixes as `album_validation_behavior` says
+        album_path = os.path.join(library.albums_directory, "Unknown Pleasures")
+        os.mkdir(album_path)
+        create_mp3(os.path.join(album_path, "01 - disorder.mp3"), "Joy Division", "Unknown Pleasures", "1979")
+
+        events = [[os.path.join(album_path, "01 - disorder.mp3")], []]
+        event_source = mock.Mock(read=lambda timeout: events.pop(0))
+
+        watcher = AlbumWatcher(
+            Benchmark(library).create_config(), debounce=0, migrate=True, event_source=event_source
+        )
+
+        with mock.patch.object(AlbumWatcher, "handle", wraps=watcher.handle) as handle:
+            watcher.run(until=lambda: not events)
+            handle.assert_called_once_with(album_path)
+
+        migrated_album_path = os.path.join(library.artists_directory, "joy division", "1979 - unknown pleasures")
+        self.assertTrue(os.path.isdir(migrated_album_path))
+
+    @unittest.skipUnless(InotifyEventSource.is_supported(), "inotify is unavailable")
+    def test_inotify_reports_nested_changes(self):
+        event_source = InotifyEventSource([self.directory])
+        os.mkdir(os.path.join(self.directory, "album"))
+        event_source.read(timeout=1)
+
+        open(os.path.join(self.directory, "album", "01.mp3"), "w").close()
+        self.assertIn(os.path.join(self.directory, "album", "01.mp3"), event_source.read(timeout=1))
+
+        event_source.close()
+
+    def test_plan_cleans_and_stages_without_touching_the_disk(self):
+        library = SyntheticLibrary(self.directory, albums=5, downloaded_albums=0)
+        library.generate()
+        os.rmdir(os.path.join(library.albums_directory, "Empty Album"))
+
+        album_path = os.path.join(library.albums_directory, "1979 - Unknown Pleasures")
+        os.mkdir(album_path)
+        create_mp3(os.path.join(album_path, "01 - disorder.mp3"), "Joy Division", "Unknown Pleasures", "1979")
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        plan = Plan()
+
+        lydia.clean_albums_directory(plan=plan)
+        lydia.migrate_albums_to_staging_directory(plan=plan)
+
+        self.assertTrue(os.path.isdir(album_path))
+        self.assertEqual(
+            [operation.operation_type for operation in plan.operations],
+            [OperationType.RENAME, OperationType.MKDIR, OperationType.MOVE]
+        )
+        self.assertEqual(plan.find_conflicts(), [])
+
+        plan.save(os.path.join(self.directory, "plan.json"))
+        self.assertTrue(lydia.apply_plan(Plan.load(os.path.join(self.directory, "plan.json"))))
+
+        self.assertFalse(os.path.exists(album_path))
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(library.staging_directory, "joy division", "1979 - unknown pleasures", "01 - disorder.mp3")
+            )
+        )
+
+    def test_an_applied_plan_leaves_the_snapshot_pointing_at_the_new_paths(self):
+        library = SyntheticLibrary(self.directory, albums=3, downloaded_albums=3)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        plan = Plan()
+
+        lydia.clean_albums_directory(plan=plan)
+        self.assertTrue(lydia.apply_plan(plan))
+
+        # tags are read from where the albums are now, not from where they were when the plan was made
+        albums = lydia.query("in:albums")
+
+        self.assertTrue(albums)
+        self.assertTrue(all(os.path.isdir(album.path) for album in albums))
+
+    def test_plan_detects_collisions(self):
+        for name in ("Closer", "closer", "Still"):
+            os.mkdir(os.path.join(self.directory, name))
+
+        plan = Plan()
+        plan.rename(os.path.join(self.directory, "Closer"), os.path.join(self.directory, "closer"))
+        plan.rename(os.path.join(self.directory, "Still"), os.path.join(self.directory, "still"))
+        plan.move(os.path.join(self.directory, "Still"), os.path.join(self.directory, "closer"))
+        plan.mkdir(os.path.join(self.directory, "Heart and Soul"))
+        plan.mkdir(os.path.join(self.directory, "HEART AND SOUL"))
+
+        conflicts = plan.find_conflicts()
+
+        self.assertEqual(len(conflicts), 3)
+        self.assertIn("the target already exists", conflicts[0])
+        self.assertIn("the source does not exist", conflicts[1])
+        self.assertIn("differs only in case", conflicts[2])
+
+    def test_transport_copies_and_verifies_across_devices(self):
+        source = os.path.join(self.directory, "staging", "joy division", "1979 - unknown pleasures")
+        os.makedirs(os.path.join(source, "scans"))
+        create_mp3(os.path.join(source, "01 - disorder.mp3"), "Joy Division", "Unknown Pleasures", "1979")
+
+        with open(os.path.join(source, "scans", "front.jpg"), "wb") as f:
+            f.write(os.urandom(64 * 1024))
+
+        os.symlink("scans", os.path.join(source, "artwork"))
+        os.utime(os.path.join(source, "01 - disorder.mp3"), ns=(0, 315532800 * 10 ** 9))
+        albums_directory = os.path.join(self.directory, "albums")
+        os.mkdir(albums_directory)
+
+        transport = MigrationTransport(jobs=2, verify="hash", verbose=False)
+
+        # pretend the albums directory lives on another file system
+        with mock.patch.object(MigrationTransport, "is_same_device", return_value=False):
+            with mock.patch.object(MigrationTransport, "hash_file", side_effect=lambda path: path):
+                with self.assertRaises(IOError):
+                    transport.move(source, albums_directory)
+
+            self.assertTrue(os.path.isdir(source))
+            self.assertEqual(os.listdir(albums_directory), [])
+
+            target = transport.move(source, albums_directory)
+
+        self.assertEqual(target, os.path.join(albums_directory, "1979 - unknown pleasures"))
+        self.assertFalse(os.path.exists(source))
+        self.assertEqual(os.path.getsize(os.path.join(target, "scans", "front.jpg")), 64 * 1024)
+        self.assertEqual(os.readlink(os.path.join(target, "artwork")), "scans")
+        self.assertEqual(os.stat(os.path.join(target, "01 - disorder.mp3")).st_mtime_ns, 315532800 * 10 ** 9)
+        self.assertEqual(Mp3(os.path.join(target, "01 - disorder.mp3")).artist, "Joy Division")
+
+    def test_staging_keeps_only_paths_between_journaling_and_moving(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=6)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        live_albums = []
+        migrate_to = AlbumDirectory.migrate_to
+
+        def count_live_albums(album, *args, **kwargs):
+            gc.collect()
+            live_albums.append(sum(isinstance(o, AlbumDirectory) for o in gc.get_objects()))
+
+            return migrate_to(album, *args, **kwargs)
+
+        # (a plain function, since a mock would keep every album it was called with)
+        with mock.patch.object(AlbumDirectory, "migrate_to", count_live_albums):
+            lydia.migrate_albums_to_staging_directory()
+
+        self.assertEqual(len(live_albums), 6)  # every album but the empty one
+        self.assertEqual(max(live_albums), 1)  # just the one being moved
+        self.assertEqual(len(os.listdir(os.path.join(library.staging_directory, "joy division 0"))), 6)
+
+    def test_journal_resumes_an_interrupted_migration(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=0)
+        library.generate()
+
+        for name in ("1979 - unknown pleasures", "1980 - closer"):
+            os.mkdir(os.path.join(library.albums_directory, name))
+            create_mp3(os.path.join(library.albums_directory, name, "01.mp3"), "Joy Division", name[7:], name[:4])
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        artist_path = os.path.join(library.staging_directory, "joy division")
+        moves = [
+            (os.path.join(library.albums_directory, name), os.path.join(artist_path, name))
+            for name in ("1979 - unknown pleasures", "1980 - closer")
+        ]
+
+        # the first album made it; the second was half-copied when the power went out
+        os.mkdir(artist_path)
+        lydia.journal.begin("stage", moves)
+        lydia.journal.move(*moves[0])
+        lydia.journal.write({"event": "moving", "source": moves[1][0], "target": moves[1][1]})
+        os.mkdir(moves[1][1])
+        create_mp3(os.path.join(moves[1][1], "01.mp3"))
+        lydia.journal.close()
+
+        with mock.patch.object(TagExtractor, "extract") as extract:
+            lydia.migrate_albums_to_staging_directory()
+
+        extract.assert_not_called()  # nothing was rescanned
+        self.assertFalse(os.path.exists(lydia.config.journal_path))
+        self.assertEqual(sorted(os.listdir(library.albums_directory)), ["Empty Album", "loose file.txt"])
+        self.assertEqual(Mp3(os.path.join(moves[1][1], "01.mp3")).album, "closer")
+
+        journal = MigrationJournal(lydia.config.journal_path)
+        journal.begin("unstage", [])
+        journal.close()
+
+        self.assertIsNone(journal.get_unfinished("stage"))
+        self.assertEqual(journal.get_unfinished("unstage"), [])
+
+    def test_journal_is_kept_after_a_failed_move_and_blocks_other_migrations(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=0)
+        library.generate()
+
+        for name in ("1979 - unknown pleasures", "1980 - closer"):
+            os.mkdir(os.path.join(library.albums_directory, name))
+            create_mp3(os.path.join(library.albums_directory, name, "01.mp3"), "Joy Division", name[7:], name[:4])
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        artist_path = os.path.join(library.staging_directory, "joy division")
+        moves = [
+            (os.path.join(library.albums_directory, name), os.path.join(artist_path, name))
+            for name in ("1979 - unknown pleasures", "1980 - closer")
+        ]
+
+        # something is already in the way of the second album
+        os.makedirs(artist_path)
+        open(moves[1][1], "w").close()
+
+        lydia.journal.begin("stage", moves)
+        lydia.journal.move(*moves[0])
+
+        with self.assertRaises(FileExistsError):
+            lydia.journal.move(*moves[1])
+
+        self.assertFalse(lydia.journal.finish())
+        self.assertEqual(lydia.journal.get_unfinished("stage"), [moves[1]])
+
+        # nothing else may start until the failed move is dealt with
+        self.assertFalse(MigrationJournal(lydia.config.journal_path).begin("unstage", []))
+        lydia.migrate_staging_to_albums_directory()
+        self.assertTrue(os.path.isdir(moves[0][1]))
+
+        os.remove(moves[1][1])
+        lydia.migrate_albums_to_staging_directory()
+
+        self.assertFalse(os.path.exists(lydia.config.journal_path))
+        self.assertTrue(os.path.isfile(os.path.join(moves[1][1], "01.mp3")))
+
+    def test_artists_albums_and_tracks_are_streamed(self):
+        library = SyntheticLibrary(self.directory, albums=20, albums_per_artist=5)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        artists = lydia.iter_artists(validate=False)
+
+        self.assertTrue(inspect.isgenerator(artists))
+
+        artist = next(artists)
+        self.assertIsNone(artist.album_directories)
+        self.assertIsNone(artist._all_nested_files)
+
+        albums = lydia.iter_albums(artist, validate=False)
+        album = next(albums)
+        tracks = list(lydia.iter_tracks(album))
+
+        self.assertEqual(len(tracks), 3)
+        self.assertTrue(all(track._fields is None for track in tracks))
+        self.assertEqual(tracks[0].artist, os.path.basename(artist.path).title())
+        self.assertEqual(len(list(albums)), 4)
+        self.assertEqual(len(list(artists)), 4)  # plus the empty artist
+
+    def test_native_id3_reader_agrees_with_eyed3(self):
+        paths = []
+
+        for version, date, cover in (((2, 4, 0), "1980-07-18", True), ((2, 3, 0), "1980", False)):
+            path = os.path.join(self.directory, f"{version[1]}.mp3")
+            create_mp3(path, "坂本龍一", "B-2 Unit", date)
+
+            tag = id3.Tag()
+            tag.parse(path)
+
+            if cover:
+                tag.images.set(3, b"\x89PNG" + b"\x00" * 100000, "image/png")
+
+            tag.save(path, version=version)
+            paths.append(path)
+
+        for path in paths:
+            self.assertIsNotNone(Id3v2Reader.read_tag_fields(path))
+            self.assertEqual(Id3v2Reader.read_tag_fields(path), Mp3.read_tag_fields(path, backend="eyed3"))
+
+        # unsynchronised tags are left to eyed3
+        with open(paths[0], "r+b") as f:
+            f.seek(5)
+            f.write(b"\x80")
+
+        self.assertIsNone(Id3v2Reader.read_tag_fields(paths[0]))
+
+    def test_flac_only_albums_are_inferred_and_migrated(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=0)
+        library.generate()
+
+        album_path = os.path.join(library.albums_directory, "Movement")
+        os.mkdir(album_path)
+
+        for i in (1, 2):
+            SyntheticLibrary.create_flac(
+                os.path.join(album_path, f"0{i} - track.flac"), "New Order", "Movement", "1981", seconds=i
+            )
+
+        album = AlbumDirectory(album_path)
+
+        self.assertEqual(album.mp3s, [])
+        self.assertTrue(all(isinstance(track, Flac) for track in album.tracks))
+        self.assertEqual(album.tracks[1].duration, 2.0)
+        self.assertEqual((album.assumed_artist, album.assumed_year), ("new order", "1981"))
+
+        lydia = Lydia(jobs=2, config=Benchmark(library).create_config())
+        lydia.migrate_albums_to_staging_directory()
+
+        self.assertTrue(
+            os.path.isfile(os.path.join(library.staging_directory, "new order", "Movement", "01 - track.flac"))
+        )
+
+    def test_retagger_only_writes_tracks_that_differ(self):
+        album_path = os.path.join(self.directory, "joy division", "1980 - closer")
+        os.makedirs(album_path)
+
+        create_mp3(os.path.join(album_path, "01 - atrocity exhibition.mp3"), "joy division", "Closer", "1980")
+        create_mp3(os.path.join(album_path, "02 - isolation.mp3"), None, None, None)
+
+        tag = id3.Tag()
+        tag.parse(os.path.join(album_path, "01 - atrocity exhibition.mp3"))
+        tag.album_artist = "Joy Division"
+        tag.artist = "Joy Division"
+        tag.save()
+
+        mapping_path = os.path.join(self.directory, "mapping.csv")
+
+        with open(mapping_path, "w", encoding="utf-8") as f:
+            f.write(f"directory,artist,album,year\n{os.path.dirname(album_path)},Joy Division,,\n")
+            f.write(f"{album_path},,Closer,1980\n")
+
+        mapping = Retagger.load_mapping(mapping_path)
+
+        self.assertEqual(Retagger(dry_run=True).retag(mapping), {"unchanged": 1, "changed": 1})
+        self.assertEqual(Retagger(jobs=2).retag(mapping), {"unchanged": 1, "in_place": 1})
+        self.assertEqual(Retagger(jobs=2).retag(mapping), {"unchanged": 2})
+
+        self.assertEqual(
+            Mp3.read_tag_fields(os.path.join(album_path, "02 - isolation.mp3")),
+            {"artist": "Joy Division", "album": "Closer", "recording_date": "1980"}
+        )
+
+        # same-sized changes fit into the existing tag; much larger ones don't
+        self.assertEqual(Retagger().retag({album_path: {"artist": "JOY DIVISION"}}), {"in_place": 2})
+        self.assertEqual(Retagger().retag({album_path: {"album": "Closer" * 100}}), {"rewritten": 2})
+
+    def test_library_index_is_compact_and_round_trips(self):
+        library = SyntheticLibrary(self.directory, albums=10, albums_per_artist=5)
+        library.generate()
+
+        lydia = Lydia(jobs=2, config=Benchmark(library).create_config())
+        index = lydia.build_index()
+
+        tracks = list(index.iter_tracks(library.artists_directory))
+        directory, track = tracks[0]
+
+        self.assertFalse(hasattr(track, "__dict__") or hasattr(directory, "__dict__"))
+        self.assertEqual(len(tracks), sum(
+            len([f for f in files if f.endswith(".mp3")]) for root, dirs, files in os.walk(library.artists_directory)
+        ))
+        self.assertEqual(Mp3(os.path.join(directory.path, track.name)).artist, track.artist)
+        self.assertIs(tracks[0][1].artist, tracks[1][1].artist)  # interned
+
+        index.save(os.path.join(self.directory, "index.pickle"))
+        lydia.index = LibraryIndex.load(os.path.join(self.directory, "index.pickle"))
+        shutil.rmtree(library.artists_directory)
+
+        lydia.create_inventory()
+
+        with open(os.path.join(library.inventory_path, "artists.json"), encoding="utf-8") as f:
+            self.assertEqual(len(json.load(f)), 3)
+
+    def test_async_scan_overlaps_slow_calls_and_feeds_migrations(self):
+        library = SyntheticLibrary(self.directory, albums=10, albums_per_artist=5, downloaded_albums=4)
+        library.generate()
+
+        file_system = LatencyFileSystem(latency=0.01)
+        lydia = Lydia(config=Benchmark(library).create_config())
+        lydia.scan(concurrency=8, file_system=file_system)
+
+        self.assertTrue(1 < file_system.max_in_flight <= 8)
+
+        for path in (library.artists_directory, library.albums_directory, library.staging_directory):
+            self.assertEqual(sorted(lydia.snapshot.walk(path)), sorted(LibrarySnapshot(path).walk(path)))
+
+        calls = file_system.calls
+
+        with mock.patch.object(Mp3, "parse_tag_fields") as parse_tag_fields:
+            lydia.migrate_albums_to_staging_directory()
+
+        parse_tag_fields.assert_not_called()
+        self.assertEqual(file_system.calls, calls)
+        self.assertEqual(sorted(os.listdir(library.albums_directory)), ["Empty Album", "loose file.txt"])
+
+    def test_duplicate_albums_are_found_by_their_audio(self):
+        library = SyntheticLibrary(self.directory, albums=0)
+        library.generate()
+
+        up = os.path.join(library.artists_directory, "joy division", "1979 - unknown pleasures")
+        remaster = os.path.join(library.albums_directory, "(1979) - Unknown Pleasures [remaster]")
+        side_a = os.path.join(library.albums_directory, "1979 - unknown pleasures (side a)")
+        closer = os.path.join(library.albums_directory, "1980 - closer")
+
+        for path, artist, tracks, padding in ((up, "Joy Division", 3, 0), (remaster, "JOY DIVISION", 3, 0),
+                                              (side_a, "Joy Division", 2, 0), (closer, "Joy Division", 3, 1)):
+            os.makedirs(path)
+
+            # payloads that only differ in their last byte (or, for "closer", in their lengths)
+            for track in range(tracks):
+                audio = bytes(100 * 1024 + padding * (track + 1)) + bytes([track])
+                create_mp3(os.path.join(path, f"0{track} - track.mp3"), artist, "Unknown Pleasures", "1979", audio)
+
+        # a retagged copy has a differently-sized tag (and an ID3v1 tag, too)
+        with open(os.path.join(remaster, "00 - track.mp3"), "ab") as f:
+            f.write(b"TAG" + bytes(125))
+
+        lydia = Lydia(jobs=2, config=Benchmark(library).create_config())
+
+        with mock.patch.object(DuplicateFinder, "hash_payload", wraps=DuplicateFinder.hash_payload) as hash_payload:
+            self.assertEqual(lydia.find_duplicates(), [sorted([up, remaster])])
+
+        # tracks with no same-sized counterpart are never hashed
+        hashed = {os.path.dirname(c.args[0]) for c in hash_payload.call_args_list}
+        self.assertTrue({up, remaster, side_a} <= hashed)
+        self.assertNotIn(closer, hashed)
+
+    def test_incremental_inventory_only_lists_changed_artists(self):
+        library = SyntheticLibrary(self.directory, albums=10, albums_per_artist=5, downloaded_albums=2)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        metrics.reset()
+
+        changes = lydia.update_inventory(compress=True)
+
+        with gzip.open(os.path.join(library.inventory_path, "inventory.ndjson.gz"), "rt", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual(len(changes), len([r for r in records if r["album"]]))
+        self.assertEqual({c["change"] for c in changes}, {"added"})
+
+        artist = sorted(a for a in os.listdir(library.artists_directory) if os.listdir(
+            os.path.join(library.artists_directory, a)
+        ))[0]
+        album = sorted(os.listdir(os.path.join(library.artists_directory, artist)))[0]
+        download = sorted(os.listdir(library.albums_directory))[0]
+
+        os.rename(
+            os.path.join(library.artists_directory, artist, album),
+            os.path.join(library.artists_directory, artist, "renamed")
+        )
+        shutil.move(os.path.join(library.albums_directory, download), os.path.join(library.artists_directory, artist))
+
+        metrics.reset()
+        changes = lydia.update_inventory()
+
+        self.assertEqual(metrics.counters["directories_visited"], 2)  # the changed artist and the albums directory
+        self.assertEqual(sorted((c["change"], c["album"], c["from"]["album"]) for c in changes), sorted([
+            ("renamed", "renamed", album), ("renamed", download, download)
+        ]))
+
+        changes = Inventory(library.inventory_path).update(library.artists_directory, library.albums_directory)
+        self.assertEqual(changes, [])
+
+    def test_queries_are_answered_from_the_index(self):
+        library = SyntheticLibrary(self.directory, albums=15, albums_per_artist=5, downloaded_albums=5)
+        library.generate()
+
+        album_path = os.path.join(library.artists_directory, "New Order", "1981 - movement")
+        os.makedirs(album_path)
+        create_mp3(os.path.join(album_path, "01.mp3"), "New Order", "Movement", "1981")
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        index_path = os.path.join(self.directory, "query.pickle")
+
+        # the artist's errors are its own, not its (valid) album's
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            index = lydia.build_query_index()
+
+        self.assertNotIn("Validating", output.getvalue())
+        self.assertIn(album_path, [a.path for a in index.query("artist_error:lowercase")])
+        self.assertNotIn(album_path, [a.path for a in index.query("error:any")])
+        self.assertTrue(all(len(set(a.errors)) == len(a.errors) for a in index.albums))
+
+        # albums are read from the compact library index, which is kept (e.g. by `--serve`) until it's invalidated
+        self.assertIsNotNone(lydia.index)
+
+        with mock.patch("os.scandir") as scandir:
+            self.assertEqual([str(a) for a in lydia.build_query_index().albums], [str(a) for a in index.albums])
+
+        scandir.assert_not_called()
+
+        albums = lydia.query("artist:'joy division'", index_path=index_path)
+        self.assertTrue(albums and all(a.artist.startswith("joy division") for a in albums))
+        self.assertEqual(
+            {a.path for a in albums if a.directory == "artists"},
+            {os.path.join(library.artists_directory, "joy division 0", a)
+             for a in os.listdir(os.path.join(library.artists_directory, "joy division 0"))}
+        )
+
+        shutil.rmtree(library.artists_directory)
+        shutil.rmtree(library.albums_directory)
+
+        with mock.patch("os.scandir") as scandir, mock.patch("os.stat") as stat:
+            index = QueryIndex.load(index_path)
+
+            self.assertEqual(
+                {a.path for a in index.query("year:1952-1955")},
+                {a.path for a in index.albums if a.year and 1952 <= int(a.year) <= 1955}
+            )
+            self.assertEqual([a.path for a in index.query("error:empty in:albums")], [
+                os.path.join(library.albums_directory, "Empty Album")
+            ])
+            self.assertEqual(len(index.query("in:albums")), 6)
+            self.assertEqual(
+                len(index.query("pleasures")), len([a for a in index.albums if "pleasures" in (a.title or "")])
+            )
+            self.assertEqual(index.query("title:'unknown pleasures 3' year:none"), [])
+
+        scandir.assert_not_called()
+        stat.assert_not_called()
+
+        for query in ("label:factory", "joy year:79", "title:'unknown pleasures"):
+            with self.assertRaises(ValueError):
+                index.query(query)
+
+            # lydia reports bad queries rather than raising
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertEqual(lydia.query(query, index_path=index_path), [])
+
+            self.assertIn("ERROR:", output.getvalue())
+
+    def test_album_inferences_are_memoized_until_renamed(self):
+        album_path = os.path.join(self.directory, "1979 - unknown pleasures")
+        os.makedirs(album_path)
+        create_mp3(os.path.join(album_path, "01 - disorder.mp3"), None, "Unknown Pleasures", "1979")
+
+        album = AlbumDirectory(album_path, validate=False)
+        metrics.reset()
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            album.migrate(os.path.join(self.directory, "staging"))
+            album.migrate(os.path.join(self.directory, "staging"))
+
+        self.assertEqual(output.getvalue().count("WARNING: it's a bad idea"), 1)
+        self.assertEqual((album.assumed_year, album.assumed_title), ("1979", "unknown pleasures"))
+        self.assertEqual(metrics.counters["album_inferences"], 3)
+
+        album.rename("1980 - closer", prompt=False)
+
+        self.assertEqual((album.assumed_year, album.assumed_title), ("1980", "closer"))
+        self.assertEqual(metrics.counters["album_inferences"], 5)
+
+    def test_server_keeps_the_library_warm_between_commands(self):
+        library = SyntheticLibrary(self.directory, albums=10, albums_per_artist=5, downloaded_albums=3)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        address = os.path.join(self.directory, "lydia.sock")
+        event_source = PollingEventSource([library.albums_directory], interval=0.05, track_files=[])
+
+        server = LydiaServer(lydia, address, event_source=event_source)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            self.assertEqual(send({"command": "ping"}, address)["result"], "pong")
+            self.assertEqual(len(send({"command": "query", "query": "in:albums"}, address)["result"]), 4)
+
+            metrics.reset()
+            self.assertEqual(len(send({"command": "query", "query": "in:albums"}, address)["result"]), 4)
+            self.assertEqual(metrics.counters["directories_visited"], 0)
+
+            os.mkdir(os.path.join(library.albums_directory, "1980 - closer"))
+            create_mp3(os.path.join(library.albums_directory, "1980 - closer", "01 - atrocity exhibition.mp3"),
+                       "Joy Division", "Closer", "1980")
+
+            for attempt in range(100):
+                result = send({"command": "lookup", "artist": "joy division", "album": "closer"}, address)["result"]
+
+                if result:
+                    break
+
+                threading.Event().wait(0.05)
+
+            self.assertEqual(len(result), 1)
+            self.assertTrue(result[0].startswith("1980  joy division - closer"))
+
+            response = send({"command": "stage"}, address)
+            self.assertTrue(response["ok"])
+            self.assertIn("1980 - closer", response["output"])
+            self.assertTrue(os.path.isdir(os.path.join(library.staging_directory, "joy division", "1980 - closer")))
+
+            self.assertFalse(send({"command": "format_c"}, address)["ok"])
+
+        finally:
+            send({"command": "shutdown"}, address)
+            thread.join(timeout=5)
+
+        self.assertFalse(thread.is_alive() or os.path.exists(address))
+
+    def test_tcp_server_requires_a_token_and_hangs_up_on_anything_else(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=1)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+
+        with self.assertRaises(ValueError):
+            LydiaServer(lydia, ("127.0.0.1", 0), watch=False)
+
+        server = LydiaServer(lydia, ("127.0.0.1", 0), token="secret", watch=False)
+        address = server.server.server_address
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def send_raw(data):
+            with socket.create_connection(address) as connection:
+                connection.sendall(data)
+
+                with connection.makefile("rb") as f:
+                    return f.read().decode("utf-8").splitlines()  # everything, up to the server hanging up
+
+        try:
+            # a web page POSTing to localhost: the request line is refused, and the body never runs
+            body = json.dumps({"command": "ping", "token": "secret"})
+            responses = send_raw(
+                f"POST / HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\n\r\n{body}\n".encode("utf-8")
+            )
+
+            self.assertEqual(len(responses), 1)
+            self.assertNotIn("pong", responses[0])
+
+            self.assertEqual(len(send_raw(b"[]\n" + body.encode("utf-8") + b"\n")), 1)
+            self.assertFalse(send({"command": "ping"}, address)["ok"])
+            self.assertFalse(send({"command": "ping", "token": "wrong"}, address)["ok"])
+            self.assertEqual(send({"command": "ping", "token": "secret"}, address)["result"], "pong")
+
+        finally:
+            send({"command": "shutdown", "token": "secret"}, address)
+            thread.join(timeout=5)
+
+        self.assertFalse(thread.is_alive())
+
+    def test_server_never_replaces_a_file_that_isnt_a_socket(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=1)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        address = os.path.join(self.directory, "config.json")  # e.g. a `socket_path` pointing at the wrong file
+
+        with self.assertRaises(FileExistsError):
+            LydiaServer(lydia, address, watch=False)
+
+        self.assertTrue(os.path.isfile(address))
+
+        # a socket left behind by a server that didn't shut down cleanly is replaced, though
+        address = os.path.join(self.directory, "lydia.sock")
+        LydiaServer(lydia, address, watch=False).server.socket.close()
+
+        server = LydiaServer(lydia, address, watch=False)
+        server.close()
+
+        self.assertFalse(os.path.exists(address))
+
+    def test_lydia_imports_without_unix_sockets(self):
+        # as on platforms (e.g. older versions of Windows) that have no `socket.AF_UNIX`
+        result = subprocess.run(
+            [sys.executable, "-c", "import socket; del socket.AF_UNIX; import lydia, server"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_server_commands_that_change_the_library_drop_its_query_index(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=3)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        lydia.config.album_validation_behavior["remove_empty_folders"] = "prompt"
+
+        # without a watcher, only the commands themselves can tell the server what they changed
+        server = LydiaServer(lydia, os.path.join(self.directory, "lydia.sock"), watch=False)
+
+        try:
+            before = server.handle({"command": "query", "query": "in:albums"})["result"]
+
+            with mock.patch("builtins.input", side_effect=AssertionError("prompted")):
+                response = server.handle({"command": "clean_albums"})
+
+            self.assertTrue(response["ok"])
+            self.assertIn("skipped", response["output"])
+
+            after = server.handle({"command": "query", "query": "in:albums"})["result"]
+
+            self.assertEqual(len(after), len(before))
+            self.assertNotEqual(after, before)
+            self.assertTrue(all(os.path.isdir(re.search(r"  \((.*)\)( \[.*\])?$", a).group(1)) for a in after))
+
+            # renamed to lowercase (forced), but not removed (that needed confirming)
+            self.assertTrue(os.path.isdir(os.path.join(library.albums_directory, "empty album")))
+
+        finally:
+            server.close()
+
+    def test_albums_are_staged_as_links_and_unstaged_by_unlinking(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=4)
+        library.generate()
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        albums = sorted(os.listdir(library.albums_directory))
+
+        link, links = os.link, []
+
+        def link_across_devices(source, destination, **kwargs):
+            if len(links) == 3:
+                raise OSError(18, "Invalid cross-device link")
+
+            links.append(destination)
+            link(source, destination, **kwargs)
+
+        with mock.patch("os.link", side_effect=link_across_devices):
+            lydia.link_albums_to_staging_directory()
+
+        self.assertEqual(sorted(os.listdir(library.albums_directory)), albums)
+
+        staged = [
+            os.path.join(root, file) for root, dirs, files in os.walk(library.staging_directory) for file in files
+            if file.endswith(".mp3")
+        ]
+
+        self.assertEqual(len(staged), 3 * (len(albums) - 2))  # neither "Empty Album" nor "loose file.txt"
+        self.assertEqual(len([path for path in staged if os.path.islink(path)]), len(staged) - 3)
+
+        lydia.link_albums_to_staging_directory(link_type="hardlink")  # already staged; nothing changes
+        lydia.migrate_staging_to_albums_directory()
+
+        self.assertEqual(os.listdir(library.staging_directory), [])
+        self.assertEqual(sorted(os.listdir(library.albums_directory)), albums)
+        self.assertEqual(
+            sum(len(files) for root, dirs, files in os.walk(library.albums_directory)), 3 * (len(albums) - 2) + 1
+        )
+
+    def test_hardlinked_files_share_their_originals_inode(self):
+        source = os.path.join(self.directory, "source")
+        os.makedirs(os.path.join(source, "cd1"))
+        create_mp3(os.path.join(source, "cd1", "01 - disorder.mp3"))
+
+        transport = LinkTransport()
+        transport.link_tree(source, os.path.join(self.directory, "link"))
+
+        self.assertTrue(os.path.samefile(
+            os.path.join(source, "cd1", "01 - disorder.mp3"),
+            os.path.join(self.directory, "link", "cd1", "01 - disorder.mp3")
+        ))
+        self.assertEqual(transport.links, {"hardlink": 1})
+
+        with self.assertRaises(FileExistsError):
+            transport.link_tree(source, os.path.join(self.directory, "link"))
+
+    def test_empty_and_audioless_folders_are_pruned_in_one_pass(self):
+        library = SyntheticLibrary(self.directory, albums=5, albums_per_artist=5, downloaded_albums=1)
+        library.generate()
+
+        artist = os.path.dirname(next(
+            root for root, dirs, files in os.walk(library.artists_directory) if any(f.endswith(".mp3") for f in files)
+        ))
+        album = next(
+            root for root, dirs, files in os.walk(library.albums_directory) if any(f.endswith(".mp3") for f in files)
+        )
+
+        for path in ("artwork only", "nested/empty/folders", "_leave me alone"):
+            os.makedirs(os.path.join(library.albums_directory, path))
+
+        SyntheticLibrary.create_file(os.path.join(library.albums_directory, "artwork only", "cover.jpg"))
+        os.makedirs(os.path.join(album, "scans"))
+        SyntheticLibrary.create_file(os.path.join(album, "scans", "booklet.jpg"))
+        os.makedirs(os.path.join(album, "cd2"))
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        pruner = Pruner(lydia.snapshot, empty="force", audioless="prompt")
+        roots = [(library.artists_directory, 2), (library.albums_directory, 1)]
+
+        self.assertEqual(pruner.find(library.albums_directory, 1), sorted([
+            (os.path.join(library.albums_directory, "Empty Album"), "empty"),
+            (os.path.join(library.albums_directory, "artwork only"), "audioless"),
+            (os.path.join(library.albums_directory, "nested"), "empty"),
+            (os.path.join(album, "cd2"), "empty")
+        ]))
+
+        with mock.patch("builtins.input", return_value="n") as prompt:
+            removed = pruner.prune(roots)
+
+        prompt.assert_called_once()
+        self.assertIn(os.path.join(library.artists_directory, "empty artist"), removed)
+        self.assertNotIn(os.path.join(library.albums_directory, "artwork only"), removed)
+        self.assertTrue(os.path.isdir(os.path.join(library.albums_directory, "artwork only")))
+        self.assertFalse(os.path.exists(os.path.join(library.albums_directory, "nested")))
+        self.assertFalse(os.path.exists(os.path.join(album, "cd2")))
+        self.assertTrue(os.path.isdir(os.path.join(album, "scans")))
+        self.assertTrue(os.path.isdir(os.path.join(library.albums_directory, "_leave me alone")))
+        self.assertTrue(os.path.isdir(artist))
+
+        # `--batch` asks before anything is applied; `--plan-out` queues the removals for review (each plan is made
+        # against its own snapshot, since planning a removal takes it out of the snapshot)
+        def plan_pruning(prompts):
+            return Pruner(LibrarySnapshot(), empty="force", audioless="prompt").prune(roots, plan=Plan(prompts=prompts))
+
+        with mock.patch("builtins.input", return_value="n") as prompt:
+            self.assertEqual(plan_pruning("ask"), [])
+
+        prompt.assert_called_once()
+
+        with mock.patch("builtins.input", side_effect=AssertionError("prompted")):
+            self.assertEqual(plan_pruning("queue"), [os.path.join(library.albums_directory, "artwork only")])
+            self.assertEqual(plan_pruning("skip"), [])
+
+        with mock.patch("builtins.input", return_value="y"):
+            self.assertEqual(pruner.prune(roots), [os.path.join(library.albums_directory, "artwork only")])
+
+    def test_album_rules_are_evaluated_in_bulk_and_applied_as_configured(self):
+        for name in ("1979 - 1979 - Closer", "1981-06-01 Still", "Substance", "(1988) - Technique", "Empty"):
+            os.mkdir(os.path.join(self.directory, name))
+
+        create_mp3(os.path.join(self.directory, "1979 - 1979 - Closer", "01.mp3"), "Joy Division", "Closer", "1980")
+        create_mp3(os.path.join(self.directory, "Substance", "01.mp3"), "New Order", "Substance", "1987")
+        create_mp3(os.path.join(self.directory, "(1988) - Technique", "01.mp3"), "New Order", "Technique", "1989")
+
+        engine = RuleEngine({
+            "rename_as_lowercase": "force",
+            "rename_as_year_plus_title": "prompt",
+            "remove_empty_folders": "skip",
+            "remove_folders_with_no_mp3s_or_flacs": "skip"
+        })
+
+        albums = [
+            AlbumDirectory(os.path.join(self.directory, name), validate=False) for name in os.listdir(self.directory)
+        ]
+
+        with mock.patch("builtins.input", return_value="y") as prompt:
+            fixed = engine.apply(albums)
+
+        self.assertEqual(prompt.call_count, 3)  # once per rule, not once per album
+        self.assertEqual(fixed, {"double_leading_year": 1, "yyyy_mm_dd": 1, "year_plus_title": 2, "lowercase": 3})
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ["1979 - closer", "1981 - still", "1987 - substance", "1988 - technique", "empty"]
+        )
+
+        names = [f"{1900 + i % 100} - Album {i}" if i % 3 else f"album {i}" for i in range(100000)]
+
+        broken = engine.validate_names(names)
+
+        self.assertEqual(len(broken["year_plus_title"]), 33334)
+        self.assertEqual(len(broken["lowercase"]), 66666)
+
+    def test_artists_are_cleaned_through_the_rule_engine(self):
+        library = SyntheticLibrary(self.directory, albums=5, downloaded_albums=0)
+        library.generate()
+
+        for artist, album in (("Joy Division", "Closer"), ("坂本龍一 Live At BUDOKAN", "1980 - Live"), ("Empty", None)):
+            os.makedirs(os.path.join(library.artists_directory, artist, album or ""))
+
+            if album:
+                create_mp3(os.path.join(library.artists_directory, artist, album, "01.mp3"), artist, album, "1980")
+
+        self.assertTrue(is_lowercase("坂本龍一 Live At BUDOKAN"))
+        self.assertFalse(is_lowercase("Joy Division"))
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+
+        with mock.patch.object(RuleEngine, "apply", autospec=True, side_effect=RuleEngine.apply) as apply:
+            fixed = lydia.clean_artists_directory(force=False)
+
+        self.assertEqual(apply.call_count, 2)  # once for a batch of artists, then once for all of their albums
+        self.assertGreaterEqual(fixed["year_plus_title"], 1)
+        self.assertTrue(os.path.isdir(os.path.join(library.artists_directory, "joy division", "1980 - closer")))
+        self.assertTrue(os.path.isdir(os.path.join(library.artists_directory, "坂本龍一 Live At BUDOKAN", "1980 - live")))
+        self.assertTrue(os.path.isdir(os.path.join(library.artists_directory, "empty")))  # only removed with -f
+
+        artists = len(os.listdir(library.artists_directory))
+        lydia = Lydia(config=Benchmark(library).create_config())
+
+        # only a batch of artists (and their albums) is held at once
+        with mock.patch.object(RuleEngine, "apply", autospec=True, side_effect=RuleEngine.apply) as apply:
+            lydia.clean_artists_directory(force=True, batch_size=2)
+
+        self.assertEqual(apply.call_count, 2 * ((artists + 1) // 2))
+        self.assertTrue(all(len(call.args[1]) <= 2 for call in apply.call_args_list[::2]))
+
+        self.assertFalse(os.path.exists(os.path.join(library.artists_directory, "empty")))
+
+    def test_prompt_behaviors_are_asked_about_before_a_plan_is_applied(self):
+        for name in ("Closer", "Empty"):
+            os.mkdir(os.path.join(self.directory, name))
+
+        create_mp3(os.path.join(self.directory, "Closer", "01.mp3"), "Joy Division", "Closer", "1980")
+
+        engine = RuleEngine({
+            "rename_as_lowercase": "prompt",
+            "rename_as_year_plus_title": "prompt",
+            "remove_empty_folders": "prompt",
+            "remove_folders_with_no_mp3s_or_flacs": "prompt"
+        })
+
+        def get_albums():
+            # plans are made against a snapshot, which knows where planned renames have (or haven't yet) taken things
+            snapshot = LibrarySnapshot(self.directory)
+
+            return [
+                AlbumDirectory(os.path.join(self.directory, n), validate=False, snapshot=snapshot)
+                for n in ("Closer", "Empty")
+            ]
+
+        # a plan that's about to be applied (`--batch`) asks, just like running without a plan
+        plan = Plan()
+
+        with mock.patch("builtins.input", return_value="n") as prompt:
+            engine.apply(get_albums(), plan=plan)
+
+        self.assertEqual(prompt.call_count, 3)
+        self.assertEqual(plan.operations, [])
+
+        # a plan that's only written out for review (`--plan-out`) queues them unasked ...
+        plan = Plan(prompts="queue")
+
+        with mock.patch("builtins.input", side_effect=AssertionError("prompted")):
+            engine.apply(get_albums(), plan=plan)
+
+        self.assertEqual(
+            [operation.operation_type for operation in plan.operations],
+            [OperationType.RENAME, OperationType.RENAME, OperationType.DELETE]
+        )
+
+        # ... and with nobody to ask (`--serve`), they're skipped
+        plan = Plan(prompts="skip")
+
+        with mock.patch("builtins.input", side_effect=AssertionError("prompted")):
+            engine.apply(get_albums(), plan=plan)
+
+        self.assertEqual(plan.operations, [])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["Closer", "Empty"])
+
+    def test_covers_are_extracted_once_per_image_and_never_kept_by_tracks(self):
+        library = SyntheticLibrary(self.directory, albums=0, downloaded_albums=0)
+        library.generate()
+
+        cover = b"\xFF\xD8\xFF\xE0" + bytes(range(255)) * 800
+        albums = {"1979 - Unknown Pleasures": cover, "(1979) - Unknown Pleasures [remaster]": cover, "Closer": None}
+
+        for album_name, image in albums.items():
+            os.mkdir(os.path.join(library.albums_directory, album_name))
+
+            for i, version in enumerate(((2, 4, 0), (2, 3, 0))):
+                path = os.path.join(library.albums_directory, album_name, f"0{i} - track.mp3")
+                create_mp3(path, "Joy Division", album_name, "1979")
+
+                tag = id3.Tag()
+                tag.parse(path)
+
+                if image:
+                    tag.images.set(3, image, "image/jpeg", "cover")
+                    tag.images.set(4, b"\x89PNG" + b"\x00" * 100, "image/png", "back")
+
+                tag.save(path, version=version)
+
+        # unsynchronised tags are read by eyed3 instead
+        with open(os.path.join(library.albums_directory, "1979 - Unknown Pleasures", "00 - track.mp3"), "r+b") as f:
+            f.seek(5)
+            f.write(b"\x80")
+
+        lydia = Lydia(config=Benchmark(library).create_config())
+        lydia.config.covers_directory = os.path.join(self.directory, "covers")
+
+        metrics.reset()
+        metrics.enabled = True
+
+        covers = lydia.extract_covers()
+
+        cover_path = os.path.join(lydia.config.covers_directory, hashlib.sha256(cover).hexdigest() + ".jpg")
+
+        self.assertEqual(set(os.listdir(lydia.config.covers_directory)), {"covers.json", os.path.basename(cover_path)})
+        self.assertEqual(covers.get(os.path.join(library.albums_directory, "1979 - Unknown Pleasures")), cover_path)
+        self.assertIsNone(covers.get(os.path.join(library.albums_directory, "Closer")))
+        self.assertEqual((metrics.counters["covers_written"], metrics.counters["covers_deduplicated"]), (1, 1))
+
+        with open(cover_path, "rb") as f:
+            self.assertEqual(f.read(), cover)
+
+        # nothing changed, so nothing is read again
+        metrics.reset()
+        metrics.enabled = True
+
+        CoverCache(lydia.config.covers_directory).update(lydia.snapshot, albums_directory=library.albums_directory)
+        self.assertEqual(metrics.counters["covers_unchanged"], 3)
+        self.assertEqual(metrics.counters["covers_read"], 0)
+
+        metrics.reset()
+
+        # inference never holds onto the tracks' art, whichever backend parses it
+        album = AlbumDirectory(os.path.join(library.albums_directory, "1979 - Unknown Pleasures"), validate=False)
+
+        self.assertEqual(album.assumed_artist, "joy division")
+        self.assertTrue(all(track._id_tag is None for track in album.tracks))
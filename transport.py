@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not on Windows; reflinks fall back to symlinks there
+
+from metrics import metrics
+
+
+class TransferProgress:
+    """
+    Thread-safe byte counter that periodically reports throughput and an ETA.
+    """
+
+    def __init__(self, total_bytes, label, interval=1.0, verbose=True):
+        self.total_bytes = total_bytes
+        self.label = label
+        self.interval = interval
+        self.verbose = verbose
+
+        self.transferred_bytes = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.transferred_bytes += count
+            now = time.monotonic()
+
+            if self.verbose and now - self.reported >= self.interval:
+                self.reported = now
+                print(f"INFO: {self}")
+
+    @property
+    def throughput(self):
+        elapsed = time.monotonic() - self.started
+        return self.transferred_bytes / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        throughput = self.throughput
+        return (self.total_bytes - self.transferred_bytes) / throughput if throughput > 0 else None
+
+    def __str__(self):
+        eta = "?" if self.eta is None else time.strftime("%H:%M:%S", time.gmtime(self.eta))
+
+        return f"{self.label}: {TransferProgress.format_size(self.transferred_bytes)} of " \
+               f"{TransferProgress.format_size(self.total_bytes)} " \
+               f"({TransferProgress.format_size(self.throughput)}/s, ETA {eta})"
+
+    @staticmethod
+    def format_size(size):
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024:
+                return f"{size:.1f} {unit}"
+
+            size /= 1024
+
+        return f"{size:.1f} TB"
+
+
+class MigrationTransport:
+    """
+    Moves directory trees. Within a file system, that's a single `os.rename`; across file systems, files are copied
+    concurrently with zero-copy system calls (`os.copy_file_range`, falling back to `os.sendfile`, then to plain
+    buffered copies), verified, and only then is the source removed.
+    """
+
+    BLOCK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, jobs=4, verify="size", verbose=True):
+        """
+        :param jobs: The number of files to copy concurrently.
+        :param verify: Either "size" (compare file sizes after copying) or "hash" (also compare SHA-256 digests).
+        :param verbose: Whether to report progress.
+        """
+
+        if verify not in ("size", "hash"):
+            raise ValueError(f"'{verify}' is not a valid verification mode; expected 'size' or 'hash'.")
+
+        self.jobs = max(1, jobs)
+        self.verify = verify
+        self.verbose = verbose
+
+    def move(self, source, destination, on_copied=None):
+        """
+        Moves `source` to `destination` - or *into* `destination`, if it's an existing directory (like `shutil.move`).
+
+        :param on_copied: Called once a cross-device copy has been verified, just before the source is removed.
+        :return: The path `source` was moved to.
+        """
+
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(source))
+
+        if os.path.lexists(destination):
+            raise FileExistsError(f"'{destination}' already exists.")
+
+        if MigrationTransport.is_same_device(source, os.path.dirname(destination) or "."):
+            os.rename(source, destination)
+            return destination
+
+        self.copy_tree(source, destination)
+
+        if on_copied:
+            on_copied()
+
+        shutil.rmtree(source)
+
+        return destination
+
+    @staticmethod
+    def is_same_device(source, destination_directory):
+        try:
+            return os.stat(source).st_dev == os.stat(destination_directory).st_dev
+        except OSError:
+            return False
+
+    def copy_tree(self, source, destination):
+        """
+        Copies (and verifies) every file beneath `source` to `destination`. If anything fails, the partial copy is
+        removed and the source is left untouched.
+        """
+
+        files = []
+
+        for root, directories, filenames in os.walk(source):
+            target_root = os.path.join(destination, os.path.relpath(root, source))
+            os.makedirs(target_root, exist_ok=True)
+
+            # `os.walk` lists symlinked directories, but never descends into them; they're recreated as links (by
+            # `copy_file`), just like symlinked files
+            links = [d for d in directories if os.path.islink(os.path.join(root, d))]
+
+            for filename in filenames + links:
+                files.append((os.path.join(root, filename), os.path.join(target_root, filename)))
+
+        progress = TransferProgress(
+            sum(os.lstat(f).st_size for f, t in files if not os.path.islink(f)),
+            f"copying '{os.path.basename(source)}'", verbose=self.verbose
+        )
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                list(executor.map(lambda f: self.copy_file(f[0], f[1], progress), files))
+
+            for root, directories, filenames in os.walk(source):
+                shutil.copystat(root, os.path.join(destination, os.path.relpath(root, source)))
+
+        except BaseException:
+            shutil.rmtree(destination, ignore_errors=True)
+            raise
+
+        metrics.count("bytes_copied", progress.transferred_bytes)
+
+        if self.verbose:
+            print(f"INFO: Done {progress}.")
+
+    def copy_file(self, source, destination, progress=None):
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), destination)
+            return
+
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            size = os.fstat(source_file.fileno()).st_size
+
+            for count in MigrationTransport.copy_file_contents(source_file, destination_file, size):
+                if progress:
+                    progress.add(count)
+
+        shutil.copystat(source, destination)
+
+        if os.path.getsize(destination) != size:
+            raise IOError(f"'{destination}' is {os.path.getsize(destination)} bytes; expected {size}.")
+
+        if self.verify == "hash" and MigrationTransport.hash_file(source) != MigrationTransport.hash_file(destination):
+            raise IOError(f"'{destination}' does not match '{source}'.")
+
+    @staticmethod
+    def copy_file_contents(source_file, destination_file, size):
+        """
+        Copies `size` bytes between two open files, yielding the number of bytes copied at each step.
+        """
+
+        source_fd, destination_fd = source_file.fileno(), destination_file.fileno()
+        copied = 0
+
+        for copy in (MigrationTransport.copy_file_range, MigrationTransport.sendfile):
+            try:
+                while copied < size:
+                    count = copy(source_fd, destination_fd, copied, min(MigrationTransport.BLOCK_SIZE, size - copied))
+
+                    if count == 0:
+                        break
+
+                    copied += count
+                    yield count
+
+                return
+
+            except (AttributeError, OSError):
+                continue  # not supported here (or for these files); try the next, more portable method
+
+        source_file.seek(copied)
+        destination_file.seek(copied)
+
+        while True:
+            block = source_file.read(MigrationTransport.BLOCK_SIZE)
+
+            if not block:
+                break
+
+            destination_file.write(block)
+            yield len(block)
+
+    @staticmethod
+    def copy_file_range(source_fd, destination_fd, offset, count):
+        return os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+
+    @staticmethod
+    def sendfile(source_fd, destination_fd, offset, count):
+        os.lseek(destination_fd, offset, os.SEEK_SET)
+        return os.sendfile(destination_fd, source_fd, offset, count)
+
+    @staticmethod
+    def hash_file(path):
+        digest = hashlib.sha256()
+
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(MigrationTransport.BLOCK_SIZE), b""):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+
+class LinkTransport:
+    """
+    Mirrors album trees as links instead of moving them: every directory is recreated, and every file is hardlinked,
+    reflinked (a copy-on-write clone, where the file system supports it) or - if that fails, e.g. across file systems
+    - symlinked. Staging this way only touches metadata, and leaves the originals where they are.
+
+    The albums that were linked are recorded in a manifest in the staging directory, so that unstaging them is just a
+    matter of deleting their link trees.
+    """
+
+    LINK_TYPES = ("hardlink", "reflink", "symlink")
+    MANIFEST = ".lydia-links.json"
+
+    FICLONE = 0x40049409  # from linux/fs.h
+
+    def __init__(self, link_type="hardlink", verbose=True):
+        """
+        :param link_type: One of "hardlink", "reflink" or "symlink".
+        :param verbose: Whether to report every linked album.
+        """
+
+        if link_type not in LinkTransport.LINK_TYPES:
+            raise ValueError(f"'{link_type}' is not a valid link type; expected one of {LinkTransport.LINK_TYPES}.")
+
+        self.link_type = link_type
+        self.verbose = verbose
+        self.links = Counter()  # link type -> the number of files linked that way
+
+    def link_tree(self, source, destination):
+        """
+        Mirrors the tree beneath `source` at `destination` (which mustn't exist yet).
+        """
+
+        if os.path.lexists(destination):
+            raise FileExistsError(f"'{destination}' already exists.")
+
+        with metrics.phase("link"):
+            for root, directories, files in os.walk(source):
+                target = os.path.join(destination, os.path.relpath(root, source))
+                os.makedirs(target, exist_ok=True)
+
+                for file in files:
+                    self.link_file(os.path.join(root, file), os.path.join(target, file))
+
+        if self.verbose:
+            print(f"INFO: Succesfully linked '{source}' to '{destination}'.")
+
+    def link_file(self, source, destination):
+        try:
+            if self.link_type == "hardlink":
+                os.link(source, destination, follow_symlinks=False)
+            elif self.link_type == "reflink":
+                LinkTransport.reflink(source, destination)
+            else:
+                os.symlink(os.path.abspath(source), destination)
+
+            link_type = self.link_type
+
+        except OSError:
+            os.symlink(os.path.abspath(source), destination)
+            link_type = "symlink"
+
+        self.links[link_type] += 1
+        metrics.count(f"files_{link_type}ed")
+
+    @staticmethod
+    def reflink(source, destination):
+        if fcntl is None:
+            raise OSError("reflinks aren't supported on this platform.")
+
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), LinkTransport.FICLONE, source_file.fileno())
+            except OSError:
+                destination_file.close()
+                os.remove(destination)
+                raise
+
+        shutil.copystat(source, destination)
+
+    @staticmethod
+    def get_manifest_path(staging_directory):
+        return os.path.join(staging_directory, LinkTransport.MANIFEST)
+
+    @staticmethod
+    def load_manifest(staging_directory):
+        """
+        Returns the paths of the album link trees in `staging_directory`.
+        """
+
+        path = LinkTransport.get_manifest_path(staging_directory)
+
+        if not os.path.isfile(path):
+            return []
+
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    @staticmethod
+    def save_manifest(staging_directory, paths):
+        with open(LinkTransport.get_manifest_path(staging_directory), "w", encoding="utf-8") as f:
+            json.dump(sorted(set(paths)), f, indent=4)
+
+    @staticmethod
+    def remove_manifest(staging_directory):
+        path = LinkTransport.get_manifest_path(staging_directory)
+
+        if os.path.isfile(path):
+            os.remove(path)
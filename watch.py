@@ -0,0 +1,303 @@
+import os
+import time
+import ctypes
+import select
+import struct
+import ctypes.util
+
+from models import AlbumDirectory, ArtistDirectory
+from rules import ARTIST_RULES, RuleEngine
+
+
+class InotifyEventSource:
+    """
+    Reports changed paths beneath a set of directories using Linux's inotify (via ctypes; no extra dependencies).
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+        | IN_DELETE_SELF | IN_MOVE_SELF
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, paths):
+        """
+        :param paths: The directories to watch (recursively).
+        """
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watches = {}  # watch descriptor -> path
+
+        for path in paths:
+            self.add_watches(path)
+
+    @staticmethod
+    def is_supported():
+        return hasattr(select, "poll") and ctypes.util.find_library("c") is not None \
+            and hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1")
+
+    def add_watches(self, path):
+        """
+        Watches `path` and every directory beneath it.
+        """
+
+        for root, directories, files in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), InotifyEventSource.WATCH_MASK)
+
+            if wd < 0:
+                print(f"WARNING: could not watch '{root}'.")
+                continue
+
+            self.watches[wd] = root
+
+    def read(self, timeout=None):
+        """
+        Blocks for up to `timeout` seconds (forever if None) and returns the paths that changed in the meantime.
+        """
+
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+
+        if not poller.poll(None if timeout is None else int(timeout * 1000)):
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        changed_paths = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = InotifyEventSource.EVENT_HEADER.unpack_from(data, offset)
+            offset += InotifyEventSource.EVENT_HEADER.size
+
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & InotifyEventSource.IN_Q_OVERFLOW:
+                print("WARNING: inotify's event queue overflowed; some changes may have been missed.")
+                continue
+
+            if mask & InotifyEventSource.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if wd not in self.watches:
+                continue
+
+            path = os.path.join(self.watches[wd], name) if name else self.watches[wd]
+            changed_paths.append(path)
+
+            if mask & InotifyEventSource.IN_ISDIR \
+                    and mask & (InotifyEventSource.IN_CREATE | InotifyEventSource.IN_MOVED_TO):
+                self.add_watches(path)
+
+        return changed_paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingEventSource:
+    """
+    Reports changed paths beneath a set of directories by periodically re-scanning them. Directory mtimes are tracked
+    everywhere; file sizes/mtimes only where `track_files` says so (files still being written don't touch their
+    directory's mtime).
+    """
+
+    def __init__(self, paths, interval=5.0, track_files=None):
+        """
+        :param paths: The directories to watch (recursively).
+        :param interval: The number of seconds between scans.
+        :param track_files: The subset of `paths` to track individual files in (defaults to all of them).
+        """
+
+        self.paths = paths
+        self.interval = interval
+        self.track_files = paths if track_files is None else track_files
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+
+        for path in self.paths:
+            stack = [path]
+
+            while stack:
+                directory = stack.pop()
+
+                try:
+                    state[directory] = os.stat(directory).st_mtime_ns
+
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if entry.is_dir():
+                                stack.append(entry.path)
+                            elif path in self.track_files:
+                                stat = entry.stat()
+                                state[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue
+
+        return state
+
+    def read(self, timeout=None):
+        """
+        Sleeps for up to `timeout` seconds (at most one polling interval) and returns the paths that changed.
+        """
+
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+
+        state = self.scan()
+
+        changed_paths = [p for p in state if self.state.get(p) != state[p]]
+        changed_paths += [p for p in self.state if p not in state]
+
+        self.state = state
+
+        return changed_paths
+
+    def close(self):
+        pass
+
+
+class AlbumWatcher:
+    """
+    Watches the albums and artists directories, and validates/cleans (and optionally migrates) only the albums that
+    changed - once they've been quiet for `debounce` seconds, i.e. once they've (probably) finished being written.
+    """
+
+    def __init__(self, config, catalog=None, debounce=10.0, migrate=False, force=False, event_source=None):
+        """
+        :param config: A `LydiaConfig`.
+        :param catalog: An optional `Catalog`.
+        :param debounce: The number of quiet seconds to wait for before handling a changed album.
+        :param migrate: Whether to migrate settled albums from the albums directory into the artists directory.
+        :param force: Whether empty artist directories (and their empty albums) may be deleted, as with `-A -f`.
+            Albums in the albums directory are cleaned as `album_validation_behavior` says, as with `-a`.
+        :param event_source: Where changes come from (defaults to inotify, falling back to polling).
+        """
+
+        self.albums_directory = os.path.normpath(config.albums_directory)
+        self.artists_directory = os.path.normpath(config.artists_directory)
+        self.catalog = catalog
+        self.debounce = debounce
+        self.migrate = migrate
+        self.force = force
+
+        # the same rules (and policies) as `clean_artists_directory` and `clean_albums_directory`
+        behavior = config.album_validation_behavior
+        overrides = {"empty": "force" if force else "warn"}
+
+        self.artist_rules = RuleEngine(behavior, rules=ARTIST_RULES, overrides=overrides)
+        self.artist_album_rules = RuleEngine(behavior, overrides=overrides)
+        self.album_rules = RuleEngine(behavior)
+
+        self.pending = {}  # album/artist path -> time of its latest change
+
+        if event_source:
+            self.event_source = event_source
+        elif InotifyEventSource.is_supported():
+            self.event_source = InotifyEventSource([self.albums_directory, self.artists_directory])
+        else:
+            print("INFO: inotify is unavailable; falling back to polling.")
+            self.event_source = PollingEventSource(
+                [self.albums_directory, self.artists_directory], track_files=[self.albums_directory]
+            )
+
+    def run(self, until=None):
+        """
+        Handles changes until interrupted (or until the `until` callable returns True).
+        """
+
+        print(f"INFO: Watching '{self.albums_directory}' and '{self.artists_directory}'...")
+
+        try:
+            while until is None or not until():
+                self.step()
+        except KeyboardInterrupt:
+            print("INFO: Stopped watching.")
+        finally:
+            self.event_source.close()
+
+    def step(self):
+        """
+        Waits for (and records) changes, then handles every directory that has settled.
+        """
+
+        now = time.monotonic()
+        timeout = None
+
+        if self.pending:
+            timeout = max(0.0, min(self.pending.values()) + self.debounce - now)
+
+        for path in self.event_source.read(timeout):
+            directory = self.get_affected_directory(path)
+
+            if directory:
+                self.pending[directory] = time.monotonic()
+
+        now = time.monotonic()
+
+        for directory, changed in sorted(self.pending.items()):
+            if now - changed >= self.debounce:
+                del self.pending[directory]
+                self.handle(directory)
+
+    def get_affected_directory(self, path):
+        """
+        Maps a changed path to the album (or artist) directory it belongs to.
+        """
+
+        path = os.path.normpath(path)
+
+        if path.startswith(self.albums_directory + os.sep):
+            names = path[len(self.albums_directory) + 1:].split(os.sep)
+            return os.path.join(self.albums_directory, names[0])
+
+        if path.startswith(self.artists_directory + os.sep):
+            names = path[len(self.artists_directory) + 1:].split(os.sep)
+            album_path = os.path.join(self.artists_directory, *names[:2])
+
+            # loose files, and albums that were removed/renamed, concern the artist directory itself
+            return album_path if os.path.isdir(album_path) else os.path.join(self.artists_directory, names[0])
+
+        return None
+
+    def handle(self, path):
+        if not os.path.isdir(path) or os.path.basename(path).startswith("_"):
+            return
+
+        if os.path.dirname(path) == self.artists_directory:
+            artist = ArtistDirectory(path, validate=False, parse_albums=False, catalog=self.catalog)
+            self.artist_rules.apply([artist])
+
+            return
+
+        album = AlbumDirectory(path, validate=False, catalog=self.catalog)
+
+        if os.path.dirname(path) == self.albums_directory:
+            self.album_rules.apply([album])
+        else:
+            self.artist_album_rules.apply([album])
+
+        if self.migrate and album.path is not None and os.path.dirname(album.path) == self.albums_directory:
+            album.migrate(self.artists_directory)
+
+        if self.catalog:
+            self.catalog.commit()
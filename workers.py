@@ -0,0 +1,68 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from models import Mp3, Track
+from metrics import metrics
+
+
+class TagExtractor:
+    """
+    Reads the tags of many (lazy) `Track` objects at once, fanned out across a worker pool.
+
+    Threads suit I/O-bound libraries (e.g. network mounts); processes suit CPU-bound eyed3 parsing. Either way, results
+    are handed back to the `Track` objects in the order they were given.
+    """
+
+    POOLS = {
+        "thread": ThreadPoolExecutor,
+        "process": ProcessPoolExecutor
+    }
+
+    def __init__(self, jobs=1, pool="thread"):
+        """
+        :param jobs: The number of workers (1 parses everything in-process, one file at a time).
+        :param pool: Either "thread" or "process".
+        """
+
+        if pool not in TagExtractor.POOLS:
+            raise ValueError(f"'{pool}' is not a valid pool; expected one of {list(TagExtractor.POOLS)}.")
+
+        self.jobs = max(1, jobs)
+        self.pool = pool
+
+    def extract(self, tracks):
+        """
+        Loads the tag fields of every given `Track` that doesn't already have them (or up-to-date catalog entries).
+        """
+
+        pending = [track for track in tracks if track.load_cached_tag_fields() is None]
+
+        if not pending:
+            return
+
+        paths = [track.disk_path for track in pending]
+
+        # the backend is passed along explicitly, since worker processes may not share this one's class attributes
+        read_tag_fields = functools.partial(Track.read_tag_fields, backend=Mp3.tag_backend)
+
+        with metrics.phase("tag_parsing"):
+            if self.jobs == 1 or len(pending) == 1:
+                results = map(read_tag_fields, paths)
+                self.merge(pending, results)
+            else:
+                with TagExtractor.POOLS[self.pool](max_workers=self.jobs) as executor:
+                    results = executor.map(read_tag_fields, paths, chunksize=self.chunksize(len(paths)))
+                    self.merge(pending, results)
+
+        metrics.count("tags_parsed", len(pending))
+
+    def chunksize(self, count):
+        if self.pool == "thread":
+            return 1
+
+        return max(1, count // (self.jobs * 4))
+
+    @staticmethod
+    def merge(tracks, results):
+        for track, fields in zip(tracks, results):
+            track.set_tag_fields(fields)